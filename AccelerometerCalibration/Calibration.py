@@ -1,34 +1,123 @@
-import numpy as np
-from Motor.libs.interface import CanBus
-from Motor.libs.gyems import Gyems
 import sys
 import numpy as np
-from RedisPostman.RedisWorker import AsyncRedisWorker
+
+
+class RunningStats():
+    """ Welford running mean and variance of 3-axis samples, O(1) memory: the statistics are kept
+    in a preallocated array instead of the samples. """
+
+    def __init__(self) -> None:
+        # rows: mean and sum of the squared deviations from the mean of each axis
+        self.stats = np.zeros((2, 3))
+        self.__delta__ = np.zeros(3)
+        self.count = 0
+
+    def reset(self):
+        """
+        Function to drop the accumulated samples.
+        """
+        self.stats[:] = 0
+        self.count = 0
+
+    def update(self, xyz):
+        """
+        Function to add a sample.
+        :param xyz: list of floats, sample of the three axes
+        """
+        self.count += 1
+        mean, m2 = self.stats
+        delta = self.__delta__
+        np.subtract(xyz, mean, out=delta)
+        mean += delta / self.count
+        # delta * (x - new mean)
+        m2 += delta * (np.asarray(xyz, dtype=float) - mean)
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.stats[0].copy()
+
+    @property
+    def variance(self) -> np.ndarray:
+        """ sample variance of each axis """
+        return self.stats[1] / (self.count - 1) if self.count > 1 else np.zeros(3)
+
+
+class StillnessGate():
+    """ Stillness detector over the accelerometer data alone, works on raw (uncalibrated) samples.
+    Keeps an exponentially weighted rolling mean and variance, the IMU is still when the variance
+    relative to the squared mean stays under the threshold for min_duration. """
+
+    def __init__(self, window=0.25, variance=1e-3, min_duration=1.0, sample_period=1 / 256) -> None:
+        """
+        :param window: float, time constant of the rolling mean and variance in seconds
+        :param variance: float, stillness threshold of the variance relative to the squared mean, sum over the axes
+        :param min_duration: float, time the IMU stays under the threshold before it is still, in seconds
+        :param sample_period: float, sampling period in seconds
+        """
+        self.alpha = min(1.0, sample_period / window)
+        self.threshold = variance
+        self.min_samples = max(1, round(min_duration / sample_period))
+        self.mean: list[float] | None = None
+        self.variance = 0.0
+        self.quiet_samples = 0
+
+    @property
+    def moving(self) -> bool:
+        """ the last sample was over the threshold """
+        return self.quiet_samples == 0
+
+    def update(self, xyz) -> bool:
+        """
+        Function to update the gate with new data.
+        :param xyz: list of floats, accelerometer sample
+        :return: bool, whether the IMU is still
+        """
+        x, y, z = (float(v) for v in xyz)
+        if self.mean is None:
+            self.mean = [x, y, z]
+        a = self.alpha
+        mx, my, mz = self.mean
+        dx, dy, dz = x - mx, y - my, z - mz
+        scale = mx * mx + my * my + mz * mz
+        self.variance = (1 - a) * (self.variance + a * (dx * dx + dy * dy + dz * dz))
+        self.mean = [mx + a * dx, my + a * dy, mz + a * dz]
+        if self.variance < self.threshold * scale:
+            self.quiet_samples += 1
+        else:
+            self.quiet_samples = 0
+        return self.quiet_samples >= self.min_samples
 
 
 class CalibrationByAxis():
-    """ Class used for calibration of a single axis. """
+    """ Class used for calibration of a single axis. The samples are captured while the IMU is still,
+    capture starts by itself once the StillnessGate opens and starts over if the IMU moves. """
 
 
     g = 9.81
 
-    def __init__(self, axis, n_measurements=1000, offsets_of_axis=[100000, 100000, 10000], to_show_progress=False) -> None:
+    def __init__(self, axis, n_measurements=1000, offsets_of_axis=[100000, 100000, 10000], to_show_progress=False,
+                 gate: StillnessGate | None = None, require_motion=False) -> None:
         """
         :param axis: int, axis to calibrate
         :param n_measurements: int, number of measurements to take
         :param offsets_of_axis: list of ints, initial offsets for each axis
         :param to_show_progress: bool, whether to show progress during calibration
+        :param gate: StillnessGate, stillness detector, defaults to StillnessGate()
+        :param require_motion: bool, whether the IMU has to move before the capture, e.g. to the pose of the next axis
         """
         self.axis = axis
         self.coeff = 1
         self.mean_val = 0
-        self.array: list[list[float]] = []
+        self.stats = RunningStats()
         self.n_measurements = n_measurements
         self.i = 0
-        self.offsets_of_axis = offsets_of_axis
+        self.offsets_of_axis = list(offsets_of_axis)
         self.to_show_progress = to_show_progress
         self.point = n_measurements/100
         self.increment = n_measurements/10
+        self.gate = gate if gate is not None else StillnessGate()
+        self.require_motion = require_motion
+        self.restarts = 0
 
     def show_progress(self):
         """
@@ -46,31 +135,41 @@ class CalibrationByAxis():
         :param xyz: list of floats, data to update calibration with
         :return: int, 0 if calibration is not complete, 1 if calibration is complete
         """
+        if self.i >= self.n_measurements:
+            return 1
+        still = self.gate.update(xyz)
+        if self.require_motion:
+            # the IMU is still in the pose of the previous axis
+            if self.gate.moving:
+                self.require_motion = False
+            return 0
+        if not still:
+            if self.i:
+                # the IMU moved during the capture, the pose may have changed
+                self.stats.reset()
+                self.i = 0
+                self.restarts += 1
+            return 0
+
+        self.stats.update(xyz)
+        self.i += 1
         if self.to_show_progress:
             self.show_progress()
         if self.i < self.n_measurements:
-            self.array.append(xyz)
-            self.i += 1
             # n iterations less that the desired one
             return 0
 
-        elif self.i == self.n_measurements:
-            mean_val = self.g/(np.mean(self.array[self.axis]) -
-                             self.offsets_of_axis[self.axis])
-            self.coeff = mean_val
-
-            array = np.array(self.array)
-
-            i = 0
-            while (i < 3):
-                if i != self.axis:
-                    mean_i = abs(np.mean(array[:, i], axis=0))
-                    # changes > to < and made default offset != 0, 0, 0
-                    if mean_i < abs(self.offsets_of_axis[i]):
-                        self.offsets_of_axis[i] = np.mean(array[:, i], axis=0)
-                i += 1
-            # calibration complete
-            return 1
+        mean = self.stats.mean
+        self.mean_val = mean[self.axis]
+        self.coeff = self.g/(mean[self.axis] - self.offsets_of_axis[self.axis])
+
+        for i in range(3):
+            if i != self.axis:
+                # changes > to < and made default offset != 0, 0, 0
+                if abs(mean[i]) < abs(self.offsets_of_axis[i]):
+                    self.offsets_of_axis[i] = float(mean[i])
+        # calibration complete
+        return 1
 
 
 class Calibration():
@@ -117,19 +216,25 @@ class Calibration():
 
 
 class CalibrationAcc(Calibration):
-    """ Class used for accelerometer calibration. """
-    def __init__(self, n_measurements=1000, to_show_progress=False) -> None:
+    """ Class used for accelerometer calibration. Runs unattended: the capture around each axis starts
+    when the IMU is held still, and the next axis waits until the IMU is moved to a new pose. """
+    def __init__(self, n_measurements=1000, to_show_progress=False, stillness: dict | None = None, wait_for_motion=False) -> None:
         """
     :param n_measurements: int, number of measurements to take
     :param to_show_progress: bool, whether to show progress during calibration
+    :param stillness: dict, StillnessGate parameters of each axis
+    :param wait_for_motion: bool, whether the IMU has to move before the capture of the first axis,
+        e.g. it is still in the last pose of the previous calibration
     """
         super().__init__(n_measurements=n_measurements)
+        stillness = stillness or {}
         self.acc_calib_x = CalibrationByAxis(
-            axis=0, n_measurements=n_measurements, to_show_progress=to_show_progress, offsets_of_axis=[0, 10000, 10000])
+            axis=0, n_measurements=n_measurements, to_show_progress=to_show_progress, offsets_of_axis=[0, 10000, 10000],
+            gate=StillnessGate(**stillness), require_motion=wait_for_motion)
         self.acc_calib_y = CalibrationByAxis(
-            axis=1, n_measurements=n_measurements, to_show_progress=to_show_progress)
+            axis=1, n_measurements=n_measurements, to_show_progress=to_show_progress, gate=StillnessGate(**stillness), require_motion=True)
         self.acc_calib_z = CalibrationByAxis(
-            axis=2, n_measurements=n_measurements, to_show_progress=to_show_progress)
+            axis=2, n_measurements=n_measurements, to_show_progress=to_show_progress, gate=StillnessGate(**stillness), require_motion=True)
 
         self.__to_show_progress__ = to_show_progress
 
@@ -139,8 +244,7 @@ class CalibrationAcc(Calibration):
         self.current_axis = self.acc_calib_x
 
         print(
-            f"\nPress ENTER to start calibrate accelerometer around the {self.axes[self.axis]} axis")
-        input()
+            f"\nHold the IMU still with gravity collinear with the {self.axes[self.axis]} axis, the capture starts by itself")
 
     def update_axis(self):
         """
@@ -163,17 +267,16 @@ class CalibrationAcc(Calibration):
         Function to set new data and get calibration parameters for each axis.
         :param xyz: list of floats, data to update calibration with
         """
+        if self.calibration_is_finished:
+            return
         result = super().calibrate(xyz)
         if result == 0:
             print("coeff", self.current_axis.coeff)
-            if self.update_axis() != 1:
+            self.update_axis()
+            if not self.calibration_is_finished:
                 self.current_axis.offsets_of_axis = self.offsets
                 print(
-                    f"\nRotate the IMU such as gravity is collinear with {self.axes[self.axis]}")
-                print(
-                    f"\nPress ENTER to start calibrate around the {self.axes[self.axis]} axis")
-                input()
-            self.current_axis.offsets_of_axis = self.offsets
+                    f"\nRotate the IMU such as gravity is collinear with {self.axes[self.axis]}, the capture starts when it is still")
 
     def get_coeffs(self):
         """
@@ -0,0 +1,167 @@
+import sys
+import numpy as np
+from AccelerometerCalibration.Calibration import RunningStats, StillnessGate
+
+
+def fit_ellipsoid(samples: np.ndarray, radius: float = 9.81) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Least-squares ellipsoid fit of static accelerometer samples. The samples of a static pose lie on
+    the ellipsoid (x - bias)^T A (x - bias) = 1, the correction maps it onto the sphere of the gravity:
+    |matrix @ (x - bias)| = radius. The matrix is the symmetric square root of A, it models
+    the scale of each axis and the cross-axis misalignment.
+    The quadric is solved over all samples at once through its 9x9 normal equations.
+    :param samples: (N, 3) raw accelerometer samples from many static poses, they have to span the sphere
+    :param radius: norm of the corrected samples
+    :return: (3, 3) correction matrix and (3,) bias
+    """
+    samples = np.asarray(samples, dtype=float)
+    if samples.ndim != 2 or samples.shape[1] != 3 or samples.shape[0] < 9:
+        raise ValueError(f"expected at least 9 samples of shape (N, 3), got {samples.shape}")
+    # conditioning: centered and scaled to about unit norm, one contiguous row per axis
+    axes = samples.T.copy()
+    center = axes.mean(axis=1)
+    axes -= center[:, None]
+    scale = np.sqrt(sum(row @ row for row in axes) / samples.shape[0])
+    axes /= scale
+    x, y, z = axes
+    # x^T A x + 2 b^T x = 1 with A = [[a, d, e], [d, b, f], [e, f, c]], one contiguous row per term
+    design = np.empty((9, samples.shape[0]))
+    for row, (u, v) in enumerate([(x, x), (y, y), (z, z), (x, y), (x, z), (y, z)]):
+        np.multiply(u, v, out=design[row])
+    design[3:6] *= 2
+    np.multiply(2, x, out=design[6])
+    np.multiply(2, y, out=design[7])
+    np.multiply(2, z, out=design[8])
+    normal = design @ design.T
+    if np.linalg.cond(normal) > 1e12:
+        raise ValueError("the poses do not span the ellipsoid, add more distinct static poses")
+    a, b, c, d, e, f, g, h, i = np.linalg.solve(normal, design.sum(axis=1))
+    quadric = np.array([[a, d, e], [d, b, f], [e, f, c]])
+    offset = -np.linalg.solve(quadric, np.array([g, h, i]))
+    quadric /= 1 + offset @ quadric @ offset
+    eigenvalues, eigenvectors = np.linalg.eigh(quadric)
+    if eigenvalues[0] <= 0:
+        raise ValueError("the samples do not fit an ellipsoid, add more distinct static poses")
+    root = (eigenvectors * np.sqrt(eigenvalues)) @ eigenvectors.T
+    return radius * root / scale, center + scale * offset
+
+
+class EllipsoidCalibration():
+    """ Class used for multi-position accelerometer calibration with the ellipsoid fit.
+    The IMU is put in many static poses in any order, samples_per_pose samples of each pose are kept
+    in a preallocated array. A pose is captured when the IMU is still (StillnessGate), the next one
+    waits until the IMU is moved, and poses closer than min_pose_angle to a captured one are ignored. """
+
+    g = 9.81
+
+    def __init__(self, n_poses=12, samples_per_pose=256, min_pose_angle=20.0, stillness: dict | None = None,
+                 to_show_progress=False, wait_for_motion=False) -> None:
+        """
+        :param n_poses: int, number of static poses to capture, at least 9, better spread over the whole sphere
+        :param samples_per_pose: int, number of samples of each pose
+        :param min_pose_angle: float, smallest angle between the gravity directions of two poses in degrees
+        :param stillness: dict, StillnessGate parameters
+        :param to_show_progress: bool, whether to show progress during calibration
+        :param wait_for_motion: bool, whether the IMU has to move before the first pose
+        """
+        self.n_poses = n_poses
+        self.samples_per_pose = samples_per_pose
+        self.min_pose_cos = np.cos(np.radians(min_pose_angle))
+        self.gate = StillnessGate(**(stillness or {}))
+        self.to_show_progress = to_show_progress
+        self.require_motion = wait_for_motion
+
+        self.samples = np.empty((n_poses * samples_per_pose, 3))
+        self.directions = np.empty((n_poses, 3))
+        self.pose_stats = RunningStats()
+        self.poses = 0
+        self.i = 0
+        self.matrix = np.eye(3)
+        self.bias = np.zeros(3)
+        self.calibration_is_finished = False
+
+        print(f"\nPut the IMU still in {n_poses} different poses, the capture starts by itself")
+
+    def show_progress(self):
+        """
+        Function to show progress during calibration.
+        """
+        sys.stdout.write(f"\rpose {self.poses + 1}/{self.n_poses} [" + "=" * int(10 * self.i / self.samples_per_pose) +
+                         " " * (10 - int(10 * self.i / self.samples_per_pose)) + "]")
+        sys.stdout.flush()
+
+    def calibrate(self, xyz):
+        """
+        Function to set new data, fits the ellipsoid after the last pose.
+        :param xyz: list of floats, data to update calibration with
+        :return: int, 0 if calibration is not complete, 1 if calibration is complete
+        """
+        if self.calibration_is_finished:
+            return 1
+        still = self.gate.update(xyz)
+        if self.require_motion:
+            if self.gate.moving:
+                self.require_motion = False
+            return 0
+        if not still:
+            # the pose changed during the capture
+            self.i = 0
+            self.pose_stats.reset()
+            return 0
+
+        if self.i == 0:
+            direction = np.asarray(xyz, dtype=float)
+            direction = direction / np.linalg.norm(direction)
+            if self.poses and np.max(self.directions[:self.poses] @ direction) > self.min_pose_cos:
+                # the same pose as a captured one
+                return 0
+        self.samples[self.poses * self.samples_per_pose + self.i] = xyz
+        self.pose_stats.update(xyz)
+        self.i += 1
+        if self.to_show_progress:
+            self.show_progress()
+        if self.i < self.samples_per_pose:
+            return 0
+
+        mean = self.pose_stats.mean
+        self.directions[self.poses] = mean / np.linalg.norm(mean)
+        self.poses += 1
+        self.i = 0
+        self.pose_stats.reset()
+        self.require_motion = True
+        if self.poses < self.n_poses:
+            print(f"\nPose {self.poses} captured, move the IMU to the next pose")
+            return 0
+
+        self.matrix, self.bias = fit_ellipsoid(self.samples, radius=self.g)
+        self.calibration_is_finished = True
+        print("\nmatrix", self.matrix.tolist(), "\nbias", self.bias.tolist())
+        return 1
+
+    def get_matrix(self):
+        """
+        Function to get the correction matrix.
+        :return: list of lists of floats, (3, 3) correction matrix
+        """
+        return self.matrix.tolist()
+
+    def get_bias(self):
+        """
+        Function to get the bias.
+        :return: list of floats, bias of each axis
+        """
+        return self.bias.tolist()
+
+    def get_coeffs(self):
+        """
+        Function to get the per-axis calibration coefficients, the diagonal of the correction matrix.
+        :return: list of floats, calibration coefficients
+        """
+        return np.diag(self.matrix).tolist()
+
+    def get_offsets(self):
+        """
+        Function to get the per-axis calibration offsets, the bias.
+        :return: list of floats, calibration offsets
+        """
+        return self.bias.tolist()
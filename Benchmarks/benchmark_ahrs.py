@@ -0,0 +1,134 @@
+"""
+Compares the AHRS engines on a synthetic trajectory with known orientation:
+CPU time per sample (update per sample and update_batch) and the orientation error
+against the ground truth, after the filters settle.
+
+The sensor rotates with a smooth angular velocity. The gyroscope gets noise and a constant bias,
+the accelerometer and the magnetometer get noise. The magnetic field is [131, 0, 157] in the earth frame,
+the reference of MadgwickAHRS.
+
+The trajectory follows the usual convention, q rotates the sensor frame to the earth frame and
+q_dot = q (x) (0, omega) / 2. MadgwickAHRS has its own convention: it integrates the gyroscope as
+exp(q_dot dt / 2) (x) q with q_dot = get_R(q) omega / 2 and converges to the orientation whose
+predicted gravity and magnetic field are opposite to the readings. The madgwick rows are compared
+against a ground truth generated in this convention from the same angular velocity, so their error
+is the accuracy of the filter: its correction step agrees with the convention near the identity only,
+and with the magnetometer it settles away from the ground truth even at rest. Every engine runs on the
+full trajectory and on one with a tenth of the angular velocity, which stays within ~20 deg of tilt.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_ahrs
+"""
+import time
+import numpy as np
+from Madgwick import quaternions
+from Madgwick.engines import create_ahrs
+from Madgwick.quaternion_calculation import get_q_dot, quaternion_exponential_integration
+
+# engines and parameter sets to compare
+candidates: list[tuple[str, dict]] = [
+    ("madgwick", {}),
+    ("madgwick", {"beta": np.full(4, 0.3)}),
+    ("mahony", {"kp": 1.0}),
+    ("mahony", {"kp": 2.0, "ki": 0.05}),
+    ("complementary", {"gain": 0.01}),
+    ("complementary", {"gain": 0.05}),
+]
+# ground truth convention of the engines, "standard" if not listed
+conventions = {"madgwick": "madgwick"}
+# angular velocity scales of the trajectories
+motion_scales = (1.0, 0.1)
+
+
+def integrate_madgwick(omega: np.ndarray, dt: np.ndarray) -> np.ndarray:
+    """
+    (N, 4) orientations of the (N, 3) angular velocity integrated like MadgwickAHRS.update_IMU without the correction step.
+    """
+    truth = np.empty((omega.shape[0], 4))
+    q = np.array([1.0, 0.0, 0.0, 0.0])
+    for i in range(omega.shape[0]):
+        q = quaternion_exponential_integration(q=q, omega_=get_q_dot(q, omega[i]), dt=dt[i])
+        q = q / quaternions.norm(q)
+        truth[i] = q
+    return truth
+
+
+def make_trajectory(n: int, rate: float = 256.0, seed: int = 0, motion: np.ndarray | None = None,
+                    convention: str = "standard") -> dict[str, np.ndarray]:
+    """
+    Ground truth quaternions (N, 4) and the sensor data gyr, acc, mag (N, 3), dt (N,).
+    motion (N,) scales the angular velocity, 0 - the sensor is at rest.
+    convention: "standard" or "madgwick", the convention of MadgwickAHRS, see the module docstring.
+    """
+    rng = np.random.default_rng(seed)
+    dt = np.full(n, 1 / rate)
+    t = np.arange(n) / rate
+    omega = np.stack([0.6 * np.sin(0.5 * t), 0.4 * np.sin(0.3 * t + 1), 0.5 * np.cos(0.2 * t)], axis=1)
+    if motion is not None:
+        omega *= motion[:, None]
+    if convention == "madgwick":
+        truth = integrate_madgwick(omega, dt)
+        sign = -1.0
+    else:
+        # exact integration of the angular velocity, q_{k+1} = q_k (x) exp((0, omega dt / 2))
+        steps = quaternions.exponential(np.concatenate([np.zeros((n, 1)), omega * dt[:, None] / 2], axis=1))
+        truth = np.empty((n, 4))
+        q = np.array([1.0, 0.0, 0.0, 0.0])
+        for i in range(n):
+            q = quaternions.multiply(q, steps[i])
+            truth[i] = q
+        sign = 1.0
+    # sensor frame measurements of the earth frame vectors, R^T v
+    to_sensor = quaternions.conjugate(truth)
+    acc = sign * quaternions.rotate(to_sensor, np.array([0.0, 0.0, 1.0])) + rng.normal(0, 0.02, (n, 3))
+    mag = sign * quaternions.rotate(to_sensor, np.array([131.0, 0.0, 157.0])) + rng.normal(0, 2.0, (n, 3))
+    gyr = omega + np.array([0.01, -0.02, 0.015]) + rng.normal(0, 0.01, (n, 3))
+    return {"truth": truth, "gyr": gyr, "acc": acc, "mag": mag, "dt": dt}
+
+
+def orientation_error(q: np.ndarray, truth: np.ndarray) -> np.ndarray:
+    """
+    (N,) angle between the orientations in degrees
+    """
+    dot = np.abs(np.einsum("...i,...i->...", quaternions.normalize(q), truth))
+    return np.degrees(2 * np.arccos(np.clip(dot, 0.0, 1.0)))
+
+
+def main(n: int = 20000, settle: float = 5.0) -> None:
+    start_index = int(settle * 256)
+    print(f"{n} samples, error after the first {settle} s")
+    print(f"{'engine':34s} {'update':>10s} {'update_batch':>13s} {'mean error':>11s} {'max error':>10s}")
+    for scale in motion_scales:
+        trajectories = {convention: make_trajectory(n, motion=np.full(n, scale), convention=convention)
+                        for convention in ("standard", *conventions.values())}
+        for with_mag in (False, True):
+            print(f"angular velocity x{scale:g}, " + ("accelerometer + gyroscope + magnetometer" if with_mag else "accelerometer + gyroscope"))
+            for engine, params in candidates:
+                data = trajectories[conventions.get(engine, "standard")]
+                mag = data["mag"] if with_mag else None
+                ahrs = create_ahrs(engine, **params)
+                start = time.perf_counter()
+                for i in range(2000):
+                    ahrs.update(data["gyr"][i], data["acc"][i], mag[i] if mag is not None else None, data["dt"][i])
+                per_sample = (time.perf_counter() - start) / 2000
+
+                ahrs = create_ahrs(engine, **params)
+                start = time.perf_counter()
+                q = ahrs.update_batch(data["gyr"], data["acc"], mag, data["dt"])
+                per_sample_batch = (time.perf_counter() - start) / n
+
+                # without the magnetometer the yaw is not observable, compare the tilt only
+                truth = data["truth"]
+                if not with_mag:
+                    yaw = quaternions.to_euler(truth)
+                    estimate = quaternions.to_euler(q)
+                    yaw[:, 2] = 0
+                    estimate[:, 2] = 0
+                    q, truth = quaternions.from_euler(estimate), quaternions.from_euler(yaw)
+                error = orientation_error(q[start_index:], truth[start_index:])
+                name = f"{engine} {', '.join(f'{k}={np.ravel(v)[0]:g}' for k, v in params.items())}"
+                print(f"  {name:32s} {per_sample * 1e6:7.1f} us {per_sample_batch * 1e6:10.1f} us {error.mean():9.2f} deg {error.max():7.2f} deg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+CPU time per message of the calibration stage of recalculate_data.py: the block path
+(BlockCoefficients.apply on the whole (N, imus, sensors, 3) block, then the JSON payloads of the block)
+for 1..16 IMUs, against the previous per-message path (calibrate_message, to_dict and json.dumps
+for every message) which handles the two IMUs of IMU9250Message only.
+Redis is not involved, the block path sends the payloads with one pipeline per block.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_calibration
+"""
+import json
+import time
+import numpy as np
+from RedisPostman.models import BlockCoefficients, ColumnarCodec, IMU9250Data, IMU9250Message, IMUCalibrationData, IMUCoefficients
+
+
+def make_coefficients(n_imus: int, rng: np.random.Generator) -> BlockCoefficients:
+    matrix = np.zeros((n_imus, 6, 6))
+    matrix[:, :3, :3] = np.eye(3) + rng.normal(0, 0.01, (n_imus, 3, 3))
+    matrix[:, 3:, 3:] = np.eye(3) * rng.uniform(0.9, 1.1, (n_imus, 1, 1))
+    return BlockCoefficients(matrix=matrix, shift=rng.normal(0, 1, (n_imus, 6)), acc_normalize=np.zeros(n_imus, dtype=bool))
+
+
+def calibrate_message(coefficients: IMUCoefficients, message: IMU9250Message) -> IMU9250Message:
+    """
+    The previous per-message calibration: applies the coefficients to the message in place,
+    the accelerometer data is normalized unless it is corrected with the ellipsoid fit matrix.
+    """
+    message.imu_1.gyr = coefficients.imu_1_gyr.apply(message.imu_1.gyr)
+    message.imu_1.acc = coefficients.imu_1_acc.apply(message.imu_1.acc)
+    if coefficients.imu_1_acc.matrix is None:
+        message.imu_1.acc = message.imu_1.acc/np.linalg.norm(message.imu_1.acc)
+
+    message.imu_2.gyr = coefficients.imu_2_gyr.apply(message.imu_2.gyr)
+    message.imu_2.acc = coefficients.imu_2_acc.apply(message.imu_2.acc)
+    if coefficients.imu_2_acc.matrix is None:
+        message.imu_2.acc = message.imu_2.acc/np.linalg.norm(message.imu_2.acc)
+    return message
+
+
+def per_message(n: int, rng: np.random.Generator) -> float:
+    coefficients = IMUCoefficients(*[IMUCalibrationData(offset=rng.normal(0, 1, 3), coeffs=rng.uniform(0.9, 1.1, 3)) for _ in range(4)])
+    data = rng.normal(0, 1, (n, 2, 3, 3))
+    messages = [IMU9250Message(imu_1=IMU9250Data(acc=row[0, 0], gyr=row[0, 1], mag=row[0, 2]),
+                               imu_2=IMU9250Data(acc=row[1, 0], gyr=row[1, 1], mag=row[1, 2])) for row in data]
+    start = time.perf_counter()
+    for message in messages:
+        json.dumps(calibrate_message(coefficients, message).to_dict())
+    return (time.perf_counter() - start) / n
+
+
+def per_block(n: int, n_imus: int, rng: np.random.Generator) -> tuple[float, float]:
+    """
+    time per message of the calibration alone and of the calibration with the payloads
+    """
+    codec = ColumnarCodec([f"imu_{i + 1}" for i in range(n_imus)], IMU9250Message.sensor_keys)
+    coefficients = make_coefficients(n_imus, rng)
+    block = rng.normal(0, 1, (n, n_imus, 3, 3))
+    start = time.perf_counter()
+    coefficients.apply(block)
+    calibration = time.perf_counter() - start
+    start = time.perf_counter()
+    coefficients.apply(block)
+    [json.dumps(payload) for payload in codec.encode(block)]
+    return calibration / n, (time.perf_counter() - start) / n
+
+
+def main(n: int = 2000) -> None:
+    rng = np.random.default_rng(0)
+    print(f"per message, {n} messages per block")
+    print(f"  per-message path, 2 IMUs: {per_message(n, rng) * 1e6:8.1f} us")
+    print(f"  {'IMUs':>4s} {'calibration':>12s} {'per IMU':>9s} {'with payloads':>14s}")
+    for n_imus in (1, 2, 4, 8, 16):
+        calibration, total = per_block(n, n_imus, rng)
+        print(f"  {n_imus:4d} {calibration * 1e6:9.2f} us {calibration * 1e9 / n_imus:6.0f} ns {total * 1e6:11.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares the per-message IMU9250Message.from_dict/to_dict path
+with the columnar codec on the same list of payloads.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_codec
+"""
+import json
+import time
+from typing import Callable
+import numpy as np
+from RedisPostman.models import IMU9250Message
+
+
+def make_payloads(n: int) -> list[dict]:
+    rng = np.random.default_rng(0)
+    block = rng.normal(size=(n, 2, 3, 3))
+    payloads = IMU9250Message.block_to_dicts(block)
+    # payloads come from JSON, so use JSON values
+    return json.loads(json.dumps(payloads))
+
+
+def measure(function: Callable, repeats: int = 5) -> float:
+    """
+    Returns the best time of the function call in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(n: int = 10000) -> None:
+    payloads = make_payloads(n)
+    messages = [IMU9250Message.from_dict(payload) for payload in payloads]
+    block = IMU9250Message.block_from_dicts(payloads)
+    out = np.empty_like(block)
+
+    results = {
+        "decode per message": measure(lambda: [IMU9250Message.from_dict(payload) for payload in payloads]),
+        "decode columnar": measure(lambda: IMU9250Message.block_from_dicts(payloads, out=out)),
+        "encode per message": measure(lambda: [message.to_dict() for message in messages]),
+        "encode columnar": measure(lambda: IMU9250Message.block_to_dicts(block)),
+    }
+    for name, seconds in results.items():
+        print(f"{name:20s}\t{seconds / n * 1e6:8.2f} us/message\t{n / seconds:12.0f} messages/s")
+    print(f"decode speedup: {results['decode per message'] / results['decode columnar']:.1f}x")
+    print(f"encode speedup: {results['encode per message'] / results['encode columnar']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Accelerometer calibration with the ellipsoid fit against the per-axis offsets and coefficients:
+synthetic raw samples of a sensor with cross-axis misalignment, scale errors, bias and noise,
+taken in static poses spread over the sphere. For every sample count: CPU time of fit_ellipsoid
+and the error of the corrected gravity norm of both calibrations.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_ellipsoid
+"""
+import time
+import numpy as np
+from AccelerometerCalibration.EllipsoidFit import fit_ellipsoid
+
+g = 9.81
+# raw counts per m/s^2 with cross-axis misalignment, and bias in counts
+sensor_matrix = np.array([[1670.0, 30.0, -20.0], [10.0, 1640.0, 25.0], [-15.0, 40.0, 1700.0]])
+sensor_bias = np.array([120.0, -300.0, 450.0])
+
+
+def make_poses(n_poses: int, samples_per_pose: int, seed: int = 0) -> np.ndarray:
+    """
+    (n_poses * samples_per_pose, 3) raw samples, the gravity directions on a Fibonacci sphere
+    """
+    rng = np.random.default_rng(seed)
+    k = np.arange(n_poses)
+    z = 1 - 2 * (k + 0.5) / n_poses
+    r = np.sqrt(1 - z * z)
+    phi = np.pi * (3 - np.sqrt(5)) * k
+    directions = np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+    gravity = np.repeat(directions, samples_per_pose, axis=0) * g
+    return gravity @ sensor_matrix.T + sensor_bias + rng.normal(0, 30, gravity.shape)
+
+
+def axes_calibration(samples: np.ndarray, n_poses: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    per-axis offsets and coefficients from the extreme pose means of each axis,
+    the best case of the calibration with the poses along the axes
+    """
+    means = samples.reshape(n_poses, -1, 3).mean(axis=1)
+    high, low = means.max(axis=0), means.min(axis=0)
+    return (high + low) / 2, 2 * g / (high - low)
+
+
+def main() -> None:
+    print(f"{'samples':>8s} {'fit time':>9s} {'ellipsoid norm error':>21s} {'per-axis norm error':>20s}")
+    for n_poses, samples_per_pose in [(12, 256), (24, 1000), (24, 12500), (48, 12500)]:
+        samples = make_poses(n_poses, samples_per_pose)
+        fit_ellipsoid(samples)
+        start = time.perf_counter()
+        matrix, bias = fit_ellipsoid(samples)
+        fit_time = time.perf_counter() - start
+        ellipsoid_error = np.abs(np.linalg.norm((samples - bias) @ matrix.T, axis=1) - g).mean()
+        offsets, coeffs = axes_calibration(samples, n_poses)
+        axes_error = np.abs(np.linalg.norm((samples - offsets) * coeffs, axis=1) - g).mean()
+        print(f"{samples.shape[0]:8d} {fit_time * 1e3:6.1f} ms {ellipsoid_error:16.4f} m/s^2 {axes_error:15.4f} m/s^2")
+
+
+if __name__ == "__main__":
+    main()
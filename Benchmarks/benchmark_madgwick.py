@@ -0,0 +1,87 @@
+"""
+Compares MadgwickAHRS.update_IMU called per sample with MadgwickAHRS.update_batch
+on the same synthetic block of samples: throughput and the largest difference
+between the quaternion trajectories. Then compares K separate filters with one
+MadgwickBank of K sensors.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_madgwick
+"""
+import time
+import numpy as np
+from Madgwick.MadgwickFilter import MadgwickAHRS
+from Madgwick.MadgwickBank import MadgwickBank
+from config import omega_e_imu_1
+
+
+def make_samples(n: int, rate: float = 500.0) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Slowly rotating sensor with noise: gyr, acc, mag (N, 3) and dt (N,).
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(n) / rate
+    gyr = np.stack([0.5 * np.sin(t), 0.3 * np.cos(0.7 * t), 0.2 * np.sin(0.3 * t)], axis=1) + rng.normal(0, 0.01, (n, 3))
+    acc = np.stack([0.3 * np.sin(t), 0.2 * np.cos(t), np.ones(n)], axis=1) + rng.normal(0, 0.02, (n, 3))
+    mag = np.stack([30 * np.cos(t), 30 * np.sin(t), 40 * np.ones(n)], axis=1) + rng.normal(0, 0.5, (n, 3))
+    dt = np.full(n, 1 / rate)
+    return gyr, acc, mag, dt
+
+
+def run_per_sample(gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+    mf = MadgwickAHRS(omega_e=omega_e_imu_1)
+    result = np.empty((gyr.shape[0], 4))
+    for i in range(gyr.shape[0]):
+        mf.update_IMU(gyros_data=gyr[i], accel_data=acc[i], magn_data=mag[i] if mag is not None else None, dt=dt[i])
+        result[i] = mf.quaternion
+    return result
+
+
+def run_batch(gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+    mf = MadgwickAHRS(omega_e=omega_e_imu_1)
+    return mf.update_batch(gyr, acc, mag, dt)
+
+
+def run_bank(n_filters: int, n: int) -> None:
+    gyr, acc, mag, dt = make_samples(n)
+    # every sensor gets the same motion, shifted in time
+    shifts = [np.roll(np.arange(n), 37 * k) for k in range(n_filters)]
+    gyr_k = np.stack([gyr[s] for s in shifts], axis=1)
+    acc_k = np.stack([acc[s] for s in shifts], axis=1)
+    mag_k = np.stack([mag[s] for s in shifts], axis=1)
+
+    start = time.perf_counter()
+    separate = np.stack([run_per_sample(gyr_k[:, k], acc_k[:, k], mag_k[:, k], dt) for k in range(n_filters)], axis=1)
+    separate_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bank = MadgwickBank(n_filters).update_batch(gyr_k, acc_k, mag_k, dt)
+    bank_time = time.perf_counter() - start
+
+    print(f"{n_filters} sensors")
+    print(f"\t{n_filters} x update_IMU:   {n / separate_time:10.0f} time steps/s")
+    print(f"\tMadgwickBank:     {n / bank_time:10.0f} time steps/s\t{separate_time / bank_time:.1f}x")
+    print(f"\tmax difference: {np.max(np.abs(separate - bank)):.2e}")
+
+
+def main(n: int = 20000) -> None:
+    gyr, acc, mag, dt = make_samples(n)
+    for name, m in [("accelerometer + gyroscope", None), ("with magnetometer", mag)]:
+        start = time.perf_counter()
+        per_sample = run_per_sample(gyr, acc, m, dt)
+        per_sample_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = run_batch(gyr, acc, m, dt)
+        batch_time = time.perf_counter() - start
+
+        print(name)
+        print(f"\tupdate_IMU:   {n / per_sample_time:10.0f} samples/s")
+        print(f"\tupdate_batch: {n / batch_time:10.0f} samples/s\t{per_sample_time / batch_time:.1f}x")
+        print(f"\tmax difference: {np.max(np.abs(per_sample - batch)):.2e}")
+
+    for n_filters in (2, 8, 16):
+        run_bank(n_filters, n // 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Regression check and per-sample latency of MadgwickAHRS.update_IMU_fast against
+MadgwickAHRS.update_IMU. Both filters get the same samples with the same dt, the
+quaternions must agree to within the tolerance, otherwise an AssertionError stops the script.
+
+Always checks both IMUs of the checked-in recording in Benchmarks/fixtures (a rest period
+where the correction step is skipped and a gap in the timestamps), then the recorded
+raw IMU stream from the archive directory when it exists, synthetic samples otherwise.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_madgwick_latency [archive directory]
+"""
+import json
+import os
+import sys
+import time
+import numpy as np
+from Madgwick.MadgwickFilter import MadgwickAHRS
+from RedisPostman.StreamArchiver import read_segments
+from RedisPostman.models import IMU9250Message
+from Benchmarks.benchmark_madgwick import make_samples
+from replay_recording import read_recording
+from config import omega_e_imu_1, imu_raw_message_channel, archive_directory, timestamp_key, imu_sample_period
+
+tolerance = 1e-12
+fixture = os.path.join(os.path.dirname(__file__), "fixtures", "imu_recording.txt.gz")
+
+
+def load_fixture(imu: int, path: str = fixture) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    gyr, acc, mag (N, 3) and dt (N,) of one IMU from the checked-in recording, dt from the sample timestamps.
+    """
+    payloads = list(read_recording(path))
+    block = IMU9250Message.block_from_dicts(payloads)[:, imu]
+    sensors = IMU9250Message.sensor_names
+    t = np.array([payload[timestamp_key] for payload in payloads])
+    dt = np.diff(t, prepend=t[0] - imu_sample_period)
+    return block[:, sensors.index("gyr")], block[:, sensors.index("acc")], block[:, sensors.index("mag")], dt
+
+
+def load_recorded(directory: str, imu: int = 0, limit: int = 20000) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None:
+    """
+    gyr, acc, mag (N, 3) and dt (N,) of one IMU from the archived raw stream, dt from the stream ids.
+    """
+    payloads = []
+    stamps = []
+    for stream_id, message in read_segments(directory, imu_raw_message_channel):
+        payloads.append(json.loads(message))
+        stamps.append(int(stream_id.split("-")[0]) / 1000)
+        if len(payloads) == limit:
+            break
+    if len(payloads) < 2:
+        return None
+    block = IMU9250Message.block_from_dicts(payloads)[:, imu]
+    sensors = IMU9250Message.sensor_names
+    dt = np.diff(np.array(stamps), prepend=stamps[0])
+    return block[:, sensors.index("gyr")], block[:, sensors.index("acc")], block[:, sensors.index("mag")], dt
+
+
+def run(update, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    quaternion after every sample (N, 4) and the latency of every call (N,) in seconds.
+    """
+    n = gyr.shape[0]
+    result = np.empty((n, 4))
+    latency = np.empty(n)
+    mf = MadgwickAHRS(omega_e=omega_e_imu_1)
+    step = getattr(mf, update)
+    for i in range(n):
+        g, a, m, d = gyr[i], acc[i], mag[i] if mag is not None else None, float(dt[i])
+        start = time.perf_counter()
+        step(g, a, m, d)
+        latency[i] = time.perf_counter() - start
+        result[i] = mf.quaternion
+    return result, latency
+
+
+def check(source: str, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray, dt: np.ndarray) -> None:
+    """
+    Runs both methods with and without the magnetometer, prints the latency and asserts the agreement.
+    """
+    for name, m in [("accelerometer + gyroscope", None), ("with magnetometer", mag)]:
+        reference, reference_latency = run("update_IMU", gyr, acc, m, dt)
+        fast, fast_latency = run("update_IMU_fast", gyr, acc, m, dt)
+        difference = np.max(np.abs(reference - fast))
+
+        print(f"{source}, {name}")
+        for method, latency in [("update_IMU", reference_latency), ("update_IMU_fast", fast_latency)]:
+            p50, p99 = np.percentile(latency, [50, 99]) * 1e6
+            print(f"\t{method:16s} p50 {p50:7.1f} us\tp99 {p99:7.1f} us")
+        print(f"\tmax difference: {difference:.2e}")
+        assert difference <= tolerance, f"{source}, {name}: update_IMU_fast differs from update_IMU by {difference:.2e}"
+
+
+def main(directory: str = archive_directory) -> None:
+    for imu, imu_name in enumerate(IMU9250Message.imu_names):
+        check(f"fixture {imu_name}", *load_fixture(imu))
+
+    samples = load_recorded(directory)
+    source = f"recorded {directory}"
+    if samples is None:
+        print(f"no recorded {imu_raw_message_channel} data in {directory}, using synthetic samples")
+        samples = make_samples(20000)
+        source = "synthetic"
+    check(source, *samples)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,71 @@
+"""
+Compares the vectorized functions of Madgwick/quaternions.py with the previous
+single-quaternion functions (copied below as they were) looped over N quaternions:
+time and the largest difference of the results.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_quaternions
+"""
+import time
+from typing import Callable
+import numpy as np
+from scipy.special import logsumexp  # type:ignore
+from Madgwick import quaternions
+
+
+def legacy_normalize(v, tolerance=0.00001):
+    mag2 = logsumexp([n * n for n in v])
+    if abs(mag2 - 1.0) > tolerance:
+        mag = np.sqrt(mag2)
+        v = tuple(n / mag for n in v)
+    return np.array(v)
+
+
+def legacy_multiply(q_1, q_2):
+    scalar_part = q_1[0] * q_2[0] - np.dot(q_1[1:], q_2[1:])
+    vector_part = q_1[0] * q_2[1:] + q_2[0] * q_1[1:] + np.cross(q_1[1:], q_2[1:])
+    return np.hstack([[scalar_part], vector_part])
+
+
+def legacy_rotation_matrix(q):
+    return np.array([[q[0] ** 2 + q[1] ** 2 - q[2] ** 2 - q[3] ** 2, 2 * (q[1] * q[2] - q[0] * q[3]), 2 * (q[1] * q[3] + q[0] * q[2])],
+                     [2 * (q[1] * q[2] + q[0] * q[3]), q[0] ** 2 - q[1] ** 2 + q[2] ** 2 - q[3] ** 2, 2 * (q[2] * q[3] - q[0] * q[1])],
+                     [2 * (q[1] * q[3] - q[0] * q[2]), 2 * (q[2] * q[3] + q[0] * q[1]), q[0] ** 2 - q[1] ** 2 - q[2] ** 2 + q[3] ** 2]])
+
+
+def legacy_rotate(q, v):
+    q_conj = np.hstack([[q[0]], -q[1:]])
+    return legacy_multiply(q, legacy_multiply(np.hstack([[0.0], v]), q_conj))[1:]
+
+
+def compare(name: str, legacy: Callable[[int], np.ndarray], vectorized: Callable[[], np.ndarray], n: int) -> None:
+    start = time.perf_counter()
+    expected = np.array([legacy(i) for i in range(n)])
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = vectorized()
+    vectorized_time = time.perf_counter() - start
+
+    print(f"{name:16s} loop {legacy_time * 1e3:8.1f} ms\tvectorized {vectorized_time * 1e3:6.2f} ms\t"
+          f"{legacy_time / vectorized_time:6.0f}x\tmax difference {np.max(np.abs(expected - result)):.2e}")
+
+
+def main(n: int = 20000) -> None:
+    rng = np.random.default_rng(0)
+    q = rng.normal(size=(n, 4))
+    p = quaternions.normalize(rng.normal(size=(n, 4)))
+    v = rng.normal(size=(n, 3))
+    unit_q = quaternions.normalize(q)
+
+    compare("multiply", lambda i: legacy_multiply(p[i], unit_q[i]), lambda: quaternions.multiply(p, unit_q), n)
+    compare("rotation_matrix", lambda i: legacy_rotation_matrix(unit_q[i]), lambda: quaternions.rotation_matrix(unit_q), n)
+    compare("rotate", lambda i: legacy_rotate(unit_q[i], v[i]), lambda: quaternions.rotate(unit_q, v), n)
+    # the legacy normalize takes log(sum(exp(x^2))) for the squared norm, so its result is not a unit quaternion
+    compare("normalize", lambda i: legacy_normalize(q[i]), lambda: quaternions.normalize(q, tolerance=0.00001), n)
+    print(f"\tnorm after legacy normalize: {quaternions.norm(np.array([legacy_normalize(x) for x in q[:1000]])).min():.3f}"
+          f" .. {quaternions.norm(np.array([legacy_normalize(x) for x in q[:1000]])).max():.3f}")
+
+
+if __name__ == "__main__":
+    main()
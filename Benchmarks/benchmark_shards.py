@@ -0,0 +1,77 @@
+"""
+Throughput of the sharded Madgwick transformer: the IMUs are split between worker processes
+as in madgwick_transformer.py, every worker decodes only the fields of its IMUs
+(IMU9250Message.batch_from_dicts with imu_names) and runs its filter bank.
+Redis and the JSON decoding are not included, the messages are generated in the workers as dicts;
+the ShardMerger of the merge process is timed separately.
+
+The throughput can only scale up to the number of CPU cores, the CPU time of the slowest worker
+gives the throughput with a core per worker on machines with fewer cores.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_shards
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Madgwick.engines import create_bank
+from RedisPostman.models import IMU9250Message
+from RedisPostman.ShardMerger import ShardMerger
+from madgwick_transformer import shard_imu_names, update_bank
+from config import ahrs_engine, ahrs_parameters, timestamp_key
+
+
+def make_messages(imu_names: list[str], n: int, seed: int = 0) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    keys = [key for sensor in IMU9250Message.sensor_keys.values() for key in sensor]
+    values = rng.normal(size=(n, len(imu_names), len(keys)))
+    values[:, :, 2] += 1.0
+    return [{imu: dict(zip(keys, row)) for imu, row in zip(imu_names, message)} | {timestamp_key: i / 256}
+            for i, message in enumerate(values.tolist())]
+
+
+def shard_job(all_imu_names: list[str], imu_names: list[str], n: int, block: int = 1000) -> tuple[float, float]:
+    """
+    Wall and CPU time of one worker to decode and filter n messages of all_imu_names, in blocks as read from redis.
+    """
+    messages = make_messages(all_imu_names, n)
+    bank = create_bank(ahrs_engine, len(imu_names), **ahrs_parameters[ahrs_engine])
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for i in range(0, n, block):
+        batch = IMU9250Message.batch_from_dicts(messages[i:i + block], imu_names=imu_names)
+        update_bank(bank, batch, imu_names, bank.timestamps_to_dt(batch[timestamp_key]))
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def merge_rate(n_shards: int, n: int) -> float:
+    """
+    Messages per second ShardMerger joins from n_shards shards.
+    """
+    merger = ShardMerger(n_shards)
+    partial = [[{f"imu_{k}": [1.0, 0.0, 0.0, 0.0], "source": f"{i}-0", timestamp_key: i / 256} for i in range(n)] for k in range(n_shards)]
+    start = time.perf_counter()
+    for i in range(0, n, 1000):
+        for shard in range(n_shards):
+            merger.add(shard, partial[shard][i:i + 1000])
+        merger.pop_ready()
+    return n / (time.perf_counter() - start)
+
+
+def main(n_imus: int = 8, n: int = 20000) -> None:
+    imu_names = [f"imu_{i + 1}" for i in range(n_imus)]
+    print(f"{n_imus} IMUs, {n} messages, {os.cpu_count()} CPU cores")
+    for n_shards in (1, 2, 4, 8):
+        shards = shard_imu_names(imu_names, n_shards)
+        with ProcessPoolExecutor(len(shards)) as executor:
+            times = list(executor.map(shard_job, [imu_names] * len(shards), shards, [n] * len(shards)))
+        wall = max(t[0] for t in times)
+        cpu = max(t[1] for t in times)
+        # the slowest worker limits the merged stream
+        merge = f", merge step {merge_rate(len(shards), n):.0f} messages/s" if len(shards) > 1 else ""
+        print(f"  {len(shards)} shards: {n / wall:9.0f} messages/s, {n / cpu:9.0f} messages/s with a core per worker{merge}")
+
+
+if __name__ == "__main__":
+    main()
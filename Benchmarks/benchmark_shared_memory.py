@@ -0,0 +1,59 @@
+"""
+Writes the calibrated messages of recalculate_data.py (block_to_payloads of a calibrated block,
+with the timestamps and the calibration version) through a SharedMemoryRing with shared_memory_slot_size
+in every encoding, checks that each message fits the slot and is read back unchanged,
+and reports the write and read time per message.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_shared_memory
+"""
+import os
+import time
+import numpy as np
+from config import shared_memory_slot_size
+from recalculate_data import block_to_payloads
+from RedisPostman.models import IMU9250Message, get_serializer, serializer_classes
+from RedisPostman.SharedMemoryBroker import SharedMemoryReader, SharedMemoryRing, largest_payload
+from Benchmarks.benchmark_calibration import make_coefficients
+
+
+def make_payloads(n: int) -> list[dict]:
+    rng = np.random.default_rng(0)
+    block = rng.normal(0, 1000, (n, len(IMU9250Message.imu_names), 3, 3))
+    make_coefficients(len(IMU9250Message.imu_names), rng).apply(block)
+    timestamps = 2.6e5 + np.arange(n) / 256
+    return block_to_payloads(IMU9250Message, block, timestamps, version=12)
+
+
+def main(n: int = 20000) -> None:
+    payloads = make_payloads(n)
+    ring = SharedMemoryRing(f"imu_tools_benchmark_{os.getpid()}", shared_memory_slot_size, n)
+    print(f"slot of {shared_memory_slot_size} bytes, {ring.max_message_size} bytes for a message")
+    try:
+        for encoding in serializer_classes:
+            try:
+                serializer = get_serializer(encoding)
+            except ImportError:
+                print(f"{encoding:8s} not available")
+                continue
+            messages = [serializer.dumps(payload) for payload in payloads]
+            messages = [message.encode() if isinstance(message, str) else message for message in messages]
+            largest = len(serializer.dumps(largest_payload()))
+            reader = SharedMemoryReader(ring, "$")
+            start = time.perf_counter()
+            for message in messages:
+                ring.write(message, encoding)
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            records = reader.read(n)
+            read_time = time.perf_counter() - start
+            assert reader.lost == 0 and [record[1] for record in records] == messages
+            print(f"{encoding:8s} {max(map(len, messages)):4d} bytes, up to {largest:4d}\t"
+                  f"write {write_time / n * 1e6:6.2f} us/message\tread {read_time / n * 1e6:6.2f} us/message")
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+if __name__ == "__main__":
+    main()
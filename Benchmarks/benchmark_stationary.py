@@ -0,0 +1,86 @@
+"""
+Compute saved by the rest scheduling of MadgwickAHRS (the stationary parameter) on typical duty cycles:
+the sensor alternates between rest and motion in 20 s cycles, with 0..95% of the time at rest.
+For every duty cycle: CPU time per sample of update_batch without and with the scheduling,
+the share of the samples at rest and of the held samples, the mean orientation error of both
+against the ground truth (tilt only without the magnetometer) and the gyroscope bias estimate at the end.
+The ground truth is generated in the convention of MadgwickAHRS, see Benchmarks/benchmark_ahrs.py,
+with motion_scale of its angular velocity, slow enough for the filter and above the rate threshold of the detector.
+The filter still drifts away from the ground truth within seconds to a minute, first in yaw and then in tilt,
+so the error columns show its accuracy on the duty cycle and are large with or without the scheduling.
+
+Run from the repository root:
+    python -m Benchmarks.benchmark_stationary
+"""
+import time
+import numpy as np
+from Benchmarks.benchmark_ahrs import make_trajectory, orientation_error
+from Madgwick import quaternions
+from Madgwick.MadgwickFilter import MadgwickAHRS
+from config import stationary_detection
+
+# gyroscope bias of make_trajectory
+true_bias = np.array([0.01, -0.02, 0.015])
+# angular velocity scale of make_trajectory in motion
+motion_scale = 0.3
+
+
+def duty_cycle(n: int, rest_fraction: float, cycle: float = 20.0, rate: float = 256.0) -> np.ndarray:
+    """
+    (N,) motion envelope, 0 at rest, 1 in motion, the rest at the start of every cycle
+    """
+    phase = (np.arange(n) / rate) % cycle / cycle
+    return (phase >= rest_fraction).astype(float)
+
+
+def tilt(q: np.ndarray) -> np.ndarray:
+    """
+    (N, 4) orientations without the yaw
+    """
+    euler = quaternions.to_euler(q)
+    euler[:, 2] = 0
+    return quaternions.from_euler(euler)
+
+
+def timed_batch(stationary: dict | None, data: dict[str, np.ndarray], mag: np.ndarray | None, repeat: int = 3) -> tuple[MadgwickAHRS, np.ndarray, float]:
+    """
+    Best of repeat runs of update_batch of a new filter, returns the filter of the last run, its quaternions and the time per sample
+    """
+    best = np.inf
+    for _ in range(repeat):
+        ahrs = MadgwickAHRS(stationary=stationary)
+        start = time.perf_counter()
+        q = ahrs.update_batch(data["gyr"], data["acc"], mag, data["dt"])
+        best = min(best, time.perf_counter() - start)
+    return ahrs, q, best / data["gyr"].shape[0]
+
+
+def main(n: int = 256 * 120) -> None:
+    # the gyroscope data of make_trajectory is not calibrated, the rate threshold has to be above its bias
+    stationary = {**(stationary_detection or {}), "gyr_rate": 0.05}
+    print(f"{n} samples, rest scheduling {stationary}")
+    print(f"{'rest':>5s} {'full':>9s} {'scheduled':>10s} {'saved':>6s} {'at rest':>8s} {'held':>6s} "
+          f"{'full error':>11s} {'scheduled error':>16s} {'bias error':>11s}")
+    for with_mag in (False, True):
+        print("accelerometer + gyroscope + magnetometer" if with_mag else "accelerometer + gyroscope")
+        for rest_fraction in (0.0, 0.5, 0.8, 0.95):
+            data = make_trajectory(n, motion=duty_cycle(n, rest_fraction) * motion_scale, convention="madgwick")
+            mag = data["mag"] if with_mag else None
+            _, q_full, full_time = timed_batch(None, data, mag)
+            scheduled, q_scheduled, scheduled_time = timed_batch(stationary, data, mag)
+
+            assert scheduled.detector is not None
+            stats = scheduled.detector.stats()
+            truth = data["truth"]
+            if not with_mag:
+                q_full, q_scheduled, truth = tilt(q_full), tilt(q_scheduled), tilt(truth)
+            full_error = orientation_error(q_full, truth).mean()
+            scheduled_error = orientation_error(q_scheduled, truth).mean()
+            bias_error = np.linalg.norm(np.array(scheduled.detector.bias) - true_bias)
+            print(f"{rest_fraction:5.0%} {full_time * 1e6:6.2f} us {scheduled_time * 1e6:7.2f} us {1 - scheduled_time / full_time:6.0%} "
+                  f"{stats['rest_fraction']:8.0%} {stats['skipped_fraction']:6.0%} "
+                  f"{full_error:7.2f} deg {scheduled_error:12.2f} deg {bias_error:7.4f} rad/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,117 @@
 import asyncio
 import datetime
-import serial  # type:ignore
 import json
-from redis import asyncio as aioredis
-from RedisPostman.MessageBroker import ARedisMessageBroker
-from config import mpu9250_headers, imu_raw_message_channel, log_message_channel, esp_headers
-from RedisPostman.models import LogMessage
+import time
+from RedisPostman.MessageBroker import ABufferedPublisher, BatchStats
+from RedisPostman.SharedMemoryBroker import create_async_broker
+from RedisPostman.ConnectionManager import get_async_redis
+from config import mpu9250_headers, imu_raw_message_channel, log_message_channel, esp_headers, serial_port_name, serial_baudrate, serial_frame_mode, binary_frame_field_type, timestamp_key, imu_sample_period, publish_batch_size, publish_max_latency, message_encodings
+from RedisPostman.models import IMU9250Message, LogMessage, get_serializer
+from SerialReader.AsyncSerialReader import AsyncSerialReader
+from SerialReader.BinaryFrames import BinaryFrameDecoder, esp_payload_dtype, records_to_block
 
 
-def open_serial_port():
-    global serialPort
-    serialPort = serial.Serial(
-        port='/dev/ttyUSB0', baudrate=115200)  # open serial port
-    print(serialPort.name)  # check which port was really used
+async def open_serial_port() -> AsyncSerialReader:
+    reader = await AsyncSerialReader.open(port=serial_port_name, baudrate=serial_baudrate)  # open serial port
+    print(reader.serial_port.name)  # check which port was really used
+    return reader
 
-async def read_serial_and_post_to_redis():
+
+async def read_binary_frames(serialReader: AsyncSerialReader, decoder: BinaryFrameDecoder):
     """
-    Read data from IMU using serial port and post to redis stream.
+    Decode binary frames from the serial port and post them to redis stream.
+    Messages are timestamped by the frame sequence numbers, the device clock,
+    starting from the monotonic time of the first frame.
+    The frames of a read are encoded with the columnar codec and published with one publish_many.
+    """
+    encoding = message_encodings.get(imu_raw_message_channel, "json")
+    serializer = get_serializer(encoding)
+    start_time: float | None = None
+    async for records in serialReader.records(decoder):
+        if start_time is None:
+            start_time = time.monotonic() - int(decoder.frame_index[0]) * imu_sample_period
+        timestamps = (start_time + decoder.frame_index * imu_sample_period).tolist()
+        payloads = IMU9250Message.codec.encode(records_to_block(records, IMU9250Message.imu_names, IMU9250Message.sensor_keys))
+        for payload, t in zip(payloads, timestamps):
+            payload[timestamp_key] = t
+        await broker.publish_many(imu_raw_message_channel, [serializer.dumps(payload) for payload in payloads], encoding)
+        frame_stats.add(len(payloads))
+
+
+async def read_json_lines(serialReader: AsyncSerialReader, to_skip_first_line: bool):
     """
+    Read JSON lines from the serial port and post them to redis stream.
+    Lines without device timestamp are timestamped at ingest: the lines received
+    together are spread evenly over the monotonic time since the previous read.
+    """
+    prev_time = time.monotonic()
+    # Wait until there are complete lines in the serial buffer,
+    # the event loop is free while waiting
+    async for lines in serialReader.frames():
+        if to_skip_first_line:
+            print(lines[0].decode('Ascii', errors="replace"))
+            lines = lines[1:]
+            to_skip_first_line = False
 
-    open_serial_port()
-    serialString = serialPort.readline()
-    print(serialString.decode('Ascii'))
-    while (1):
-        try:
-            # Wait until there is data waiting in the serial buffer
-            if (serialPort.in_waiting > 0):
+        now = time.monotonic()
+        step = (now - prev_time) / max(len(lines), 1)
+        for i, serialString in enumerate(lines):
+            # Build a dict with received data.
+            result = json.loads(serialString.decode("Ascii"))
+            if timestamp_key not in result:
+                result[timestamp_key] = prev_time + (i + 1) * step
 
-                # Read data out of the buffer until a carriage return / new line is found
-                serialString = serialPort.readline()
+            await publisher.publish_dict(imu_raw_message_channel, result)
+        prev_time = now
 
-                # Get the contents of the serial data
-                # data = list(serialString.decode('Ascii').split(" "))
-                # Build a dict with received data.
-                result = json.loads(serialString.decode("Ascii"))
 
-                # result = {}
-                # for val, header in zip(data, mpu9250_headers):
-                #     result[header] = float(val)
+async def read_serial_and_post_to_redis():
+    """
+    Read data from IMU using serial port and post to redis stream.
+    """
 
-                await broker.publish(imu_raw_message_channel, json.dumps(result))
+    global redis_, broker, publisher, frame_stats
+    redis_ = get_async_redis()
+    broker = create_async_broker(redis_)
+    publisher = ABufferedPublisher(broker, max_batch_size=publish_batch_size, max_latency=publish_max_latency, encodings=message_encodings)
+    frame_stats = BatchStats()
 
-        except KeyboardInterrupt:
-            serialPort.close()
-            await redis_.delete(imu_raw_message_channel)
-            return
+    serialReader = await open_serial_port()
+    decoder = BinaryFrameDecoder(esp_payload_dtype(field_type=binary_frame_field_type))
+    # Ctrl-C cancels this task (Python 3.11+) or raises KeyboardInterrupt in it, the final flush
+    # and the removal of the channels run in finally while the event loop is still alive
+    try:
+        while (1):
+            try:
+                if serial_frame_mode == "binary":
+                    await read_binary_frames(serialReader, decoder)
+                else:
+                    # the first line is usually received partially, so skip it
+                    await read_json_lines(serialReader, to_skip_first_line=True)
 
-        except Exception as e:
-            error_message = LogMessage(date=datetime.datetime.now(), process_name="IMU_read_serial_to_redis_async", status=LogMessage.exception_to_dict(e))
-            message_str: str = json.dumps(error_message.to_dict())
-            assert isinstance(message_str, str)
-            await broker.publish(log_message_channel, message_str)
-            serialPort.close()
-            open_serial_port()
+            except Exception as e:
+                error_message = LogMessage(date=datetime.datetime.now(), process_name="IMU_read_serial_to_redis_async", status=LogMessage.exception_to_dict(e))
+                message_str: str = json.dumps(error_message.to_dict())
+                assert isinstance(message_str, str)
+                await broker.publish(log_message_channel, message_str)
+                serialReader.close()
+                serialReader = await open_serial_port()
+    finally:
+        await publisher.flush()
+        if serial_frame_mode == "binary":
+            print(f"[INFO]:\tpublished {frame_stats}")
+            print(f"[INFO]:\tframes: {decoder.n_frames}\tlost: {decoder.lost_frames}\tCRC errors: {decoder.crc_errors}")
+        else:
+            print(f"[INFO]:\tpublished {publisher.stats}")
+        serialReader.close()
+        # removes the shared memory rings of the published channels
+        await broker.close()
+        await redis_.delete(imu_raw_message_channel)
 
 
 if __name__ == "__main__":
 
-    redis_ = aioredis.from_url("redis://localhost:6379/0")
-    broker = ARedisMessageBroker(redis_)
-
-    serialPort: serial.Serial
-    asyncio.run(read_serial_and_post_to_redis())
+    try:
+        asyncio.run(read_serial_and_post_to_redis())
+    except KeyboardInterrupt:
+        pass
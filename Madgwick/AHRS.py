@@ -0,0 +1,185 @@
+import abc
+import time
+from typing import Any
+import numpy as np
+
+
+def clamp_dt(dt: np.ndarray, sample_period: float, max_dt: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Replaces gaps in the per-sample dt with the sampling period
+    :param dt: (N,) time between samples in seconds
+    :param sample_period: nominal sampling period
+    :param max_dt: longest valid dt, longer, negative or NaN dt is a gap
+    :return: clamped dt and (N,) bool mask of the gaps
+    """
+    gaps = ~((dt >= 0) & (dt <= max_dt))
+    return np.where(gaps, sample_period, dt), gaps
+
+
+def timestamps_to_dt(t: np.ndarray, prev_timestamp: float | None, sample_period: float) -> tuple[np.ndarray, float | None]:
+    """
+    Time since the previous sample for every sample
+    :param t: (N,) sample timestamps in seconds, NaN if unknown
+    :param prev_timestamp: timestamp of the sample before t[0], None if there was none
+    :param sample_period: dt of the very first sample
+    :return: (N,) dt and the timestamp of the last sample
+    """
+    t = np.asarray(t, dtype=float)
+    if t.shape[0] == 0:
+        return t, prev_timestamp
+    prev = prev_timestamp if prev_timestamp is not None else t[0] - sample_period
+    return np.diff(t, prepend=prev), float(t[-1])
+
+
+class AHRS(abc.ABC):
+    """ Common interface of the orientation filters (attitude and heading reference systems).
+
+    Args:
+    sample_period (float, optional): sampling period in seconds, used for the gaps. Defaults to 1/256.
+    max_dt (float, optional): longest valid time between samples in seconds, longer or negative dt is a gap. Defaults to 0.1.
+
+    Attributes:
+    quaternion (np.ndarray): current orientation, [w, x, y, z], sensor frame to earth frame.
+    prev_time (float): time of the previous update.
+    prev_timestamp (float | None): sensor timestamp of the previous sample, used by timestamps_to_dt.
+    gaps (int): number of samples whose dt was a gap and was replaced by sample_period.
+
+    Methods:
+    update(gyr, acc, mag, dt): updates the orientation with one sample.
+    update_batch(gyr, acc, mag, dt): updates the orientation with a block of samples.
+    timestamps_to_dt(t): per-sample dt from the sensor timestamps.
+    state_dict(): JSON-serializable snapshot of the filter state.
+    load_state(state): restores the snapshot. """
+
+    quaternion: np.ndarray
+
+    def __init__(self, sample_period: float = 1 / 256, max_dt: float = 0.1):
+        self.sample_period: float = sample_period
+        self.max_dt: float = max_dt
+        self.prev_time: float = time.time()
+        self.prev_timestamp: float | None = None
+        self.gaps: int = 0
+
+    @abc.abstractmethod
+    def update(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None = None, dt: float | None = None) -> None:
+        """ updates the orientation with one sample.
+        Args:
+        gyr (np.ndarray): gyroscope data in rad/s.
+        acc (np.ndarray): accelerometer data.
+        mag (np.ndarray, optional): magnetometer data.
+        dt (float, optional): time since the previous sample in seconds. Defaults to the time since the previous update."""
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        """ updates the orientation with a block of samples, same as update for every sample.
+        Args:
+        gyr (np.ndarray): (N, 3) gyroscope data in rad/s.
+        acc (np.ndarray): (N, 3) accelerometer data.
+        mag (np.ndarray | None): (N, 3) magnetometer data or None.
+        dt (np.ndarray): (N,) time since the previous sample for every sample in seconds, see timestamps_to_dt.
+        Returns:
+        np.ndarray: (N, 4) quaternion after every sample."""
+
+        result = np.empty((gyr.shape[0], 4))
+        for i in range(gyr.shape[0]):
+            self.update(gyr[i], acc[i], mag[i] if mag is not None else None, float(dt[i]))
+            result[i] = self.quaternion
+        return result
+
+    def check_dt(self, dt: float) -> float:
+        """ returns dt, or sample_period if dt is a gap: negative, NaN or longer than max_dt. """
+        if 0 <= dt <= self.max_dt:
+            return dt
+        self.gaps += 1
+        return self.sample_period
+
+    def timestamps_to_dt(self, t: np.ndarray) -> np.ndarray:
+        """ time since the previous sample for every sample, from the sensor timestamps.
+        The previous timestamp is kept between calls, so splitting the samples into blocks
+        differently gives the same dt. Gaps are handled by update and update_batch.
+        Args:
+        t (np.ndarray): (N,) sample timestamps in seconds, NaN if unknown.
+        Returns:
+        np.ndarray: (N,) dt in seconds, sample_period for the very first sample."""
+
+        dt, self.prev_timestamp = timestamps_to_dt(t, self.prev_timestamp, self.sample_period)
+        return dt
+
+    def state_dict(self) -> dict[str, Any]:
+        """ JSON-serializable snapshot of the filter state. The engines add their estimates
+        to "state" and their gains to "parameters", the gains are kept for reference only. """
+        return {"state": {"quaternion": np.asarray(self.quaternion, dtype=float).tolist(), "prev_time": self.prev_time,
+                          "prev_timestamp": self.prev_timestamp, "gaps": int(self.gaps)},
+                "parameters": {}}
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        """ restores the estimates of the state_dict snapshot, the gains stay as configured. """
+        values = state["state"]
+        self.quaternion = np.array(values["quaternion"], dtype=float)
+        self.prev_time = values["prev_time"]
+        self.prev_timestamp = values["prev_timestamp"]
+        self.gaps = values["gaps"]
+
+
+class AHRSBank:
+    """ K independent orientation filters with the MadgwickBank interface,
+    for the engines without a dedicated bank.
+
+    Args:
+    filters (list[AHRS]): one filter per sensor.
+
+    Attributes:
+    quaternion (np.ndarray): (K, 4) current quaternions.
+    gaps (np.ndarray): (K,) number of gaps of every filter.
+
+    Methods:
+    update_batch(gyr, acc, mag, dt): N time steps for all K sensors.
+    timestamps_to_dt(t): per-sample dt from the sensor timestamps.
+    state_dict(): JSON-serializable snapshot of the filters.
+    load_state(state): restores the snapshot. """
+
+    def __init__(self, filters: list[AHRS]):
+        self.filters = filters
+        self.n_filters = len(filters)
+        self.sample_period = filters[0].sample_period
+        self.prev_timestamp: float | None = None
+
+    @property
+    def quaternion(self) -> np.ndarray:
+        return np.array([f.quaternion for f in self.filters], dtype=float).reshape(self.n_filters, 4)
+
+    @property
+    def gaps(self) -> np.ndarray:
+        return np.array([f.gaps for f in self.filters])
+
+    def timestamps_to_dt(self, t: np.ndarray) -> np.ndarray:
+        dt, self.prev_timestamp = timestamps_to_dt(t, self.prev_timestamp, self.sample_period)
+        return dt
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"prev_timestamp": self.prev_timestamp, "filters": [f.state_dict() for f in self.filters]}
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        if len(state["filters"]) != self.n_filters:
+            raise ValueError(f"snapshot of {len(state['filters'])} filters, the bank has {self.n_filters}")
+        self.prev_timestamp = state["prev_timestamp"]
+        for f, filter_state in zip(self.filters, state["filters"]):
+            f.load_state(filter_state)
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        """ updates the quaternions of all sensors with a block of samples.
+        Args:
+        gyr (np.ndarray): (N, K, 3) gyroscope data in rad/s.
+        acc (np.ndarray): (N, K, 3) accelerometer data.
+        mag (np.ndarray | None): (N, K, 3) magnetometer data or None.
+        dt (np.ndarray): (N,) or (N, K) time since the previous sample in seconds, see timestamps_to_dt.
+        Returns:
+        np.ndarray: (N, K, 4) quaternions after every sample."""
+
+        dt = np.asarray(dt, dtype=float)
+        if dt.ndim == 1:
+            dt = dt[:, None]
+        dt = np.broadcast_to(dt, gyr.shape[:2])
+        result = np.empty((gyr.shape[0], self.n_filters, 4))
+        for k, f in enumerate(self.filters):
+            result[:, k] = f.update_batch(gyr[:, k], acc[:, k], mag[:, k] if mag is not None else None, dt[:, k])
+        return result
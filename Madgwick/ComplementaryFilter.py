@@ -0,0 +1,119 @@
+from math import sqrt, atan2, sin, cos
+import time
+from typing import Any
+import numpy as np
+from Madgwick.AHRS import AHRS, clamp_dt
+
+
+class ComplementaryAHRS(AHRS):
+    """ Plain complementary filter: the gyroscope-integrated orientation is blended with
+    the orientation measured by the accelerometer (roll, pitch) and the magnetometer (yaw).
+    The cheapest engine, no iterations and no feedback loop.
+
+    Args:
+    gain (float, optional): weight of the accelerometer/magnetometer orientation per sample, 0..1. Defaults to 0.02.
+    quaternion (np.ndarray, optional): initial quaternion. Defaults to identity.
+    sample_period (float, optional): sampling period in seconds. Defaults to 1/256.
+    max_dt (float, optional): longest valid time between samples in seconds. Defaults to 0.1.
+
+    Attributes:
+    quaternion (np.ndarray): current quaternion. """
+
+    def __init__(self, gain: float = 0.02, quaternion: np.ndarray | None = None, sample_period: float = 1 / 256, max_dt: float = 0.1):
+        super().__init__(sample_period=sample_period, max_dt=max_dt)
+        if quaternion is None:
+            quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        self.quaternion: np.ndarray = np.array(quaternion, dtype=float)
+        self.gain = gain
+
+    def state_dict(self) -> dict[str, Any]:
+        state = super().state_dict()
+        state["parameters"]["gain"] = self.gain
+        return state
+
+    def update(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None = None, dt: float | None = None) -> None:
+        curr_time = time.time()
+        dt = curr_time - self.prev_time if dt is None else self.check_dt(dt)
+        q = complementary_step(self.quaternion.tolist(), np.asarray(gyr, dtype=float).tolist(), np.asarray(acc, dtype=float).tolist(),
+                               np.asarray(mag, dtype=float).tolist() if mag is not None else None, self.gain, dt)
+        self.quaternion = np.array(q)
+        self.prev_time = curr_time
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        n = gyr.shape[0]
+        if n == 0:
+            return np.empty((0, 4))
+        dt, gaps = clamp_dt(np.broadcast_to(np.asarray(dt, dtype=float), (n,)), self.sample_period, self.max_dt)
+        self.gaps += int(gaps.sum())
+        gyr_l = np.asarray(gyr, dtype=float).tolist()
+        acc_l = np.asarray(acc, dtype=float).tolist()
+        mag_l = np.asarray(mag, dtype=float).tolist() if mag is not None else [None] * n
+        q = self.quaternion.tolist()
+        gain = self.gain
+        result = []
+        for g, a, m, d in zip(gyr_l, acc_l, mag_l, dt.tolist()):
+            q = complementary_step(q, g, a, m, gain, d)
+            result.append(q)
+        self.quaternion = np.array(q)
+        self.prev_time = time.time()
+        return np.array(result, dtype=float)
+
+
+def complementary_step(q: list[float], gyr: list[float], acc: list[float], mag: list[float] | None, gain: float, dt: float) -> list[float]:
+    """
+    One step of the complementary filter over plain floats
+    :param q: current quaternion
+    :param gyr: gyroscope data in rad/s
+    :param acc: accelerometer data
+    :param mag: magnetometer data or None, without it the yaw comes from the gyroscope only
+    :param gain: weight of the accelerometer/magnetometer orientation
+    :param dt: timestep
+    :return: next quaternion
+    """
+    qw, qx, qy, qz = q
+    gx, gy, gz = gyr
+
+    # gyroscope integration, q += q (x) (0, omega) / 2 * dt
+    h = dt / 2
+    gw = qw + (-qx * gx - qy * gy - qz * gz) * h
+    gx_ = qx + (qw * gx + qy * gz - qz * gy) * h
+    gy_ = qy + (qw * gy - qx * gz + qz * gx) * h
+    gz_ = qz + (qw * gz + qx * gy - qy * gx) * h
+    norm = sqrt(gw * gw + gx_ * gx_ + gy_ * gy_ + gz_ * gz_)
+    gw, gx_, gy_, gz_ = gw / norm, gx_ / norm, gy_ / norm, gz_ / norm
+
+    ax, ay, az = acc
+    if ax == 0 and ay == 0 and az == 0:
+        return [gw, gx_, gy_, gz_]
+
+    # roll and pitch from the gravity direction
+    roll = atan2(ay, az)
+    pitch = atan2(-ax, sqrt(ay * ay + az * az))
+    if mag is not None:
+        # yaw from the tilt compensated magnetic field
+        mx, my, mz = mag
+        sr, cr, sp, cp = sin(roll), cos(roll), sin(pitch), cos(pitch)
+        hx = mx * cp + (my * sr + mz * cr) * sp
+        hy = my * cr - mz * sr
+        yaw = -atan2(hy, hx)
+    else:
+        yaw = atan2(2 * (gw * gz_ + gx_ * gy_), 1 - 2 * (gy_ * gy_ + gz_ * gz_))
+
+    # ZYX euler angles to quaternion, see quaternions.from_euler
+    cr, sr = cos(roll / 2), sin(roll / 2)
+    cp, sp = cos(pitch / 2), sin(pitch / 2)
+    cy, sy = cos(yaw / 2), sin(yaw / 2)
+    mw = cr * cp * cy + sr * sp * sy
+    mx_ = sr * cp * cy - cr * sp * sy
+    my_ = cr * sp * cy + sr * cp * sy
+    mz_ = cr * cp * sy - sr * sp * cy
+    # q and -q are the same rotation, blend on the same hemisphere
+    if mw * gw + mx_ * gx_ + my_ * gy_ + mz_ * gz_ < 0:
+        mw, mx_, my_, mz_ = -mw, -mx_, -my_, -mz_
+
+    nw = gw + gain * (mw - gw)
+    nx = gx_ + gain * (mx_ - gx_)
+    ny = gy_ + gain * (my_ - gy_)
+    nz = gz_ + gain * (mz_ - gz_)
+    norm = sqrt(nw * nw + nx * nx + ny * ny + nz * nz)
+    return [nw / norm, nx / norm, ny / norm, nz / norm]
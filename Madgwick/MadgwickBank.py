@@ -0,0 +1,303 @@
+import time
+from typing import Any
+import numpy as np
+from Madgwick.AHRS import clamp_dt, timestamps_to_dt
+from Madgwick.StationaryDetector import StationaryDetector, REST_STEP, HOLD
+
+W, X, Y, Z = range(4)
+
+
+def __bilinear__(terms: list[tuple[float, int, int, int]], n_left: int, n_right: int, n_out: int) -> np.ndarray:
+    """
+    Matrix of the bilinear form out[o] = sum of c * left[l] * right[r] over the terms (c, l, r, o),
+    it multiplies the (n_left * n_right, K) outer products of K sensors into (n_out, K)
+    """
+    m = np.zeros((n_out, n_left, n_right))
+    for c, left, right, out in terms:
+        m[out, left, right] += c
+    return m.reshape(n_out, n_left * n_right)
+
+
+# q x q -> quadratic terms of the objective functions of MadgwickAHRS.update_IMU:
+# f1..f3 without the constant of f3, h1..h3 without the constants, their bx terms and their bz terms
+OBJECTIVE = __bilinear__([(2, X, Z, 0), (-2, W, Y, 0), (2, W, X, 1), (2, Y, Z, 1), (-2, X, X, 2), (-2, Y, Y, 2),
+                          (-2, Y, Y, 3), (-2, Z, Z, 3), (2, X, Y, 4), (-2, W, Z, 4), (2, W, Y, 5), (2, X, Z, 5),
+                          (2, X, Z, 6), (-2, W, Y, 6), (2, W, X, 7), (2, Y, Z, 7), (-2, X, X, 8), (-2, Y, Y, 8)], 4, 4, 9)
+# q x [gyr / 2, f, bx * h, bz * h] -> [rate of change of the quaternion from the gyroscope, J_g^T F_g + J_b^T F_b]
+U1, U2, U3, V1, V2, V3 = range(6, 12)
+DERIVATIVE = __bilinear__([(-1, X, 0, 0), (-1, Y, 1, 0), (-1, Z, 2, 0), (1, W, 0, 1), (1, Z, 1, 1), (-1, Y, 2, 1),
+                           (-1, Z, 0, 2), (1, W, 1, 2), (1, X, 2, 2), (1, Y, 0, 3), (-1, X, 1, 3), (1, W, 2, 3),
+                           (-2, Y, 3, 4), (2, X, 4, 4), (2, Z, 3, 5), (2, W, 4, 5), (-4, X, 5, 5),
+                           (-2, W, 3, 6), (2, Z, 4, 6), (-4, Y, 5, 6), (2, X, 3, 7), (2, Y, 4, 7),
+                           (-2, Y, V1, 4), (2, X, U2, 4), (-2, Z, U2, 4), (2, Y, U3, 4),
+                           (2, Z, V1, 5), (2, Y, U2, 5), (2, W, V2, 5), (2, Z, U3, 5), (-4, X, V3, 5),
+                           (-4, Y, U1, 6), (-2, W, V1, 6), (2, X, U2, 6), (2, Z, V2, 6), (2, W, U3, 6), (-4, Y, V3, 6),
+                           (-4, Z, U1, 7), (2, X, V1, 7), (-2, W, U2, 7), (2, Y, V2, 7), (2, X, U3, 7)], 4, 12, 8)
+# the same without the magnetometer
+DERIVATIVE_IMU = DERIVATIVE.reshape(8, 4, 12)[:, :, :6].reshape(8, 24)
+# p x q -> quaternion product p * q
+PRODUCT = __bilinear__([(1, W, W, 0), (-1, X, X, 0), (-1, Y, Y, 0), (-1, Z, Z, 0),
+                        (1, W, X, 1), (1, X, W, 1), (1, Y, Z, 1), (-1, Z, Y, 1),
+                        (1, W, Y, 2), (1, Y, W, 2), (1, Z, X, 2), (-1, X, Z, 2),
+                        (1, W, Z, 3), (1, Z, W, 3), (1, X, Y, 3), (-1, Y, X, 3)], 4, 4, 4)
+
+
+def integrate_bank(quaternion: np.ndarray, skipped_dt: np.ndarray, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None,
+                   dt: np.ndarray, gain: np.ndarray, b: np.ndarray, update: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Runs the Madgwick step of K sensors over a block of samples. The sensors are the last axis of every array
+    of the loop, so each time step is the same few array operations for any K: the objective functions,
+    the gradient and the gyroscope rate of change are products of the outer products of the quaternions
+    with the constant matrices above, the math is the one of MadgwickAHRS.update_IMU.
+    :param quaternion: (K, 4) current quaternions
+    :param skipped_dt: (K,) time of the previously skipped samples
+    :param gyr, acc, mag: (N, K, 3) sensor data, mag can be None
+    :param dt: (N, K) timesteps, gaps already clamped
+    :param gain: algorithm gain, beta * 0.1, (K, 4) or (N, K, 4) for every sample
+    :param b: (K, 3) earth magnetic field
+    :param update: (N, K) bool, False for the samples which are held, their time goes to the next update
+    :return: (N, K, 4) quaternions after every sample and the time of the skipped samples at the end
+    """
+    n, k = gyr.shape[:2]
+    # one (rows, K) array per sample, inputs of the loop: [gyr / 2, acc / |acc| - e_z, magnetometer terms]
+    n_inputs = 6 if mag is None else 12
+    inputs = np.empty((n, n_inputs, k))
+    inputs[:, :3] = gyr.transpose(0, 2, 1) / 2
+    inputs[:, 3:6] = (acc / np.linalg.norm(acc, axis=2, keepdims=True) - [0.0, 0.0, 1.0]).transpose(0, 2, 1)
+    objective = OBJECTIVE[:3] if mag is None else OBJECTIVE
+    derivative = DERIVATIVE_IMU if mag is None else DERIVATIVE
+    if mag is not None:
+        # h = bx * (quadratic bx terms + e_x) + bz * (quadratic bz terms + e_z) - mag
+        mag_offset = (mag - b * [1.0, 0.0, 1.0]).transpose(0, 2, 1).copy()
+        b_terms = np.repeat(b[:, [0, 2]].T, 3, axis=0)
+        b_pair = b[:, [0, 2]].T[:, None, :].copy()
+    half_dt = dt / 2
+    gains = np.asarray(gain, dtype=float)
+    gains = gains.T.copy() if gains.ndim == 2 else gains.transpose(0, 2, 1).copy()
+    step_gain = gains
+    q = np.asarray(quaternion, dtype=float).T.copy()
+    skipped = np.asarray(skipped_dt, dtype=float) / 2
+    result = np.empty((n, 4, k))
+    for i in range(n):
+        v = inputs[i]
+        p = objective @ (q[:, None] * q[None]).reshape(16, k)
+        np.subtract(p[:3], v[3:6], out=v[3:6])
+        if mag is not None:
+            t = p[3:9] * b_terms
+            h = t[:3] + t[3:] - mag_offset[i]
+            np.multiply(h, b_pair, out=v[6:12].reshape(2, 3, k))
+        d = derivative @ (q[:, None] * v[None]).reshape(4 * n_inputs, k)
+        g = d[4:]
+        g_norm = np.sqrt(np.add.reduce(g * g))
+        # sensors with a too small correction step skip the sample, its time goes to their next update
+        active = g_norm >= 0.001
+        if update is not None:
+            active &= update[i]
+            step_gain = gains[i]
+        step_dt = half_dt[i] + skipped
+
+        # quaternion exponential integration, x = q_dot * dt / 2
+        x = (d[:4] + g * (step_gain / np.maximum(g_norm, 1e-300))) * step_dt
+        e = np.exp(x[0])
+        v_norm = np.sqrt(np.add.reduce(x[1:] * x[1:]))
+        x[0] = e * np.cos(v_norm)
+        x[1:] = np.sign(x[1:]) * (e * np.sin(v_norm))
+        r = PRODUCT @ (x[:, None] * q[None]).reshape(16, k)
+        norm = np.sqrt(np.add.reduce(r * r))
+        r /= norm
+        np.copyto(q, r, where=active & (np.abs(norm - 1) < 0.2))
+        skipped = np.where(active, 0.0, step_dt)
+        result[i] = q
+    return result.transpose(0, 2, 1), skipped * 2
+
+
+class MadgwickBank:
+    """ K Madgwick filters updated together, one set of array operations per time step
+    for all sensors, so the cost per time step hardly depends on K.
+    Every filter follows the same math as MadgwickAHRS.update_IMU with explicit dt.
+
+    Args:
+    n_filters (int): number of sensors K.
+    quaternion (np.ndarray, optional): (K, 4) initial quaternions. Defaults to the identity for all sensors.
+    beta (np.ndarray, optional): algorithm gain, (4,) shared or (K, 4) per sensor. Defaults to np.ones(4).
+    b (np.ndarray, optional): earth magnetic field, (3,) shared or (K, 3) per sensor. Defaults to MadgwickAHRS default.
+    sample_period (float, optional): sampling period in seconds, used for the gaps. Defaults to 1/256.
+    max_dt (float, optional): longest valid time between samples in seconds. Defaults to 0.1.
+    stationary (dict, optional): StationaryDetector parameters, one detector per sensor, see MadgwickAHRS. Defaults to None.
+
+    Attributes:
+    quaternion (np.ndarray): (K, 4) current quaternions.
+    skipped_dt (np.ndarray): (K,) time of the samples skipped because of the small correction step.
+    prev_time (float): time of the last update.
+    prev_timestamp (float | None): sensor timestamp of the previous sample, used by timestamps_to_dt.
+    gaps (np.ndarray): (K,) number of samples whose dt was a gap and was replaced by sample_period.
+    detectors (list[StationaryDetector]): rest detectors of the sensors, empty without stationary.
+
+    Methods:
+    update(gyr, acc, mag, dt): one time step for all K sensors.
+    update_batch(gyr, acc, mag, dt): N time steps for all K sensors.
+    timestamps_to_dt(t): per-sample dt from the sensor timestamps.
+    stationary_stats(): rest scheduling counters of the sensors.
+    state_dict(): JSON-serializable snapshot of the filters, see AHRS.state_dict.
+    load_state(state): restores the snapshot. """
+
+    def __init__(self, n_filters: int, quaternion: np.ndarray | None = None, beta: np.ndarray = np.ones(4), b: np.ndarray | None = None,
+                 sample_period: float = 1 / 256, max_dt: float = 0.1, stationary: dict[str, Any] | None = None):
+        if quaternion is None:
+            quaternion = np.tile(np.array([1.0, 0.0, 0.0, 0.0]), (n_filters, 1))
+        if b is None:
+            b = np.array([131, 94, 157])
+        self.n_filters = n_filters
+        self.quaternion: np.ndarray = np.array(quaternion, dtype=float).reshape(n_filters, 4)
+        self.beta: np.ndarray = np.broadcast_to(np.asarray(beta, dtype=float), (n_filters, 4)).copy()
+        self.b: np.ndarray = np.broadcast_to(np.asarray(b, dtype=float), (n_filters, 3)).copy()
+        self.skipped_dt: np.ndarray = np.zeros(n_filters)
+        self.prev_time: float = time.time()
+        self.sample_period = sample_period
+        self.max_dt = max_dt
+        self.prev_timestamp: float | None = None
+        self.gaps: np.ndarray = np.zeros(n_filters, dtype=int)
+        self.detectors: list[StationaryDetector] = []
+        if stationary is not None:
+            self.detectors = [StationaryDetector(sample_period=sample_period, **stationary) for _ in range(n_filters)]
+
+    def stationary_stats(self) -> list[dict[str, float]]:
+        """ StationaryDetector.stats of every sensor, empty without the rest scheduling. """
+        return [detector.stats() for detector in self.detectors]
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"state": {"quaternion": self.quaternion.tolist(), "skipped_dt": self.skipped_dt.tolist(), "gaps": self.gaps.tolist(),
+                          "prev_time": self.prev_time, "prev_timestamp": self.prev_timestamp,
+                          "detectors": [detector.state_dict() for detector in self.detectors]},
+                "parameters": {"beta": self.beta.tolist(), "b": self.b.tolist()}}
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        values = state["state"]
+        quaternion = np.array(values["quaternion"], dtype=float)
+        if quaternion.shape != (self.n_filters, 4):
+            raise ValueError(f"snapshot of {quaternion.shape[0]} filters, the bank has {self.n_filters}")
+        self.quaternion = quaternion
+        self.skipped_dt = np.array(values["skipped_dt"], dtype=float)
+        self.gaps = np.array(values["gaps"], dtype=int)
+        self.prev_time = values["prev_time"]
+        self.prev_timestamp = values["prev_timestamp"]
+        for detector, detector_state in zip(self.detectors, values["detectors"]):
+            detector.load_state(detector_state)
+
+    def timestamps_to_dt(self, t: np.ndarray) -> np.ndarray:
+        """ time since the previous sample for every sample, from the sensor timestamps,
+        same as MadgwickAHRS.timestamps_to_dt.
+        Args:
+        t (np.ndarray): (N,) sample timestamps in seconds, NaN if unknown.
+        Returns:
+        np.ndarray: (N,) dt in seconds, sample_period for the very first sample."""
+
+        dt, self.prev_timestamp = timestamps_to_dt(t, self.prev_timestamp, self.sample_period)
+        return dt
+
+    def update(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: float | np.ndarray) -> np.ndarray:
+        """ updates the quaternions of all sensors with one sample each.
+        Args:
+        gyr (np.ndarray): (K, 3) gyroscope data in rad/s.
+        acc (np.ndarray): (K, 3) accelerometer data.
+        mag (np.ndarray | None): (K, 3) magnetometer data or None.
+        dt (float | np.ndarray): time since the previous sample in seconds, shared or (K,).
+        Returns:
+        np.ndarray: (K, 4) quaternions after the update."""
+
+        if self.detectors:
+            # the rest scheduling is sequential per sensor, run it as a block of one sample
+            dt = np.broadcast_to(np.asarray(dt, dtype=float), (self.n_filters,))
+            return self.update_batch(gyr[None], acc[None], mag[None] if mag is not None else None, dt[None])[0]
+
+        qw, qx, qy, qz = self.quaternion.T
+        a = acc / np.linalg.norm(acc, axis=1, keepdims=True)
+        ax, ay, az = a.T
+
+        # gradient of the objective function, J_g^T F_g
+        f1 = 2 * (qx * qz - qw * qy) - ax
+        f2 = 2 * (qw * qx + qy * qz) - ay
+        f3 = 2 * (0.5 - qx ** 2 - qy ** 2) - az
+        g = np.stack([-2 * qy * f1 + 2 * qx * f2,
+                      2 * qz * f1 + 2 * qw * f2 - 4 * qx * f3,
+                      -2 * qw * f1 + 2 * qz * f2 - 4 * qy * f3,
+                      2 * qx * f1 + 2 * qy * f2], axis=1)
+
+        if mag is not None:
+            # J_b^T F_b
+            bx = self.b[:, 0]
+            bz = self.b[:, 2]
+            mx, my, mz = mag.T
+            h1 = 2 * bx * (0.5 - qy ** 2 - qz ** 2) + 2 * bz * (qx * qz - qw * qy) - mx
+            h2 = 2 * bx * (qy * qx - qw * qz) + 2 * bz * (qw * qx + qy * qz) - my
+            h3 = 2 * bx * (qw * qy + qx * qz) + 2 * bz * (0.5 - qx ** 2 - qy ** 2) - mz
+            g += np.stack([-2 * bz * qy * h1 + 2 * bx * (qx - qz) * h2 + 2 * bx * qy * h3,
+                           2 * bz * qz * h1 + (2 * bx * qy + 2 * bz * qw) * h2 + (2 * bx * qz - 4 * bz * qx) * h3,
+                           (-4 * bx * qy - 2 * bz * qw) * h1 + (2 * bx * qx + 2 * bz * qz) * h2 + (2 * bx * qw - 4 * bz * qy) * h3,
+                           (-4 * bx * qz + 2 * bz * qx) * h1 + (-2 * bx * qw + 2 * bz * qy) * h2 + 2 * bx * qx * h3], axis=1)
+
+        g_norm = np.linalg.norm(g, axis=1)
+        # sensors with a too small correction step skip the sample, its time goes to their next update
+        active = g_norm >= 0.001
+        dt, gaps = clamp_dt(np.broadcast_to(np.asarray(dt, dtype=float), (self.n_filters,)), self.sample_period, self.max_dt)
+        self.gaps += gaps
+        step_dt = dt + self.skipped_dt
+        self.skipped_dt = np.where(active, 0.0, step_dt)
+
+        # rate of change of quaternion
+        wx, wy, wz = gyr.T
+        q_dot = np.stack([-qx * wx - qy * wy - qz * wz,
+                          qw * wx + qz * wy - qy * wz,
+                          -qz * wx + qw * wy + qx * wz,
+                          qy * wx - qx * wy + qw * wz], axis=1) / 2
+        q_dot += 0.1 * self.beta * g / np.where(active, g_norm, 1.0)[:, None]
+
+        # quaternion exponential integration
+        x = q_dot * (step_dt / 2)[:, None]
+        e = np.exp(x[:, 0])
+        v_norm = np.linalg.norm(x[:, 1:], axis=1)
+        pw = e * np.cos(v_norm)
+        px, py, pz = (np.sign(x[:, 1:]) * (e * np.sin(v_norm))[:, None]).T
+
+        q = np.stack([pw * qw - (px * qx + py * qy + pz * qz),
+                      pw * qx + qw * px + (py * qz - pz * qy),
+                      pw * qy + qw * py + (pz * qx - px * qz),
+                      pw * qz + qw * pz + (px * qy - py * qx)], axis=1)
+        norm = np.linalg.norm(q, axis=1)
+        accepted = active & (norm > 0.8) & (norm < 1.2)
+        self.quaternion = np.where(accepted[:, None], q / norm[:, None], self.quaternion)
+        self.prev_time = time.time()
+        return self.quaternion
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        """ updates the quaternions of all sensors with a block of samples, see integrate_bank.
+        Args:
+        gyr (np.ndarray): (N, K, 3) gyroscope data in rad/s.
+        acc (np.ndarray): (N, K, 3) accelerometer data.
+        mag (np.ndarray | None): (N, K, 3) magnetometer data or None.
+        dt (np.ndarray): (N,) or (N, K) time since the previous sample in seconds, see timestamps_to_dt.
+        Returns:
+        np.ndarray: (N, K, 4) quaternions after every sample."""
+
+        n = gyr.shape[0]
+        if n == 0:
+            return np.empty((0, self.n_filters, 4))
+        dt = np.asarray(dt, dtype=float)
+        if dt.ndim == 1:
+            dt = dt[:, None]
+        dt, gaps = clamp_dt(np.broadcast_to(dt, (n, self.n_filters)), self.sample_period, self.max_dt)
+        self.gaps += gaps.sum(axis=0)
+        gain = self.beta * 0.1
+        update = None
+        if self.detectors:
+            # the rest scheduling is sequential in time, every detector schedules the whole block of its sensor
+            scheduled = [detector.schedule(gyr[:, k], acc[:, k]) for k, detector in enumerate(self.detectors)]
+            gyr = np.stack([compensated for compensated, _ in scheduled], axis=1)
+            schedule = np.stack([sensor_schedule for _, sensor_schedule in scheduled], axis=1)
+            update = schedule != HOLD
+            rest_scale = np.array([detector.rest_beta_scale for detector in self.detectors])
+            gain = gain * np.where(schedule == REST_STEP, rest_scale, 1.0)[:, :, None]
+        result, self.skipped_dt = integrate_bank(self.quaternion, self.skipped_dt, gyr, acc, mag, dt, gain, self.b, update)
+        self.quaternion = result[-1].copy()
+        self.prev_time = time.time()
+        return result
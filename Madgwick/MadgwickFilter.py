@@ -1,23 +1,34 @@
+from math import sqrt, exp, cos, sin
 from typing import Any
 import numpy as np
 
 from Madgwick.quaternion_calculation import *
+from Madgwick import quaternions
+from Madgwick.AHRS import AHRS, clamp_dt
+from Madgwick.StationaryDetector import StationaryDetector, REST_STEP, HOLD
 import time
 
 
-class MadgwickAHRS:
+class MadgwickAHRS(AHRS):
     """ MadgwickAHRS class for orientation estimation using the Madgwick algorithm.
 
     Args: 
-    omega_e (float): gyroscope noise in rad/s. 
+    omega_e (float, optional): gyroscope noise in rad/s. 
     sample_period (float, optional): sampling period in seconds. Defaults to 1/256. 
     quaternion (np.ndarray, optional): initial quaternion. Defaults to np.array([1.0, 0.0, 0.0, 0.0], dtype=float). 
     beta (np.ndarray, optional): gyroscope measurement error. Defaults to np.ones(4). 
     hpf (float, optional): high-pass filter cutoff frequency. Defaults to 0.
+    max_dt (float, optional): longest valid time between samples in seconds, longer or negative dt is a gap. Defaults to 0.1.
+    stationary (dict, optional): StationaryDetector parameters, enables the rest scheduling of update, update_IMU_fast
+        and update_batch: at rest most samples are held and their time goes to the next update, the updates use
+        a larger gain and the gyroscope bias is refined. update_IMU always runs the full step. Defaults to None, no scheduling.
 
     Attributes: 
     prev_time (float): previous time stamp. 
+    prev_timestamp (float | None): sensor timestamp of the previous sample, used by timestamps_to_dt.
+    gaps (int): number of samples whose dt was a gap and was replaced by sample_period.
     quaternion (np.ndarray): current quaternion. 
+    detector (StationaryDetector | None): rest detector, see stationary.
     prev_quaternion (np.ndarray): previous quaternion. 
     beta (np.ndarray): algorithm gain. 
     hpf (float): high-pass filter cutoff frequency. 
@@ -28,12 +39,17 @@ class MadgwickAHRS:
 
     Methods: 
     update_IMU(gyros_data: np.ndarray, accel_data: np.ndarray): updates the quaternion using gyroscope and accelerometer data. 
-    async_update_IMU(gyros_data: np.ndarray, accel_data: np.ndarray): asynchronous version of update_IMU method. """
+    async_update_IMU(gyros_data: np.ndarray, accel_data: np.ndarray): asynchronous version of update_IMU method.
+    update_IMU_fast(gyros_data: np.ndarray, accel_data: np.ndarray): low latency version of update_IMU.
+    update_batch(gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray, dt: np.ndarray): update_IMU over a block of samples.
+    update(gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray, dt: float): AHRS interface, same as update_IMU_fast.
+    timestamps_to_dt(t: np.ndarray): per-sample dt from the sensor timestamps, see AHRS. """
 
-    def __init__(self, omega_e, sample_period=1 / 256, quaternion=None, beta: np.ndarray = np.ones(4), hpf=0, b: np.ndarray | None = None):
+    def __init__(self, omega_e=None, sample_period=1 / 256, quaternion=None, beta: np.ndarray = np.ones(4), hpf=0, b: np.ndarray | None = None, max_dt: float = 0.1,
+                 stationary: dict[str, Any] | None = None):
+        super().__init__(sample_period=sample_period, max_dt=max_dt)
         if quaternion is None:
             quaternion = np.array([1.0, 0.0, 0.0, 0.0], dtype=float)
-        self.prev_time: float = time.time()
         self.quaternion: np.ndarray = quaternion
         self.prev_quaternion: np.ndarray = quaternion
         if b is None:
@@ -48,6 +64,29 @@ class MadgwickAHRS:
 
         self.acc = np.zeros(3)
         self.gyr = np.zeros(3)
+        # time of the samples skipped because of the small correction step
+        self.skipped_dt: float = 0.0
+        # update_IMU_fast keeps the quaternion in this array and updates it in place
+        self.__quaternion_workspace__: np.ndarray | None = None
+        self.__gain__: list[float] = []
+        self.__gain_beta__: np.ndarray | None = None
+        self.detector: StationaryDetector | None = None
+        if stationary is not None:
+            self.detector = StationaryDetector(sample_period=sample_period, **stationary)
+
+    def state_dict(self) -> dict[str, Any]:
+        state = super().state_dict()
+        state["state"]["skipped_dt"] = self.skipped_dt
+        if self.detector is not None:
+            state["state"]["detector"] = self.detector.state_dict()
+        state["parameters"].update(beta=np.asarray(self.beta, dtype=float).tolist(), b=np.asarray(self.b, dtype=float).tolist())
+        return state
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        super().load_state(state)
+        self.skipped_dt = state["state"]["skipped_dt"]
+        if self.detector is not None and "detector" in state["state"]:
+            self.detector.load_state(state["state"]["detector"])
 
     def calc_objective_function_g(self, a: np.ndarray) -> np.ndarray:
         q_w: float
@@ -115,13 +154,17 @@ class MadgwickAHRS:
             # result = -1*(J_g_b.T @ F_g_b)
             return result
 
-    def update_IMU(self, gyros_data: np.ndarray, accel_data: np.ndarray, magn_data: np.ndarray | None = None):
+    def update_IMU(self, gyros_data: np.ndarray, accel_data: np.ndarray, magn_data: np.ndarray | None = None, dt: float | None = None):
         """ updates the quaternion using gyroscope and accelerometer data. 
         Args:
         gyros_data (np.ndarray): gyroscope data in rad/s.
-        accel_data (np.ndarray): accelerometer data in m/s^2"""
+        accel_data (np.ndarray): accelerometer data in m/s^2
+        magn_data (np.ndarray, optional): magnetometer data.
+        dt (float, optional): time since the previous sample in seconds. Defaults to the time since the previous update."""
 
         curr_time = time.time()
+        if dt is not None:
+            dt = self.check_dt(dt)
         self.acc = accel_data
         self.gyr = gyros_data
         q: np.ndarray = self.quaternion
@@ -151,6 +194,9 @@ class MadgwickAHRS:
         # normalize step magnitude
         # step = - normalize(step, tolerance=tolerance)
         if np.linalg.norm(step) < 0.001:
+            # the sample is skipped, its time goes to the next update
+            if dt is not None:
+                self.skipped_dt += dt
             return
         step = - step/np.linalg.norm(step)
 
@@ -161,11 +207,250 @@ class MadgwickAHRS:
 
         self.qDot = qDot
 
-        dt = curr_time - self.prev_time
+        if dt is None:
+            dt = curr_time - self.prev_time
+        else:
+            dt += self.skipped_dt
+        self.skipped_dt = 0.0
         # Integrate to yield quaternion
         q = quaternion_exponential_integration(
             q=q, omega_=qDot, dt=dt)
-        norm = np.linalg.norm(q)
+        norm = quaternions.norm(q)
         if norm > 0.8 and norm < 1.2:
             self.quaternion = q/norm
-        self.prev_time = curr_time
\ No newline at end of file
+        self.prev_time = curr_time
+
+    def update(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None = None, dt: float | None = None) -> None:
+        self.update_IMU_fast(gyros_data=gyr, accel_data=acc, magn_data=mag, dt=dt)
+
+    def update_IMU_fast(self, gyros_data: np.ndarray, accel_data: np.ndarray, magn_data: np.ndarray | None = None, dt: float | None = None):
+        """ low latency version of update_IMU with the same result. The correction step is
+        calculated in closed form over plain floats, no Jacobian matrices or temporary arrays
+        are built, and the quaternion is written in place into the preallocated self.quaternion.
+        Args:
+        gyros_data (np.ndarray): gyroscope data in rad/s.
+        accel_data (np.ndarray): accelerometer data in m/s^2
+        magn_data (np.ndarray, optional): magnetometer data.
+        dt (float, optional): time since the previous sample in seconds. Defaults to the time since the previous update."""
+
+        curr_time = time.time()
+        self.acc = accel_data
+        self.gyr = gyros_data
+        if dt is not None:
+            dt = self.check_dt(dt)
+        if dt is None:
+            step_dt = curr_time - self.prev_time
+        else:
+            step_dt = dt + self.skipped_dt
+        q = self.__quaternion_workspace__
+        if q is not self.quaternion:
+            # the quaternion was replaced from outside, take it over as the workspace
+            q = self.__quaternion_workspace__ = np.array(self.quaternion, dtype=float)
+            self.quaternion = q
+        if self.__gain_beta__ is not self.beta:
+            self.__gain__ = (np.broadcast_to(np.asarray(self.beta, dtype=float), (4,)) * 0.1).tolist()
+            self.__gain_beta__ = self.beta
+        gain = self.__gain__
+        b = self.b
+        gyr = gyros_data.tolist()
+        if self.detector is not None:
+            gyr, schedule = self.detector.push(gyr, accel_data.tolist())
+            if schedule == HOLD:
+                if dt is not None:
+                    self.skipped_dt += dt
+                return
+            if schedule == REST_STEP:
+                scale = self.detector.rest_beta_scale
+                gain = [k * scale for k in gain]
+        new_q = step_quaternion(q.item(0), q.item(1), q.item(2), q.item(3), gyr, accel_data.tolist(),
+                                magn_data.tolist() if magn_data is not None else None,
+                                gain[0], gain[1], gain[2], gain[3], float(b[0]), float(b[2]), step_dt)
+        if new_q is None:
+            # the sample is skipped, its time goes to the next update
+            if dt is not None:
+                self.skipped_dt += dt
+            return
+        self.skipped_dt = 0.0
+        q[0], q[1], q[2], q[3] = new_q
+        self.prev_time = curr_time
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        """ updates the quaternion with a block of samples, gives the same result as
+        calling update_IMU with explicit dt for every sample, but runs the whole block
+        in one loop over plain floats instead of allocating small arrays per sample.
+        Args:
+        gyr (np.ndarray): (N, 3) gyroscope data in rad/s.
+        acc (np.ndarray): (N, 3) accelerometer data.
+        mag (np.ndarray | None): (N, 3) magnetometer data or None.
+        dt (np.ndarray): (N,) time since the previous sample for every sample in seconds, see timestamps_to_dt.
+        Returns:
+        np.ndarray: (N, 4) quaternion after every sample."""
+
+        n = gyr.shape[0]
+        if n == 0:
+            return np.empty((0, 4))
+        dt, gaps = clamp_dt(np.broadcast_to(np.asarray(dt, dtype=float), (n,)), self.sample_period, self.max_dt)
+        self.gaps += int(gaps.sum())
+        gain = (np.broadcast_to(np.asarray(self.beta, dtype=float), (4,)) * 0.1).tolist()
+        result, skipped_dt = integrate_block(np.asarray(self.quaternion, dtype=float).tolist(), self.skipped_dt,
+                                             gyr, acc, mag, dt, gain, float(self.b[0]), float(self.b[2]), self.detector)
+
+        self.quaternion = result[-1].copy()
+        self.skipped_dt = skipped_dt
+        self.acc = acc[-1]
+        self.gyr = gyr[-1]
+        self.prev_time = time.time()
+        return result
+
+
+def integrate_block(q: list[float], skipped_dt: float, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None,
+                    dt: np.ndarray, gain: list[float], bx: float, bz: float, detector: StationaryDetector | None = None) -> tuple[np.ndarray, float]:
+    """
+    Runs step_quaternion over a block of samples of one sensor
+    :param q: current quaternion
+    :param skipped_dt: time of the previously skipped samples
+    :param gyr, acc, mag: (N, 3) sensor data, mag can be None
+    :param dt: (N,) timesteps, gaps already clamped
+    :param gain: algorithm gain, beta * 0.1
+    :param bx, bz: earth magnetic field
+    :param detector: rest detector of the sensor, schedules the samples, see StationaryDetector
+    :return: (N, 4) quaternion after every sample and the time of the skipped samples at the end
+    """
+    if detector is not None:
+        gyr, schedule = detector.schedule(gyr, acc)
+        return integrate_scheduled_block(q, skipped_dt, gyr, acc, mag, dt, gain, bx, bz, schedule, detector.rest_beta_scale)
+    gyr_l = np.asarray(gyr, dtype=float).tolist()
+    acc_l = np.asarray(acc, dtype=float).tolist()
+    mag_l = np.asarray(mag, dtype=float).tolist() if mag is not None else [None] * len(gyr_l)
+    k0, k1, k2, k3 = gain
+    qw, qx, qy, qz = q
+    result = []
+    for g, a, m, d in zip(gyr_l, acc_l, mag_l, np.asarray(dt, dtype=float).tolist()):
+        new_q = step_quaternion(qw, qx, qy, qz, g, a, m, k0, k1, k2, k3, bx, bz, d + skipped_dt)
+        if new_q is None:
+            # the sample is skipped, its time goes to the next update
+            skipped_dt += d
+        else:
+            skipped_dt = 0.0
+            qw, qx, qy, qz = new_q
+        result.append((qw, qx, qy, qz))
+    return np.array(result, dtype=float).reshape(len(result), 4), skipped_dt
+
+
+def integrate_scheduled_block(q: list[float], skipped_dt: float, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None,
+                              dt: np.ndarray, gain: list[float], bx: float, bz: float, schedule: np.ndarray, rest_scale: float) -> tuple[np.ndarray, float]:
+    """
+    integrate_block with the schedule of StationaryDetector: HOLD samples keep the quaternion
+    and pass their time to the next update, REST_STEP samples run with the gain scaled by rest_scale.
+    Only the updated samples go through the loop, the held ones are filled in afterwards.
+    :param gyr: (N, 3) bias-compensated gyroscope data
+    :param schedule: (N,) FULL_STEP, REST_STEP or HOLD
+    :param rest_scale: gain factor of the REST_STEP samples
+    Other parameters and the result as integrate_block
+    """
+    n = len(schedule)
+    dt = np.asarray(dt, dtype=float)
+    updated = np.flatnonzero(schedule != HOLD)
+    # time of the held samples before every updated sample, and after the last one
+    elapsed = np.concatenate([[0.0], np.cumsum(dt)])
+    start = np.concatenate([[0], updated[:-1] + 1])
+    held_dt = elapsed[updated] - elapsed[start]
+    tail_dt = float(elapsed[n] - elapsed[updated[-1] + 1]) if updated.size else float(elapsed[n])
+
+    gyr_l = np.asarray(gyr, dtype=float)[updated].tolist()
+    acc_l = np.asarray(acc, dtype=float)[updated].tolist()
+    mag_l = np.asarray(mag, dtype=float)[updated].tolist() if mag is not None else [None] * updated.size
+    k0, k1, k2, k3 = gain
+    r0, r1, r2, r3 = (k * rest_scale for k in gain)
+    qw, qx, qy, qz = q
+    steps = [(qw, qx, qy, qz)]
+    for g, a, m, d, h, s in zip(gyr_l, acc_l, mag_l, dt[updated].tolist(), held_dt.tolist(), schedule[updated].tolist()):
+        skipped_dt += h
+        if s == REST_STEP:
+            new_q = step_quaternion(qw, qx, qy, qz, g, a, m, r0, r1, r2, r3, bx, bz, d + skipped_dt)
+        else:
+            new_q = step_quaternion(qw, qx, qy, qz, g, a, m, k0, k1, k2, k3, bx, bz, d + skipped_dt)
+        if new_q is None:
+            skipped_dt += d
+        else:
+            skipped_dt = 0.0
+            qw, qx, qy, qz = new_q
+        steps.append((qw, qx, qy, qz))
+    # every sample takes the quaternion of the last update up to it
+    last_update = np.searchsorted(updated, np.arange(n), side="right")
+    return np.array(steps, dtype=float)[last_update], skipped_dt + tail_dt
+
+
+def step_quaternion(qw: float, qx: float, qy: float, qz: float, gyr: list[float], acc: list[float], mag: list[float] | None,
+                    k0: float, k1: float, k2: float, k3: float, bx: float, bz: float, dt: float) -> tuple[float, float, float, float] | None:
+    """
+    One step of the Madgwick filter over plain floats, the same math as MadgwickAHRS.update_IMU
+    :param qw, qx, qy, qz: current quaternion
+    :param gyr: gyroscope data in rad/s
+    :param acc: accelerometer data
+    :param mag: magnetometer data or None
+    :param k0, k1, k2, k3: algorithm gain, beta * 0.1
+    :param bx, bz: earth magnetic field
+    :param dt: timestep
+    :return: next quaternion, None if the correction step is too small and the sample is skipped
+    """
+    ax, ay, az = acc
+    a_norm = sqrt(ax * ax + ay * ay + az * az)
+    ax /= a_norm
+    ay /= a_norm
+    az /= a_norm
+
+    # gradient of the objective function, J_g^T F_g
+    f1 = 2 * (qx * qz - qw * qy) - ax
+    f2 = 2 * (qw * qx + qy * qz) - ay
+    f3 = 2 * (0.5 - qx ** 2 - qy ** 2) - az
+    g0 = -2 * qy * f1 + 2 * qx * f2
+    g1 = 2 * qz * f1 + 2 * qw * f2 - 4 * qx * f3
+    g2 = -2 * qw * f1 + 2 * qz * f2 - 4 * qy * f3
+    g3 = 2 * qx * f1 + 2 * qy * f2
+
+    if mag is not None:
+        # J_b^T F_b
+        mx, my, mz = mag
+        h1 = 2 * bx * (0.5 - qy ** 2 - qz ** 2) + 2 * bz * (qx * qz - qw * qy) - mx
+        h2 = 2 * bx * (qy * qx - qw * qz) + 2 * bz * (qw * qx + qy * qz) - my
+        h3 = 2 * bx * (qw * qy + qx * qz) + 2 * bz * (0.5 - qx ** 2 - qy ** 2) - mz
+        g0 += -2 * bz * qy * h1 + 2 * bx * (qx - qz) * h2 + 2 * bx * qy * h3
+        g1 += 2 * bz * qz * h1 + (2 * bx * qy + 2 * bz * qw) * h2 + (2 * bx * qz - 4 * bz * qx) * h3
+        g2 += (-4 * bx * qy - 2 * bz * qw) * h1 + (2 * bx * qx + 2 * bz * qz) * h2 + (2 * bx * qw - 4 * bz * qy) * h3
+        g3 += (-4 * bx * qz + 2 * bz * qx) * h1 + (-2 * bx * qw + 2 * bz * qy) * h2 + 2 * bx * qx * h3
+
+    g_norm = sqrt(g0 * g0 + g1 * g1 + g2 * g2 + g3 * g3)
+    if g_norm < 0.001:
+        return None
+
+    # rate of change of quaternion
+    wx, wy, wz = gyr
+    d0 = (-qx * wx - qy * wy - qz * wz) / 2 + k0 * g0 / g_norm
+    d1 = (qw * wx + qz * wy - qy * wz) / 2 + k1 * g1 / g_norm
+    d2 = (-qz * wx + qw * wy + qx * wz) / 2 + k2 * g2 / g_norm
+    d3 = (qy * wx - qx * wy + qw * wz) / 2 + k3 * g3 / g_norm
+
+    # quaternion exponential integration
+    x0 = d0 * dt / 2
+    x1 = d1 * dt / 2
+    x2 = d2 * dt / 2
+    x3 = d3 * dt / 2
+    e = exp(x0)
+    v_norm = sqrt(x1 * x1 + x2 * x2 + x3 * x3)
+    pw = e * cos(v_norm)
+    # np.sign of the vector part, as in get_quaternion_exponential
+    e_sin = e * sin(v_norm)
+    px = e_sin if x1 > 0 else (-e_sin if x1 < 0 else 0.0)
+    py = e_sin if x2 > 0 else (-e_sin if x2 < 0 else 0.0)
+    pz = e_sin if x3 > 0 else (-e_sin if x3 < 0 else 0.0)
+
+    nw = pw * qw - (px * qx + py * qy + pz * qz)
+    nx = pw * qx + qw * px + (py * qz - pz * qy)
+    ny = pw * qy + qw * py + (pz * qx - px * qz)
+    nz = pw * qz + qw * pz + (px * qy - py * qx)
+    norm = sqrt(nw * nw + nx * nx + ny * ny + nz * nz)
+    if norm > 0.8 and norm < 1.2:
+        return nw / norm, nx / norm, ny / norm, nz / norm
+    return qw, qx, qy, qz
+
@@ -0,0 +1,143 @@
+from math import sqrt
+import time
+from typing import Any
+import numpy as np
+from Madgwick.AHRS import AHRS, clamp_dt
+
+
+class MahonyAHRS(AHRS):
+    """ Mahony complementary filter on SO(3): the gyroscope rate is corrected by a PI controller
+    on the error between the measured and the estimated gravity (and magnetic field) directions.
+    Cheaper than MadgwickAHRS: no gradient, one cross product per reference vector.
+
+    Args:
+    kp (float, optional): proportional gain. Defaults to 1.
+    ki (float, optional): integral gain, estimates the gyroscope bias. Defaults to 0.
+    quaternion (np.ndarray, optional): initial quaternion. Defaults to identity.
+    sample_period (float, optional): sampling period in seconds. Defaults to 1/256.
+    max_dt (float, optional): longest valid time between samples in seconds. Defaults to 0.1.
+
+    Attributes:
+    quaternion (np.ndarray): current quaternion.
+    integral (np.ndarray): integral of the error, the gyroscope bias estimate with opposite sign. """
+
+    def __init__(self, kp: float = 1.0, ki: float = 0.0, quaternion: np.ndarray | None = None, sample_period: float = 1 / 256, max_dt: float = 0.1):
+        super().__init__(sample_period=sample_period, max_dt=max_dt)
+        if quaternion is None:
+            quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        self.quaternion: np.ndarray = np.array(quaternion, dtype=float)
+        self.kp = kp
+        self.ki = ki
+        self.integral: np.ndarray = np.zeros(3)
+
+    def state_dict(self) -> dict[str, Any]:
+        state = super().state_dict()
+        state["state"]["integral"] = self.integral.tolist()
+        state["parameters"].update(kp=self.kp, ki=self.ki)
+        return state
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        super().load_state(state)
+        self.integral = np.array(state["state"]["integral"], dtype=float)
+
+    def update(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None = None, dt: float | None = None) -> None:
+        curr_time = time.time()
+        dt = curr_time - self.prev_time if dt is None else self.check_dt(dt)
+        q, integral = mahony_step(self.quaternion.tolist(), self.integral.tolist(), np.asarray(gyr, dtype=float).tolist(),
+                                  np.asarray(acc, dtype=float).tolist(), np.asarray(mag, dtype=float).tolist() if mag is not None else None,
+                                  self.kp, self.ki, dt)
+        self.quaternion = np.array(q)
+        self.integral = np.array(integral)
+        self.prev_time = curr_time
+
+    def update_batch(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray | None, dt: np.ndarray) -> np.ndarray:
+        n = gyr.shape[0]
+        if n == 0:
+            return np.empty((0, 4))
+        dt, gaps = clamp_dt(np.broadcast_to(np.asarray(dt, dtype=float), (n,)), self.sample_period, self.max_dt)
+        self.gaps += int(gaps.sum())
+        gyr_l = np.asarray(gyr, dtype=float).tolist()
+        acc_l = np.asarray(acc, dtype=float).tolist()
+        mag_l = np.asarray(mag, dtype=float).tolist() if mag is not None else [None] * n
+        q = self.quaternion.tolist()
+        integral = self.integral.tolist()
+        kp = self.kp
+        ki = self.ki
+        result = []
+        for g, a, m, d in zip(gyr_l, acc_l, mag_l, dt.tolist()):
+            q, integral = mahony_step(q, integral, g, a, m, kp, ki, d)
+            result.append(q)
+        self.quaternion = np.array(q)
+        self.integral = np.array(integral)
+        self.prev_time = time.time()
+        return np.array(result, dtype=float)
+
+
+def mahony_step(q: list[float], integral: list[float], gyr: list[float], acc: list[float], mag: list[float] | None,
+                kp: float, ki: float, dt: float) -> tuple[list[float], list[float]]:
+    """
+    One step of the Mahony filter over plain floats
+    :param q: current quaternion
+    :param integral: integral of the error
+    :param gyr: gyroscope data in rad/s
+    :param acc: accelerometer data
+    :param mag: magnetometer data or None
+    :param kp, ki: proportional and integral gains
+    :param dt: timestep
+    :return: next quaternion and integral of the error
+    """
+    qw, qx, qy, qz = q
+    gx, gy, gz = gyr
+    ix, iy, iz = integral
+    ex = ey = ez = 0.0
+
+    ax, ay, az = acc
+    a_norm = sqrt(ax * ax + ay * ay + az * az)
+    if a_norm > 0:
+        ax /= a_norm
+        ay /= a_norm
+        az /= a_norm
+        # estimated direction of gravity in the sensor frame
+        vx = 2 * (qx * qz - qw * qy)
+        vy = 2 * (qw * qx + qy * qz)
+        vz = qw * qw - qx * qx - qy * qy + qz * qz
+        ex = ay * vz - az * vy
+        ey = az * vx - ax * vz
+        ez = ax * vy - ay * vx
+
+    if mag is not None:
+        mx, my, mz = mag
+        m_norm = sqrt(mx * mx + my * my + mz * mz)
+        if m_norm > 0:
+            mx /= m_norm
+            my /= m_norm
+            mz /= m_norm
+            # magnetic field in the earth frame, its horizontal part is the reference north
+            hx = 2 * (mx * (0.5 - qy * qy - qz * qz) + my * (qx * qy - qw * qz) + mz * (qx * qz + qw * qy))
+            hy = 2 * (mx * (qx * qy + qw * qz) + my * (0.5 - qx * qx - qz * qz) + mz * (qy * qz - qw * qx))
+            bx = sqrt(hx * hx + hy * hy)
+            bz = 2 * (mx * (qx * qz - qw * qy) + my * (qy * qz + qw * qx) + mz * (0.5 - qx * qx - qy * qy))
+            # estimated direction of the magnetic field in the sensor frame
+            wx = 2 * (bx * (0.5 - qy * qy - qz * qz) + bz * (qx * qz - qw * qy))
+            wy = 2 * (bx * (qx * qy - qw * qz) + bz * (qw * qx + qy * qz))
+            wz = 2 * (bx * (qw * qy + qx * qz) + bz * (0.5 - qx * qx - qy * qy))
+            ex += my * wz - mz * wy
+            ey += mz * wx - mx * wz
+            ez += mx * wy - my * wx
+
+    if ki > 0:
+        ix += ki * ex * dt
+        iy += ki * ey * dt
+        iz += ki * ez * dt
+    gx += kp * ex + ix
+    gy += kp * ey + iy
+    gz += kp * ez + iz
+
+    # q += q (x) (0, omega) / 2 * dt
+    h = dt / 2
+    nw = qw + (-qx * gx - qy * gy - qz * gz) * h
+    nx = qx + (qw * gx + qy * gz - qz * gy) * h
+    ny = qy + (qw * gy - qx * gz + qz * gx) * h
+    nz = qz + (qw * gz + qx * gy - qy * gx) * h
+    norm = sqrt(nw * nw + nx * nx + ny * ny + nz * nz)
+    return [nw / norm, nx / norm, ny / norm, nz / norm], [ix, iy, iz]
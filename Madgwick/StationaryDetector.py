@@ -0,0 +1,210 @@
+from typing import Any
+import numpy as np
+from scipy.signal import lfilter  # type:ignore
+
+# schedule of a sample: the full update, the correction step at rest with the gain scaled by rest_beta_scale,
+# or no update, the sample time goes to the next update like a skipped sample of step_quaternion
+FULL_STEP = 0
+REST_STEP = 1
+HOLD = 2
+
+
+class StationaryDetector:
+    """ Rest detector of one IMU for the filter update scheduling. Keeps exponentially weighted
+    rolling mean and variance of the gyroscope and of the accelerometer, the sensor is at rest when
+    both variances and the bias-compensated rotation rate stay under their thresholds for min_duration.
+    At rest only every correction_interval-th sample is updated, and the gyroscope bias is refined.
+
+    Args:
+    window (float, optional): time constant of the rolling mean and variance in seconds. Defaults to 0.25.
+    gyr_variance (float, optional): rest threshold of the gyroscope variance, sum over the axes, (rad/s)^2. Defaults to 1e-3.
+    gyr_rate (float, optional): rest threshold of the rolling mean of the bias-compensated rotation rate, rad/s,
+        a slow steady rotation has a small variance, and a rotation slower than gyr_rate is taken into the bias
+        at rest. Keep it near the residual bias of the calibrated gyroscope. Defaults to 0.01.
+    acc_variance (float, optional): rest threshold of the accelerometer variance relative to the squared mean, sum over the axes. Defaults to 5e-3.
+    min_duration (float, optional): time the sensor stays under the thresholds before the rest starts, in seconds. Defaults to 0.5.
+    correction_interval (int, optional): at rest every correction_interval-th sample is updated over the time
+        of the held samples before it. Defaults to 8.
+    rest_beta_scale (float, optional): gain factor of the correction steps at rest. Defaults to 2.
+    bias_time_constant (float, optional): time constant of the gyroscope bias refinement at rest in seconds, 0 disables it. Defaults to 5.
+    sample_period (float, optional): sampling period in seconds, converts the times above to samples. Defaults to 1/256.
+
+    Attributes:
+    bias (np.ndarray): gyroscope bias estimate in rad/s, subtracted from the gyroscope data.
+    quiet_samples (int): number of consecutive samples under the thresholds.
+    samples (int): number of processed samples.
+    rest_samples (int): number of samples at rest.
+    skipped_corrections (int): number of held samples.
+
+    Methods:
+    schedule(gyr, acc): bias-compensated gyroscope data and the schedule of a block of samples.
+    push(gyr, acc): the same for one sample, over plain floats.
+    stats(): counters of the processed samples.
+    state_dict(): JSON-serializable bias and counters.
+    load_state(state): restores them. """
+
+    def __init__(self, window: float = 0.25, gyr_variance: float = 1e-3, gyr_rate: float = 0.01, acc_variance: float = 5e-3, min_duration: float = 0.5,
+                 correction_interval: int = 8, rest_beta_scale: float = 2.0, bias_time_constant: float = 5.0, sample_period: float = 1 / 256):
+        self.alpha = min(1.0, sample_period / window)
+        self.gyr_threshold = gyr_variance
+        self.rate_threshold = gyr_rate * gyr_rate
+        self.acc_threshold = acc_variance
+        self.min_samples = max(1, round(min_duration / sample_period))
+        self.correction_interval = max(1, int(correction_interval))
+        self.rest_beta_scale = rest_beta_scale
+        self.bias_rate = min(1.0, sample_period / bias_time_constant) if bias_time_constant > 0 else 0.0
+
+        # rolling statistics, None before the first sample
+        self.gyr_mean: np.ndarray | None = None
+        self.acc_mean: np.ndarray = np.zeros(3)
+        self.gyr_var = 0.0
+        self.acc_var = 0.0
+        self.bias: np.ndarray = np.zeros(3)
+        self.quiet_samples = 0
+        self.samples = 0
+        self.rest_samples = 0
+        self.skipped_corrections = 0
+
+    def __ew_filter__(self, x: np.ndarray, initial: np.ndarray | float, gain: float) -> np.ndarray:
+        """ y[n] = (1 - a) * y[n - 1] + gain * x[n] along the first axis, y[-1] = initial """
+        a = self.alpha
+        zi = np.reshape((1 - a) * np.asarray(initial, dtype=float), (1,) + np.shape(x)[1:])
+        return lfilter([gain], [1.0, -(1 - a)], x, axis=0, zi=zi)[0]
+
+    def schedule(self, gyr: np.ndarray, acc: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ updates the rolling statistics with a block of samples. Gives the same output as push sample by sample,
+        the rolling statistics are vectorized over the block and the bias over each rest period.
+        Args:
+        gyr (np.ndarray): (N, 3) gyroscope data in rad/s, without the bias compensation.
+        acc (np.ndarray): (N, 3) accelerometer data.
+        Returns:
+        tuple[np.ndarray, np.ndarray]: (N, 3) bias-compensated gyroscope data and (N,) schedule of the samples,
+        FULL_STEP, REST_STEP or HOLD."""
+
+        gyr = np.asarray(gyr, dtype=float)
+        acc = np.asarray(acc, dtype=float)
+        n = gyr.shape[0]
+        if n == 0:
+            return gyr, np.empty(0, dtype=np.int8)
+        if self.gyr_mean is None:
+            self.gyr_mean = gyr[0].copy()
+            self.acc_mean = acc[0].copy()
+        a = self.alpha
+
+        # exponentially weighted variance: var = (1 - a) * (var + a * (x - mean)^2), with the mean before x
+        gyr_mean = self.__ew_filter__(gyr, self.gyr_mean, a)
+        gyr_prev = np.concatenate([self.gyr_mean[None], gyr_mean[:-1]])
+        gyr_var = self.__ew_filter__(np.sum((gyr - gyr_prev) ** 2, axis=1), self.gyr_var, (1 - a) * a)
+        acc_mean = self.__ew_filter__(acc, self.acc_mean, a)
+        acc_prev = np.concatenate([self.acc_mean[None], acc_mean[:-1]])
+        acc_var = self.__ew_filter__(np.sum((acc - acc_prev) ** 2, axis=1), self.acc_var, (1 - a) * a)
+
+        # the variance tests do not depend on the bias, the rate test does and the bias changes at rest only:
+        # the bias is constant up to the first rest sample, then it is refined at every sample while the rest lasts
+        still = (gyr_var < self.gyr_threshold) & (acc_var < self.acc_threshold * np.sum(acc_prev ** 2, axis=1))
+        schedule = np.full(n, FULL_STEP, dtype=np.int8)
+        bias = np.empty_like(gyr)
+        bias_now = self.bias
+        quiet_samples = self.quiet_samples
+        start = 0
+        while start < n:
+            quiet = still[start:] & (np.sum((gyr_mean[start:] - bias_now) ** 2, axis=1) < self.rate_threshold)
+            # length of the quiet run at every sample
+            index = np.arange(n - start)
+            last_loud = np.maximum.accumulate(np.where(quiet, -1, index))
+            run = np.where(last_loud < 0, index + 1 + quiet_samples, index - last_loud)
+            rest_index = np.flatnonzero(run >= self.min_samples)
+            if rest_index.size == 0:
+                bias[start:] = bias_now
+                quiet_samples = int(run[-1])
+                break
+            first = start + int(rest_index[0])
+            bias[start:first] = bias_now
+            if self.bias_rate > 0:
+                r = self.bias_rate
+                refined = lfilter([r], [1.0, -(1 - r)], gyr[first:], axis=0, zi=((1 - r) * bias_now)[None])[0]
+            else:
+                refined = np.broadcast_to(bias_now, gyr[first:].shape)
+            # the rate of every sample is compared with the bias before its refinement
+            previous = np.concatenate([bias_now[None], refined[:-1]])
+            quiet = still[first:] & (np.sum((gyr_mean[first:] - previous) ** 2, axis=1) < self.rate_threshold)
+            length = int(np.argmin(quiet)) if not quiet.all() else n - first
+            rest_run = run[rest_index[0]] + np.arange(length)
+            schedule[first:first + length] = np.where((rest_run - self.min_samples) % self.correction_interval == 0, REST_STEP, HOLD)
+            bias[first:first + length] = refined[:length]
+            bias_now = refined[length - 1].copy()
+            quiet_samples = int(rest_run[-1])
+            start = first + length
+        self.bias = np.array(bias_now, dtype=float)
+
+        self.gyr_mean = gyr_mean[-1].copy()
+        self.acc_mean = acc_mean[-1].copy()
+        self.gyr_var = float(gyr_var[-1])
+        self.acc_var = float(acc_var[-1])
+        self.quiet_samples = quiet_samples
+        self.samples += n
+        self.rest_samples += int(np.count_nonzero(schedule != FULL_STEP))
+        self.skipped_corrections += int(np.count_nonzero(schedule == HOLD))
+        return gyr - bias, schedule
+
+    def push(self, gyr: list[float], acc: list[float]) -> tuple[list[float], int]:
+        """ updates the rolling statistics with one sample, same as schedule for a block of one sample.
+        Args:
+        gyr (list[float]): gyroscope data in rad/s, without the bias compensation.
+        acc (list[float]): accelerometer data.
+        Returns:
+        tuple[list[float], int]: bias-compensated gyroscope data and the schedule of the sample."""
+
+        gx, gy, gz = gyr
+        ax, ay, az = acc
+        self.samples += 1
+        if self.gyr_mean is None:
+            self.gyr_mean = np.array([gx, gy, gz])
+            self.acc_mean = np.array([ax, ay, az])
+        a = self.alpha
+        mgx, mgy, mgz = self.gyr_mean.tolist()
+        dx, dy, dz = gx - mgx, gy - mgy, gz - mgz
+        mgx, mgy, mgz = mgx + a * dx, mgy + a * dy, mgz + a * dz
+        self.gyr_var = gyr_var = (1 - a) * (self.gyr_var + a * (dx * dx + dy * dy + dz * dz))
+        max_, may, maz = self.acc_mean.tolist()
+        dx, dy, dz = ax - max_, ay - may, az - maz
+        acc_scale = max_ * max_ + may * may + maz * maz
+        self.acc_var = acc_var = (1 - a) * (self.acc_var + a * (dx * dx + dy * dy + dz * dz))
+        self.gyr_mean = np.array([mgx, mgy, mgz])
+        self.acc_mean = np.array([max_ + a * dx, may + a * dy, maz + a * dz])
+
+        bx, by, bz = self.bias.tolist()
+        rate = (mgx - bx) ** 2 + (mgy - by) ** 2 + (mgz - bz) ** 2
+        if gyr_var < self.gyr_threshold and rate < self.rate_threshold and acc_var < self.acc_threshold * acc_scale:
+            self.quiet_samples += 1
+        else:
+            self.quiet_samples = 0
+        if self.quiet_samples < self.min_samples:
+            return [gx - bx, gy - by, gz - bz], FULL_STEP
+
+        self.rest_samples += 1
+        if self.bias_rate > 0:
+            r = self.bias_rate
+            bx, by, bz = bx + r * (gx - bx), by + r * (gy - by), bz + r * (gz - bz)
+            self.bias = np.array([bx, by, bz])
+        if (self.quiet_samples - self.min_samples) % self.correction_interval == 0:
+            return [gx - bx, gy - by, gz - bz], REST_STEP
+        self.skipped_corrections += 1
+        return [gx - bx, gy - by, gz - bz], HOLD
+
+    def state_dict(self) -> dict[str, Any]:
+        """ bias and counters, the rolling statistics are not kept: they start over from the next sample. """
+        return {"bias": self.bias.tolist(), "samples": self.samples, "rest_samples": self.rest_samples,
+                "skipped_corrections": self.skipped_corrections}
+
+    def load_state(self, state: dict[str, Any]) -> None:
+        self.bias = np.array(state["bias"], dtype=float)
+        self.samples = state["samples"]
+        self.rest_samples = state["rest_samples"]
+        self.skipped_corrections = state["skipped_corrections"]
+
+    def stats(self) -> dict[str, float]:
+        """ counters of the processed samples, rest_fraction and skipped_fraction are relative to all samples. """
+        return {"samples": self.samples, "rest_samples": self.rest_samples, "skipped_corrections": self.skipped_corrections,
+                "rest_fraction": self.rest_samples / self.samples if self.samples else 0.0,
+                "skipped_fraction": self.skipped_corrections / self.samples if self.samples else 0.0}
@@ -1,6 +1,6 @@
-from scipy.special import logsumexp #type:ignore
 import matplotlib.pyplot as plt #type:ignore
 import numpy as np
+from Madgwick import quaternions
 from Madgwick.visualize_quaternion import visualize_rotation
 import math
 
@@ -30,25 +30,11 @@ def x_rotation(theta):
 
 
 def quaternion_product(p, q):
-    Q = np.array([[p[0], -p[1], -p[2], -p[3]],
-                  [p[1], p[0], -p[3], p[2]],
-                  [p[2], p[3], p[0], -p[1]],
-                  [p[3], -p[2], p[1], p[0]]])
-    return Q @ q
+    return quaternions.multiply(p, q)
 
 
 def rot_matrix_quaternion(q):
-    R = np.array([[
-                    q[0] ** 2 + q[1] ** 2 - q[2] ** 2 - q[3] ** 2, 
-                    2 * (q[1] * q[2] - q[0] * q[3]),
-                    2 * (q[1] * q[3] + q[0] * q[2])],
-                  [ 2 * (q[1] * q[2] + q[0] * q[3]), 
-                    q[0] ** 2 - q[1] ** 2 + q[2] ** 2 - q[3] ** 2,
-                    2 * (q[2] * q[3] - q[0] * q[1])],
-                  [ 2 * (q[1] * q[3] - q[0] * q[2]), 
-                   2 * (q[2] * q[3] + q[0] * q[1]),
-                   q[0] ** 2 - q[1] ** 2 - q[2] ** 2 + q[3] ** 2]])
-    return R
+    return quaternions.rotation_matrix(q)
 
 
 def quaternion_rotation_by_vec(theta, vector):
@@ -63,11 +49,7 @@ def quaternion_rotation_by_vec(theta, vector):
 
 
 def normalize(v, tolerance=0.00001):
-    mag2 = logsumexp([n * n for n in v])
-    if abs(mag2 - 1.0) > tolerance:
-        mag = np.sqrt(mag2)
-        v = tuple(n / mag for n in v)
-    return np.array(v)
+    return quaternions.normalize(v, tolerance=tolerance)
 
 
 def quaternion_x_rotation(theta):
@@ -201,14 +183,9 @@ def make_quaternion_integration(q0, omega, N=1000, t=5, to_animate=True, to_plot
     :param t: time end
     :return:
     """
-    rm = np.zeros([N, 3, 3])
-    q = q0
     rot_q, t_span = forward_Euler(q0, calc_q_dot, omega, N=N, t=t)
-    theta = np.zeros(N)
-
-    for k in range(t_span.shape[0]):
-        theta[k] = rot_q[0, k]
-        rm[k, :, :] = rot_matrix_quaternion(normalize(rot_q[:, k]))
+    theta = rot_q[0, :]
+    rm = quaternions.rotation_matrix(quaternions.normalize(rot_q.T, tolerance=0.00001))
     anim = None
     fig, axs = None, None
     if to_animate:
@@ -3,7 +3,7 @@ import matplotlib.figure #type:ignore
 import matplotlib.pyplot as plt #type:ignore
 import numpy as np
 
-from Madgwick.animate_rotatioin import normalize, rot_matrix_quaternion
+from Madgwick import quaternions
 
 
 def draw_rotation_in_time(rot_matrix, ax=None, fig=None, stats=None):
@@ -56,7 +56,7 @@ def draw_rotation(
     t=None,
 ):
 
-    rm = rot_matrix_quaternion(normalize(quaternion))
+    rm = quaternions.rotation_matrix(quaternions.normalize(quaternion))
 
     if theta is None:
         theta = np.arccos(rm[2, 2])
@@ -0,0 +1,32 @@
+from typing import Any
+from Madgwick.AHRS import AHRS, AHRSBank
+from Madgwick.MadgwickFilter import MadgwickAHRS
+from Madgwick.MadgwickBank import MadgwickBank
+from Madgwick.MahonyFilter import MahonyAHRS
+from Madgwick.ComplementaryFilter import ComplementaryAHRS
+
+
+# names of the orientation filters for ahrs_engine in config.py
+ahrs_engines: dict[str, type[AHRS]] = {
+    "madgwick": MadgwickAHRS,
+    "mahony": MahonyAHRS,
+    "complementary": ComplementaryAHRS,
+}
+
+
+def create_ahrs(engine: str, **parameters: Any) -> AHRS:
+    """
+    Orientation filter by name, parameters go to its constructor.
+    """
+    if engine not in ahrs_engines:
+        raise ValueError(f"unknown AHRS engine {engine!r}, available: {', '.join(ahrs_engines)}")
+    return ahrs_engines[engine](**parameters)
+
+
+def create_bank(engine: str, n_filters: int, **parameters: Any) -> MadgwickBank | AHRSBank:
+    """
+    Bank of n_filters orientation filters by name, MadgwickBank for "madgwick".
+    """
+    if engine == "madgwick":
+        return MadgwickBank(n_filters, **parameters)
+    return AHRSBank([create_ahrs(engine, **parameters) for _ in range(n_filters)])
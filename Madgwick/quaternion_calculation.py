@@ -1,18 +1,10 @@
-import sys
 from typing import Iterable
 import numpy as np
-from scipy.special import logsumexp #type:ignore
+from Madgwick import quaternions
 
 
 def normalize(v: Iterable, tolerance=0.001):
-    mag2 = logsumexp([n * n for n in v])
-    if abs(mag2 - 1.0) > tolerance:
-        mag = np.sqrt(mag2)
-        if mag == 0:
-            # print("mag is less then 0:", mag)
-            mag = sys.float_info.min
-        v = [n / (mag) for n in v]
-    return np.array(v)
+    return quaternions.normalize(np.asarray(v, dtype=float), tolerance=tolerance)
 
 
 # QUATERNIONS
@@ -25,6 +17,9 @@ def get_R(q) -> np.ndarray:
 
     For derivative:
     \dot_q = R(q) @ omega / 2
+
+    The third row differs from the product q (x) (0, omega), see quaternions.q_dot.
+    MadgwickAHRS is tuned with this matrix, so it is kept as it is.
     :param q: 4x1 vector, a quaternion
     :return: 4x3 matrix R
     """
@@ -55,15 +50,14 @@ def multiply_quaternions(q_1: np.ndarray, q_2: np.ndarray) -> np.ndarray:
     :param q_2: 4x1 vector
     :return: 4x1 vector, q_1 (x) q_2 result
     """
-    scalar_part: float = q_1[0] * q_2[0] - np.dot(q_1[1:], q_2[1:])
-    vector_part: np.ndarray = q_1[0] * q_2[1:] + q_2[0] * q_1[1:] + np.cross(q_1[1:], q_2[1:])
-
-    return np.hstack([[scalar_part], vector_part])
+    return quaternions.multiply(q_1, q_2)
 
 
 def get_quaternion_exponential(omega_dt) -> np.ndarray:
     """
-    The function calculates the quaternion exponential form (no need to normalize)
+    The function calculates the quaternion exponential form (no need to normalize).
+    Uses sign(vector) instead of vector/|vector|, unlike quaternions.exponential,
+    MadgwickAHRS is tuned with this form, so it is kept as it is.
     :param omega_dt: just quaternion or the angle of rotation on one step (omega*dt)
     :return: normalized quaternion
     """
@@ -95,4 +89,4 @@ def quaternion_exponential_integration(q, omega_, dt) -> np.ndarray:
 
 
 def quaternion_conj(q) -> np.ndarray:
-    return np.array([q[0], -q[2] - q[3], -q[4]])
+    return quaternions.conjugate(q)
@@ -0,0 +1,185 @@
+"""
+Quaternion math over arrays of quaternions.
+
+Quaternions are [w, x, y, z] along the last axis, every function broadcasts over
+the leading axes, so a single (4,) quaternion and a (N, 4) trajectory go through the same code.
+Vectors are (..., 3), rotation matrices (..., 3, 3).
+"""
+import numpy as np
+
+
+def multiply(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """
+    Quaternion product p (x) q
+    :param p: (..., 4) quaternions
+    :param q: (..., 4) quaternions
+    :return: (..., 4)
+    """
+    p = np.asarray(p, dtype=float)
+    q = np.asarray(q, dtype=float)
+    pw, px, py, pz = np.moveaxis(p, -1, 0)
+    qw, qx, qy, qz = np.moveaxis(q, -1, 0)
+    return np.stack([pw * qw - px * qx - py * qy - pz * qz,
+                     pw * qx + px * qw + py * qz - pz * qy,
+                     pw * qy - px * qz + py * qw + pz * qx,
+                     pw * qz + px * qy - py * qx + pz * qw], axis=-1)
+
+
+def conjugate(q: np.ndarray) -> np.ndarray:
+    return np.asarray(q, dtype=float) * np.array([1.0, -1.0, -1.0, -1.0])
+
+
+def norm(q: np.ndarray) -> np.ndarray:
+    """
+    :return: (...) euclidean norm of the quaternions
+    """
+    q = np.asarray(q, dtype=float)
+    return np.sqrt(np.einsum("...i,...i->...", q, q))
+
+
+def normalize(q: np.ndarray, tolerance: float = 0.0) -> np.ndarray:
+    """
+    Unit quaternions. Quaternions with |norm^2 - 1| <= tolerance are returned as they are,
+    zero quaternions stay zero.
+    :param q: (..., 4) quaternions
+    :param tolerance: tolerance on the squared norm
+    :return: (..., 4)
+    """
+    q = np.asarray(q, dtype=float)
+    norm2 = np.einsum("...i,...i->...", q, q)[..., None]
+    scale = np.where((np.abs(norm2 - 1.0) > tolerance) & (norm2 > 0), 1 / np.sqrt(np.where(norm2 > 0, norm2, 1.0)), 1.0)
+    return q * scale
+
+
+def exponential(q: np.ndarray) -> np.ndarray:
+    """
+    exp(q) = e^w (cos|v|, v/|v| sin|v|)
+    :param q: (..., 4) quaternions
+    :return: (..., 4)
+    """
+    q = np.asarray(q, dtype=float)
+    v = q[..., 1:]
+    v_norm = np.sqrt(np.einsum("...i,...i->...", v, v))[..., None]
+    e_w = np.exp(q[..., :1])
+    # sin(x)/x -> 1 for x -> 0, np.sinc(x) = sin(pi x)/(pi x)
+    return np.concatenate([e_w * np.cos(v_norm), e_w * np.sinc(v_norm / np.pi) * v], axis=-1)
+
+
+def logarithm(q: np.ndarray) -> np.ndarray:
+    """
+    log(q) = (ln|q|, v/|v| arccos(w/|q|)), inverse of exponential
+    :param q: (..., 4) non-zero quaternions
+    :return: (..., 4)
+    """
+    q = np.asarray(q, dtype=float)
+    q_norm = norm(q)[..., None]
+    v = q[..., 1:]
+    v_norm = np.sqrt(np.einsum("...i,...i->...", v, v))[..., None]
+    angle = np.arccos(np.clip(q[..., :1] / q_norm, -1.0, 1.0))
+    scale = np.where(v_norm > 0, angle / np.where(v_norm > 0, v_norm, 1.0), 1 / q_norm)
+    return np.concatenate([np.log(q_norm), scale * v], axis=-1)
+
+
+def q_dot(q: np.ndarray, omega: np.ndarray) -> np.ndarray:
+    """
+    Derivative of the quaternion for the angular velocity, q (x) (0, omega) / 2
+    :param q: (..., 4) quaternions
+    :param omega: (..., 3) angular velocities
+    :return: (..., 4)
+    """
+    omega = np.asarray(omega, dtype=float)
+    return multiply(q, np.concatenate([np.zeros(omega.shape[:-1] + (1,)), omega], axis=-1)) / 2
+
+
+def rotation_matrix(q: np.ndarray) -> np.ndarray:
+    """
+    Rotation matrices of unit quaternions
+    :param q: (..., 4) quaternions
+    :return: (..., 3, 3)
+    """
+    q = np.asarray(q, dtype=float)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    return np.stack([np.stack([w * w + x * x - y * y - z * z, 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+                     np.stack([2 * (x * y + w * z), w * w - x * x + y * y - z * z, 2 * (y * z - w * x)], axis=-1),
+                     np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), w * w - x * x - y * y + z * z], axis=-1)], axis=-2)
+
+
+def rotate(q: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    Rotates the vectors by unit quaternions, q (x) (0, v) (x) q*
+    :param q: (..., 4) quaternions
+    :param v: (..., 3) vectors
+    :return: (..., 3)
+    """
+    q = np.asarray(q, dtype=float)
+    v = np.asarray(v, dtype=float)
+    w = q[..., :1]
+    u = q[..., 1:]
+    t = 2 * np.cross(u, v)
+    return v + w * t + np.cross(u, t)
+
+
+def slerp(q0: np.ndarray, q1: np.ndarray, t: np.ndarray | float) -> np.ndarray:
+    """
+    Spherical linear interpolation between unit quaternions along the shorter arc
+    :param q0: (..., 4) quaternions at t = 0
+    :param q1: (..., 4) quaternions at t = 1
+    :param t: (...) interpolation parameter
+    :return: (..., 4)
+    """
+    q0 = np.asarray(q0, dtype=float)
+    q1 = np.asarray(q1, dtype=float)
+    t = np.asarray(t, dtype=float)[..., None]
+    dot = np.einsum("...i,...i->...", q0, q1)[..., None]
+    # q and -q are the same rotation, take the shorter arc
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    close = sin_theta < 1e-6
+    safe_sin = np.where(close, 1.0, sin_theta)
+    w0 = np.where(close, 1 - t, np.sin((1 - t) * theta) / safe_sin)
+    w1 = np.where(close, t, np.sin(t * theta) / safe_sin)
+    return normalize(w0 * q0 + w1 * q1)
+
+
+def to_euler(q: np.ndarray) -> np.ndarray:
+    """
+    Roll, pitch, yaw (ZYX convention) of unit quaternions
+    :param q: (..., 4) quaternions
+    :return: (..., 3) angles in radians
+    """
+    q = np.asarray(q, dtype=float)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return np.stack([roll, pitch, yaw], axis=-1)
+
+
+def from_euler(angles: np.ndarray) -> np.ndarray:
+    """
+    Unit quaternions of roll, pitch, yaw (ZYX convention), inverse of to_euler
+    :param angles: (..., 3) angles in radians
+    :return: (..., 4)
+    """
+    angles = np.asarray(angles, dtype=float)
+    cr, cp, cy = np.moveaxis(np.cos(angles / 2), -1, 0)
+    sr, sp, sy = np.moveaxis(np.sin(angles / 2), -1, 0)
+    return np.stack([cr * cp * cy + sr * sp * sy,
+                     sr * cp * cy - cr * sp * sy,
+                     cr * sp * cy + sr * cp * sy,
+                     cr * cp * sy - sr * sp * cy], axis=-1)
+
+
+def from_axis_angle(axis: np.ndarray, angle: np.ndarray | float) -> np.ndarray:
+    """
+    Unit quaternions of the rotation by angle around axis
+    :param axis: (..., 3) rotation axes, not necessarily unit
+    :param angle: (...) angles in radians
+    :return: (..., 4)
+    """
+    axis = np.asarray(axis, dtype=float)
+    angle = np.asarray(angle, dtype=float)[..., None]
+    u = axis / np.linalg.norm(axis, axis=-1, keepdims=True)
+    return np.concatenate([np.cos(angle / 2), u * np.sin(angle / 2)], axis=-1)
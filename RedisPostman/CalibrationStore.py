@@ -0,0 +1,91 @@
+import json
+import time
+from typing import Any
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+
+
+class ACalibrationStore:
+    """
+    Versioned calibration coefficients in Redis, running stages switch to a new calibration without a restart.
+
+    Every published calibration set gets the next version number and is kept as an immutable record,
+    the hash "<key>:<version>" with the fields "data" (JSON in the layout of calib_data_filename) and "saved_at".
+    The hash key holds the current set and its "version", and the version number is published
+    to the notification channel "<key>:updates" after the set is stored.
+    """
+
+    def __init__(self, redis_client: aioredis.Redis, key: str) -> None:
+        """
+        :param redis_client: async redis client
+        :param key: name of the hash of the current set, prefix of the records and of the channel
+        """
+        self.redis_client = redis_client
+        self.key = key
+        self.channel = key + ":updates"
+        self.__pubsub__: Any = None
+
+    async def publish(self, calib_data: dict[str, Any]) -> int:
+        """
+        Stores the calibration set as the next version and notifies the subscribers.
+        The version bump, the record and the current set are written in one transaction watching the counter,
+        it is retried when another publisher bumps the counter first, so the current set only moves forward.
+
+        :return: version of the set
+        """
+        counter = self.key + ":counter"
+        record = {"data": json.dumps(calib_data), "saved_at": time.time()}
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(counter)
+                    version = int(await pipe.get(counter) or 0) + 1
+                    pipe.multi()
+                    pipe.set(counter, version)
+                    pipe.hset(f"{self.key}:{version}", mapping=record)
+                    pipe.hset(self.key, mapping={"version": version, **record})
+                    pipe.publish(self.channel, version)
+                    await pipe.execute()
+                    return version
+                except WatchError:
+                    continue
+
+    async def load(self, version: int | None = None) -> tuple[int, dict[str, Any]] | None:
+        """
+        Returns the version and the calibration set, the current one by default, None if there is none.
+        """
+        if version is None:
+            fields = await self.redis_client.hgetall(self.key)
+            if b"version" not in fields:
+                return None
+            version = int(fields[b"version"])
+        else:
+            fields = await self.redis_client.hgetall(f"{self.key}:{version}")
+        if b"data" not in fields:
+            return None
+        return version, json.loads(fields[b"data"])
+
+    async def subscribe(self) -> None:
+        """
+        Starts receiving the notifications of poll, call it before load so no update is missed.
+        """
+        self.__pubsub__ = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        await self.__pubsub__.subscribe(self.channel)
+
+    async def poll(self) -> int | None:
+        """
+        Returns the newest version notified since the last call without waiting, None if there is no update.
+        """
+        newest = None
+        while True:
+            message = await self.__pubsub__.get_message(timeout=0)
+            if message is None:
+                return newest
+            if message["type"] == "message":
+                version = int(message["data"])
+                newest = version if newest is None else max(newest, version)
+
+    async def close(self) -> None:
+        if self.__pubsub__ is not None:
+            await self.__pubsub__.reset()
+            self.__pubsub__ = None
@@ -0,0 +1,69 @@
+"""
+Redis clients shared by all workers and brokers of the process.
+
+Clients are created on the first request, not on import, with the connection
+settings from config.py. Every process (and every event loop, for the async client)
+gets its own connection pool, so clients are not shared across fork.
+"""
+import asyncio
+import os
+import weakref
+import redis
+from redis import asyncio as aioredis
+from redis.asyncio.retry import Retry as aRetry
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from redis.exceptions import ConnectionError, TimeoutError
+from config import (redis_url, redis_max_connections, redis_socket_keepalive, redis_health_check_interval,
+                    redis_retries, redis_backoff_base, redis_backoff_cap)
+
+
+__clients__: dict[tuple, redis.Redis] = {}
+# per event loop, weak keys so the id of a finished loop is never matched by a new one
+__async_clients__: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, aioredis.Redis]] = weakref.WeakKeyDictionary()
+
+
+def connection_kwargs(url: str) -> dict:
+    """
+    Arguments of the connection pool built from the settings in config.py.
+    """
+    kwargs = {
+        "max_connections": redis_max_connections,
+        "health_check_interval": redis_health_check_interval,
+    }
+    # keepalive is an option of TCP sockets only
+    if not url.startswith("unix://"):
+        kwargs["socket_keepalive"] = redis_socket_keepalive
+    return kwargs
+
+
+def get_redis(url: str = redis_url) -> redis.Redis:
+    """
+    Returns Redis client of this process for the url.
+    """
+    key = (url, os.getpid())
+    if key not in __clients__:
+        retry = Retry(ExponentialBackoff(cap=redis_backoff_cap, base=redis_backoff_base), redis_retries)
+        pool = redis.ConnectionPool.from_url(url, retry=retry, retry_on_error=[ConnectionError, TimeoutError],
+                                             **connection_kwargs(url))
+        __clients__[key] = redis.Redis(connection_pool=pool)
+    return __clients__[key]
+
+
+def get_async_redis(url: str = redis_url) -> aioredis.Redis:
+    """
+    Returns async Redis client of this process and the running event loop for the url.
+    Must be called from a coroutine, since async connections belong to the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # clients of closed loops can still hold their loop through the connections
+    for closed in [other for other in __async_clients__.keys() if other.is_closed()]:
+        del __async_clients__[closed]
+    clients = __async_clients__.setdefault(loop, {})
+    key = (url, os.getpid())
+    if key not in clients:
+        retry = aRetry(ExponentialBackoff(cap=redis_backoff_cap, base=redis_backoff_base), redis_retries)
+        pool = aioredis.ConnectionPool.from_url(url, retry=retry, retry_on_error=[ConnectionError, TimeoutError],
+                                                **connection_kwargs(url))
+        clients[key] = aioredis.Redis(connection_pool=pool)
+    return clients[key]
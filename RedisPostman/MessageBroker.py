@@ -1,7 +1,13 @@
 import abc
+import asyncio
+import json
+import time
+from dataclasses import dataclass
 from typing import AsyncIterator, Iterator
 from redis import Redis
+from redis.exceptions import ResponseError
 from redis.asyncio.client import Redis as aRedis
+from RedisPostman.models import get_serializer
 
 
 class MessageBroker(abc.ABC):
@@ -26,6 +32,20 @@ class MessageBroker(abc.ABC):
         returns generator which yields messages."""
         pass
 
+    @property
+    def lost(self) -> dict[str, int]:
+        """
+        Number of messages of each channel which were overwritten before the subscriptions read them,
+        empty for the brokers which do not drop unread messages.
+        """
+        return {}
+
+    def close(self) -> None:
+        """
+        Releases the channels of the broker. The redis client is shared by the process and stays open.
+        """
+        pass
+
 
 class AMessageBroker(abc.ABC):
     """
@@ -53,8 +73,65 @@ class AMessageBroker(abc.ABC):
         returns async generator which yields messages.
         """
         pass
+
+    @property
+    def lost(self) -> dict[str, int]:
+        """
+        Number of messages of each channel which were overwritten before the subscriptions read them,
+        empty for the brokers which do not drop unread messages.
+        """
+        return {}
+
+    async def close(self) -> None:
+        """
+        Releases the channels of the broker. The redis client is shared by the process and stays open.
+        """
+        pass
     
 
+def stream_trim_args(retention: dict[str, float] | None) -> dict:
+    """
+    Converts retention of the channel ({"maxlen": n} or {"max_age": seconds})
+    to the arguments of xadd, which trim the stream approximately.
+    """
+    if retention is None:
+        return {}
+    if "maxlen" in retention:
+        return {"maxlen": int(retention["maxlen"]), "approximate": True}
+    if "max_age" in retention:
+        min_id = int((time.time() - retention["max_age"]) * 1000)
+        return {"minid": str(min_id), "approximate": True}
+    return {}
+
+
+def message_fields(message: str | bytes, encoding: str = "json") -> dict:
+    """
+    Fields of the stream entry. The encoding is stored only
+    if it is not JSON, so JSON entries stay readable by old consumers.
+    """
+    if encoding == "json":
+        return {"message": message}
+    return {"message": message, "enc": encoding}
+
+
+def load_message(fields: dict[bytes, bytes]) -> dict:
+    """
+    Decodes the message of the stream entry according to its encoding.
+    """
+    encoding = fields.get(b"enc", b"json").decode()
+    return get_serializer(encoding).loads(fields[b"message"])
+
+
+def message_as_json(fields: dict[bytes, bytes]) -> str:
+    """
+    Returns the message of the stream entry as JSON string,
+    messages in other encodings are converted.
+    """
+    if b"enc" not in fields or fields[b"enc"] == b"json":
+        return fields[b"message"].decode()
+    return json.dumps(load_message(fields))
+
+
 class RedisMessageBroker(MessageBroker):
     """
     Implementation of MessageBroker using Redis.
@@ -66,14 +143,32 @@ class RedisMessageBroker(MessageBroker):
 
     redis_client: Redis
 
-    def __init__(self, redis_pool: Redis) -> None:
+    def __init__(self, redis_pool: Redis, retention: dict[str, dict[str, float]] | None = None) -> None:
+        """
+        :redis_pool: redis client
+        :retention: retention of the channels, see stream_retention in config.py.
+            Streams of the channels which are not listed are not trimmed.
+        """
         self.redis_client = redis_pool
+        self.retention = retention if retention is not None else {}
 
     
 
-    def publish(self, channel: str, message: str) -> None:
-        self.redis_client.xadd(channel, {"message": message})
+    def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        self.redis_client.xadd(channel, message_fields(message, encoding), **stream_trim_args(self.retention.get(channel)))
 
+    def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        """
+        Publishes all messages to the specified channel
+        using one pipelined round-trip to Redis.
+        """
+        if len(messages) == 0:
+            return
+        trim_args = stream_trim_args(self.retention.get(channel))
+        pipe = self.redis_client.pipeline(transaction=False)
+        for message in messages:
+            pipe.xadd(channel, message_fields(message, encoding), **trim_args)
+        pipe.execute()
 
     def subscribe(
         self,
@@ -104,7 +199,7 @@ class RedisMessageBroker(MessageBroker):
                         print("WARNING: Malfored message, skipping")
                         continue
 
-                    message = e[1][b"message"].decode()
+                    message = message_as_json(e[1])
                     yield (stream_id, message)
 
     def subscribe_grouped(
@@ -141,12 +236,145 @@ class RedisMessageBroker(MessageBroker):
                     if not b"message" in e[1].keys():
                         print("WARNING: Malfored message, skipping")
                         continue
-                    message = e[1][b"message"].decode()
+                    message = message_as_json(e[1])
                     result.append(message)
 
             # print(f"Yielding {stream_id}; {result}")
             yield (stream_id, result)
 
+    def subscribe_batch(
+        self,
+        channel: str,
+        last_id: str,
+        block: int = 1000,
+        count=10
+    ) -> Iterator[tuple[list[str], list[dict]]]:
+        """
+        Subscribes to the specified channel and
+        returns Iterator which yields ids and decoded payloads
+        of every message sent since last read.
+
+        :channel: channel to subscribe to
+        :last_id: last id of the message that was read
+        :block: how long to wait for new messages before returning in ms
+        :count: max number of messages in one group
+        """
+        if last_id:
+            stream_id = last_id
+        else:
+            stream_id = "0"
+
+        while True:
+            events = self.redis_client.xread(
+                {channel: stream_id}, block=block, count=count
+            )
+            ids = []
+            result = []
+            for _, es in events:
+                for e in es:
+                    stream_id = e[0].decode()
+                    if not b"message" in e[1].keys():
+                        print("WARNING: Malfored message, skipping")
+                        continue
+                    ids.append(stream_id)
+                    result.append(load_message(e[1]))
+
+            yield (ids, result)
+
+    def create_group(self, channel: str, group: str, start_id: str = "$") -> None:
+        """
+        Creates consumer group for the channel (and the channel itself),
+        does nothing if the group already exists.
+
+        :start_id: id after which the new group starts to read, "$" - only new messages
+        """
+        try:
+            self.redis_client.xgroup_create(channel, group, id=start_id, mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def subscribe_group(
+        self,
+        channel: str,
+        group: str,
+        consumer: str,
+        block: int = 1000,
+        count=10,
+        ack_batch_size: int = 100,
+        claim_min_idle: int = 30000,
+        claim_interval: float = 10,
+    ) -> Iterator[tuple[list[str], list[dict]]]:
+        """
+        Subscribes to the specified channel as a consumer of the group and
+        returns Iterator which yields ids and decoded payloads. Each message is
+        delivered to only one consumer of the group, so the processing
+        can be shared by several processes.
+
+        Messages are acknowledged after the consumer asks for the next group,
+        in batches of ack_batch_size, so a crashed consumer gets the
+        unacknowledged messages again (at-least-once delivery).
+        On start, messages pending for this consumer name are delivered first.
+        Messages pending for other consumers longer than claim_min_idle
+        are claimed every claim_interval seconds.
+
+        :channel: channel to subscribe to
+        :group: name of the consumer group
+        :consumer: name of the consumer, unique inside of the group
+        :block: how long to wait for new messages before returning in ms
+        :count: max number of messages in one group
+        :ack_batch_size: number of processed messages acknowledged at once
+        :claim_min_idle: time in ms after which a pending message is claimed from another consumer
+        :claim_interval: how often to look for messages to claim in seconds
+        """
+        self.create_group(channel, group)
+        # first read the messages pending for this consumer after the previous run,
+        # then ">" - the messages never delivered to the group
+        reading_pending = True
+        stream_id = "0"
+        next_claim = time.monotonic() + claim_interval
+        to_ack: list[str] = []
+        try:
+            while True:
+                if time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + claim_interval
+                    claimed = self.redis_client.xautoclaim(
+                        channel, group, consumer, min_idle_time=claim_min_idle, count=count)
+                    entries = claimed[1]
+                else:
+                    events = self.redis_client.xreadgroup(
+                        group, consumer, {channel: stream_id}, block=None if reading_pending else block, count=count)
+                    entries = [e for _, es in events for e in es]
+                    if reading_pending:
+                        if len(entries) == 0:
+                            reading_pending = False
+                            stream_id = ">"
+                            continue
+                        else:
+                            stream_id = entries[-1][0].decode()
+
+                ids = []
+                result = []
+                for e in entries:
+                    message_id = e[0].decode()
+                    if e[1] is None or not b"message" in e[1].keys():
+                        # deleted or malformed messages will never be processed
+                        print("WARNING: Malfored message, skipping")
+                        to_ack.append(message_id)
+                        continue
+                    ids.append(message_id)
+                    result.append(load_message(e[1]))
+
+                yield (ids, result)
+
+                to_ack.extend(ids)
+                if len(to_ack) >= ack_batch_size:
+                    self.redis_client.xack(channel, group, *to_ack)
+                    to_ack = []
+        finally:
+            if len(to_ack) > 0:
+                self.redis_client.xack(channel, group, *to_ack)
+
 
 class ARedisMessageBroker(AMessageBroker):
     """
@@ -159,14 +387,32 @@ class ARedisMessageBroker(AMessageBroker):
 
     redis_client: aRedis
 
-    def __init__(self, redis_pool: aRedis) -> None:
+    def __init__(self, redis_pool: aRedis, retention: dict[str, dict[str, float]] | None = None) -> None:
+        """
+        :redis_pool: redis client
+        :retention: retention of the channels, see stream_retention in config.py.
+            Streams of the channels which are not listed are not trimmed.
+        """
         self.redis_client = redis_pool
+        self.retention = retention if retention is not None else {}
 
     
 
-    async def publish(self, channel: str, message: str) -> None:
-        await self.redis_client.xadd(channel, {"message": message})
+    async def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        await self.redis_client.xadd(channel, message_fields(message, encoding), **stream_trim_args(self.retention.get(channel)))
 
+    async def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        """
+        Asynchronously publishes all messages to the specified channel
+        using one pipelined round-trip to Redis.
+        """
+        if len(messages) == 0:
+            return
+        trim_args = stream_trim_args(self.retention.get(channel))
+        pipe = self.redis_client.pipeline(transaction=False)
+        for message in messages:
+            pipe.xadd(channel, message_fields(message, encoding), **trim_args)
+        await pipe.execute()
 
     async def subscribe(
         self,
@@ -196,7 +442,7 @@ class ARedisMessageBroker(AMessageBroker):
                         print("WARNING: Malformed message, skipping")
                         continue
 
-                    message = e[1][b"message"].decode()
+                    message = message_as_json(e[1])
                     yield (stream_id, message)
 
     async def subscribe_grouped(
@@ -235,7 +481,294 @@ class ARedisMessageBroker(AMessageBroker):
                         print("WARNING: Malformed message, skipping")
                         continue
 
-                    message = e[1][b"message"].decode()
+                    message = message_as_json(e[1])
                     result.append(message)
 
             yield (stream_id, result)
+
+    async def subscribe_batch(
+        self,
+        channel: str,
+        last_id: str,
+        block: int = 5,
+        count=10
+    ) -> AsyncIterator[tuple[list[str], list[dict]]]:
+        """
+        Asynchronously subscribes to the specified channel and
+        returns async generator which yields ids and decoded payloads
+        of every message sent since last read.
+
+        :channel: channel to subscribe to
+        :last_id: last id of the message that was read
+        :block: how long to wait for new messages before returning in ms
+        :count: max number of messages in one group
+        """
+        if last_id:
+            stream_id = last_id
+        else:
+            stream_id = "0"
+
+        while True:
+            events = await self.redis_client.xread(
+                {channel: stream_id}, block=block, count=count
+            )
+            ids = []
+            result = []
+            for _, es in events:
+                for e in es:
+                    stream_id = e[0].decode()
+
+                    if not b"message" in e[1].keys():
+                        print("WARNING: Malformed message, skipping")
+                        continue
+
+                    ids.append(stream_id)
+                    result.append(load_message(e[1]))
+
+            yield (ids, result)
+
+    async def create_group(self, channel: str, group: str, start_id: str = "$") -> None:
+        """
+        Asynchronously creates consumer group for the channel (and the channel itself),
+        does nothing if the group already exists.
+
+        :start_id: id after which the new group starts to read, "$" - only new messages
+        """
+        try:
+            await self.redis_client.xgroup_create(channel, group, id=start_id, mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def subscribe_group(
+        self,
+        channel: str,
+        group: str,
+        consumer: str,
+        block: int = 1000,
+        count=10,
+        ack_batch_size: int = 100,
+        claim_min_idle: int = 30000,
+        claim_interval: float = 10,
+    ) -> AsyncIterator[tuple[list[str], list[dict]]]:
+        """
+        Asynchronously subscribes to the specified channel as a consumer of the group and
+        returns async generator which yields ids and decoded payloads. Each message is
+        delivered to only one consumer of the group, so the processing
+        can be shared by several processes.
+
+        Messages are acknowledged after the consumer asks for the next group,
+        in batches of ack_batch_size, so a crashed consumer gets the
+        unacknowledged messages again (at-least-once delivery).
+        On start, messages pending for this consumer name are delivered first.
+        Messages pending for other consumers longer than claim_min_idle
+        are claimed every claim_interval seconds.
+
+        :channel: channel to subscribe to
+        :group: name of the consumer group
+        :consumer: name of the consumer, unique inside of the group
+        :block: how long to wait for new messages before returning in ms
+        :count: max number of messages in one group
+        :ack_batch_size: number of processed messages acknowledged at once
+        :claim_min_idle: time in ms after which a pending message is claimed from another consumer
+        :claim_interval: how often to look for messages to claim in seconds
+        """
+        await self.create_group(channel, group)
+        # first read the messages pending for this consumer after the previous run,
+        # then ">" - the messages never delivered to the group
+        reading_pending = True
+        stream_id = "0"
+        next_claim = time.monotonic() + claim_interval
+        to_ack: list[str] = []
+        try:
+            while True:
+                if time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + claim_interval
+                    claimed = await self.redis_client.xautoclaim(
+                        channel, group, consumer, min_idle_time=claim_min_idle, count=count)
+                    entries = claimed[1]
+                else:
+                    events = await self.redis_client.xreadgroup(
+                        group, consumer, {channel: stream_id}, block=None if reading_pending else block, count=count)
+                    entries = [e for _, es in events for e in es]
+                    if reading_pending:
+                        if len(entries) == 0:
+                            reading_pending = False
+                            stream_id = ">"
+                            continue
+                        else:
+                            stream_id = entries[-1][0].decode()
+
+                ids = []
+                result = []
+                for e in entries:
+                    message_id = e[0].decode()
+                    if e[1] is None or not b"message" in e[1].keys():
+                        # deleted or malformed messages will never be processed
+                        print("WARNING: Malformed message, skipping")
+                        to_ack.append(message_id)
+                        continue
+                    ids.append(message_id)
+                    result.append(load_message(e[1]))
+
+                yield (ids, result)
+
+                to_ack.extend(ids)
+                if len(to_ack) >= ack_batch_size:
+                    await self.redis_client.xack(channel, group, *to_ack)
+                    to_ack = []
+        finally:
+            if len(to_ack) > 0:
+                await self.redis_client.xack(channel, group, *to_ack)
+
+
+@dataclass
+class BatchStats:
+    """
+    Statistics of the batches flushed by a buffered publisher.
+    """
+    n_batches: int = 0
+    n_messages: int = 0
+    max_batch_size: int = 0
+    last_batch_size: int = 0
+
+    def add(self, batch_size: int) -> None:
+        self.n_batches += 1
+        self.n_messages += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+
+    @property
+    def mean_batch_size(self) -> float:
+        if self.n_batches == 0:
+            return 0.0
+        return self.n_messages / self.n_batches
+
+    def __str__(self) -> str:
+        return (f"batches: {self.n_batches}\tmessages: {self.n_messages}\t"
+                f"mean batch: {self.mean_batch_size:.1f}\tmax batch: {self.max_batch_size}")
+
+
+class BufferedPublisher:
+    """
+    Coalesces messages published to RedisMessageBroker into pipelines.
+
+    Messages are buffered per channel and flushed with publish_many
+    when the buffer reaches max_batch_size or when the oldest buffered
+    message is older than max_latency seconds. Since the sync broker has
+    no event loop, the deadline is checked on every publish, so call
+    flush() when the stream of messages stops.
+    """
+
+    def __init__(self, broker: RedisMessageBroker, max_batch_size: int = 100, max_latency: float = 0.005, encodings: dict[str, str] | None = None) -> None:
+        """
+        :param broker: broker used to send the batches
+        :param max_batch_size: number of messages which triggers a flush
+        :param max_latency: max time in seconds a message can stay in the buffer
+        :param encodings: encoding of the payloads published with publish_dict for each channel,
+            see message_encodings in config.py, JSON for the channels which are not listed
+        """
+        self.broker = broker
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.encodings = encodings if encodings is not None else {}
+        self.stats = BatchStats()
+        self.__buffers__: dict[tuple[str, str], list[str | bytes]] = {}
+        self.__deadline__: float | None = None
+
+    def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        buffer = self.__buffers__.setdefault((channel, encoding), [])
+        buffer.append(message)
+        if self.__deadline__ is None:
+            self.__deadline__ = time.monotonic() + self.max_latency
+        if len(buffer) >= self.max_batch_size or time.monotonic() >= self.__deadline__:
+            self.flush()
+
+    def publish_dict(self, channel: str, payload: dict) -> None:
+        """
+        Serializes the payload with the encoding of the channel and publishes it.
+        """
+        encoding = self.encodings.get(channel, "json")
+        self.publish(channel, get_serializer(encoding).dumps(payload), encoding)
+
+    def flush(self) -> None:
+        """
+        Sends all buffered messages to Redis.
+        """
+        buffers = self.__buffers__
+        self.__buffers__ = {}
+        self.__deadline__ = None
+        for (channel, encoding), messages in buffers.items():
+            if len(messages) == 0:
+                continue
+            self.broker.publish_many(channel, messages, encoding)
+            self.stats.add(len(messages))
+
+
+class ABufferedPublisher:
+    """
+    Coalesces messages published to ARedisMessageBroker into pipelines.
+
+    Messages are buffered per channel and flushed with publish_many
+    when the buffer reaches max_batch_size or, at the latest,
+    max_latency seconds after the first message was buffered.
+    """
+
+    def __init__(self, broker: ARedisMessageBroker, max_batch_size: int = 100, max_latency: float = 0.005, encodings: dict[str, str] | None = None) -> None:
+        """
+        :param broker: broker used to send the batches
+        :param max_batch_size: number of messages which triggers a flush
+        :param max_latency: max time in seconds a message can stay in the buffer
+        :param encodings: encoding of the payloads published with publish_dict for each channel,
+            see message_encodings in config.py, JSON for the channels which are not listed
+        """
+        self.broker = broker
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.encodings = encodings if encodings is not None else {}
+        self.stats = BatchStats()
+        self.__buffers__: dict[tuple[str, str], list[str | bytes]] = {}
+        self.__deadline_task__: asyncio.Task | None = None
+        # batches are sent one at a time, so a deadline flush still in flight
+        # cannot be overtaken by the next batch and the stream keeps the publish order
+        self.__send_lock__ = asyncio.Lock()
+
+    async def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        buffer = self.__buffers__.setdefault((channel, encoding), [])
+        buffer.append(message)
+        if len(buffer) >= self.max_batch_size:
+            await self.flush()
+        elif self.__deadline_task__ is None:
+            self.__deadline_task__ = asyncio.create_task(self.__flush_after_deadline__())
+
+    async def publish_dict(self, channel: str, payload: dict) -> None:
+        """
+        Serializes the payload with the encoding of the channel and publishes it.
+        """
+        encoding = self.encodings.get(channel, "json")
+        await self.publish(channel, get_serializer(encoding).dumps(payload), encoding)
+
+    async def __flush_after_deadline__(self) -> None:
+        await asyncio.sleep(self.max_latency)
+        self.__deadline_task__ = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Sends all buffered messages to Redis.
+        """
+        task = self.__deadline_task__
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        self.__deadline_task__ = None
+
+        # swap the buffers before awaiting, so messages published
+        # during the round-trip go to the next batch
+        buffers = self.__buffers__
+        self.__buffers__ = {}
+        async with self.__send_lock__:
+            for (channel, encoding), messages in buffers.items():
+                if len(messages) == 0:
+                    continue
+                await self.broker.publish_many(channel, messages, encoding)
+                self.stats.add(len(messages))
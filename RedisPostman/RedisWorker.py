@@ -1,12 +1,16 @@
+import contextlib
+import datetime
 import json
 import traceback
 from typing import Generator, AsyncGenerator
 import redis
 import numpy as np
 from redis import asyncio as aioredis
-from RedisPostman.models import IMUData, IMUMessage
-from RedisPostman.models import Message
-from RedisPostman.MessageBroker import ARedisMessageBroker, RedisMessageBroker
+from RedisPostman.models import IMUData, IMU9250Message, LogMessage
+from RedisPostman.models import BatchMessage, Message
+from RedisPostman.SharedMemoryBroker import create_async_broker, create_broker
+from RedisPostman.ConnectionManager import get_async_redis, get_redis
+from config import consumer_group_ack_batch_size, consumer_group_claim_min_idle, log_message_channel
 
 
 class AsyncRedisWorker:
@@ -14,10 +18,10 @@ class AsyncRedisWorker:
     AsyncRedisWorker is a class that provides an interface for subscribing 
     to Redis channels and receiving data in an asynchronous manner.
 
-    Args: redis_db (aioredis.Redis):
+    Args: redis_db (aioredis.Redis | None):
         An instance of aioredis.
         Redis that represents the Redis database to connect to. 
-        Defaults to aioredis.from_url("redis://localhost:6379/0").
+        Defaults to the shared client of the process from ConnectionManager.get_async_redis.
 
     Methods: subscribe(dataClass, channel, block, count):
         An asynchronous method that subscribes 
@@ -26,14 +30,25 @@ class AsyncRedisWorker:
 
     def __init__(
             self,
-            redis_db: aioredis.Redis = aioredis.from_url(
-                "redis://localhost:6379/0"),
+            redis_db: aioredis.Redis | None = None,
     ) -> None:
+        if redis_db is None:
+            redis_db = get_async_redis()
         self.r = redis_db
-        self.broker = ARedisMessageBroker(redis_db)
+        self.broker = create_async_broker(redis_db)
         # By default, read from the last key. Skip old data.
         self.last_id = "$"
 
+    async def __log_decode_error__(self, channel: str, ids: list[str], exception: Exception) -> None:
+        """
+        Publishes the error of a batch which could not be decoded to the log channel, like the stages do.
+        """
+        status = LogMessage.exception_to_dict(exception)
+        status["channel"] = channel
+        status["ids"] = [ids[0], ids[-1]]
+        error_message = LogMessage(date=datetime.datetime.now(), process_name="AsyncRedisWorker", status=status)
+        await self.broker.publish(log_message_channel, json.dumps(error_message.to_dict()))
+
     async def subscribe(self, dataClass: type[Message], channel: str = "imu_data", block: int = 5, count=10000)->AsyncGenerator[None, Message]:
         """
         Args:
@@ -58,6 +73,99 @@ class AsyncRedisWorker:
                     print(e)
                     traceback.print_exc()
 
+    async def subscribe_batch(self, dataClass: type[BatchMessage], channel: str = "imu_data", block: int = 5, count=10000,
+                              imu_names: list[str] | None = None) -> AsyncGenerator[tuple[list[str], np.ndarray], None]:
+        """
+        Unlike subscribe, which yields only the last message of each read,
+        yields every received message.
+
+        Args:
+        dataClass: A class that represents the data being received. Must implement batch_from_dicts.
+        channel (str): The name of the Redis channel to subscribe to. Defaults to "imu_data".
+        block (int): The number of milliseconds to block while waiting for new data. Defaults to 5.
+        count (int): The maximum number of messages to retrieve at once. Defaults to 10000.
+        imu_names (list[str] | None): read only the fields of these IMUs, for the IMU messages. Defaults to all IMUs.
+
+        Yields:
+            Stream ids of the messages and a structured array with one row per message.
+
+        Raises:
+            The decode error of a batch, after logging it to log_message_channel. last_id stays at the last yielded batch.
+        """
+        async for ids, messages in self.broker.subscribe_batch(channel, self.last_id, block, count=count):
+            if len(messages) > 0:
+                try:
+                    batch = dataClass.batch_from_dicts(messages, imu_names=imu_names)
+                except Exception as e:
+                    await self.__log_decode_error__(channel, ids, e)
+                    raise
+                yield ids, batch
+            # last_id stays at the last yielded batch, a new subscription resumes after it
+            if len(ids) > 0:
+                self.last_id = ids[-1]
+
+    async def subscribe_block(self, dataClass: type[IMU9250Message], channel: str = "imu_data", block: int = 5,
+                              count=10000) -> AsyncGenerator[tuple[list[str], np.ndarray, np.ndarray], None]:
+        """
+        Like subscribe_batch, but yields the messages as a float block for vectorized processing.
+
+        Args:
+        dataClass: A class that represents the data being received. Must implement block_from_dicts.
+        channel (str): The name of the Redis channel to subscribe to. Defaults to "imu_data".
+        block (int): The number of milliseconds to block while waiting for new data. Defaults to 5.
+        count (int): The maximum number of messages to retrieve at once. Defaults to 10000.
+
+        Yields:
+            Stream ids of the messages, (N, imus, sensors, 3) block and (N,) timestamps (NaN if the message has none).
+        """
+        async for ids, messages in self.broker.subscribe_batch(channel, self.last_id, block, count=count):
+            if len(messages) > 0:
+                try:
+                    block_data = dataClass.block_from_dicts(messages)
+                    timestamps = dataClass.timestamps_from_dicts(messages)
+                except Exception as e:
+                    await self.__log_decode_error__(channel, ids, e)
+                    raise
+                yield ids, block_data, timestamps
+            if len(ids) > 0:
+                self.last_id = ids[-1]
+
+    async def subscribe_group(self, dataClass: type[BatchMessage], group: str, consumer: str, channel: str = "imu_data", block: int = 5, count=10000) -> AsyncGenerator[tuple[list[str], np.ndarray], None]:
+        """
+        Like subscribe_batch, but reads as a consumer of the Redis consumer group,
+        so several processes with the same group share the messages of the channel.
+        Processed messages are acknowledged when the next batch is requested,
+        so a restarted consumer gets its unprocessed messages again.
+
+        Args:
+        dataClass: A class that represents the data being received. Must implement batch_from_dicts.
+        group (str): The name of the consumer group.
+        consumer (str): The name of this consumer, unique inside of the group.
+        channel (str): The name of the Redis channel to subscribe to. Defaults to "imu_data".
+        block (int): The number of milliseconds to block while waiting for new data. Defaults to 5.
+        count (int): The maximum number of messages to retrieve at once. Defaults to 10000.
+
+        Yields:
+            Stream ids of the messages and a structured array with one row per message.
+
+        Raises:
+            The decode error of a batch, after logging it to log_message_channel. The batch is not acknowledged,
+            it stays pending for this consumer and is claimed by another one after consumer_group_claim_min_idle.
+        """
+        # closing the group reader acknowledges the batches yielded before the error
+        async with contextlib.aclosing(self.broker.subscribe_group(channel, group, consumer, block, count=count,
+                                                                   ack_batch_size=consumer_group_ack_batch_size,
+                                                                   claim_min_idle=consumer_group_claim_min_idle)) as reader:
+            async for ids, messages in reader:
+                if len(messages) > 0:
+                    try:
+                        batch = dataClass.batch_from_dicts(messages)
+                    except Exception as e:
+                        await self.__log_decode_error__(channel, ids, e)
+                        raise
+                    yield ids, batch
+
+
 class RedisWorker:
     """
     A class for subscribing to Redis channels and reading data.
@@ -80,18 +188,20 @@ class RedisWorker:
 
     def __init__(
             self,
-            redis_db: redis.Redis = redis.from_url("redis://localhost:6379/0"),
+            redis_db: redis.Redis | None = None,
     ) -> None:
         """
         Initialize a RedisWorker instance.
 
         Parameters:
         -----------
-        redis_db : redis.Redis
-            A Redis client instance.
+        redis_db : redis.Redis | None
+            A Redis client instance, the shared client of the process by default.
         """
+        if redis_db is None:
+            redis_db = get_redis()
         self.r = redis_db
-        self.broker = RedisMessageBroker(redis_db)
+        self.broker = create_broker(redis_db)
         # By default, read from the last key. Skip old data.
         self.last_id = "$"
 
@@ -121,3 +231,62 @@ class RedisWorker:
                 last_message = messages[-1]
                 data = dataClass.from_dict(json.loads(last_message))
                 yield data
+
+    def subscribe_batch(self, dataClass: type[BatchMessage], channel: str = "imu_data", block: int = 5, count=10) -> Generator[tuple[list[str], np.ndarray], None, None]:
+        """
+        Subscribe to a Redis channel and read every message, not only the last one.
+
+        Parameters:
+        -----------
+        dataClass : Type
+            The class of the data to be read from the Redis channel, must implement batch_from_dicts.
+        channel : str
+            The name of the Redis channel to subscribe to.
+        block : int
+            The number of milliseconds to block while waiting for new messages.
+        count : int
+            The maximum number of messages to read at once.
+
+        Yields:
+        -------
+        tuple[list[str], np.ndarray]
+            Stream ids of the messages and a structured array with one row per message.
+        """
+        for ids, messages in self.broker.subscribe_batch(channel, self.last_id, block, count=count):
+            if len(messages) > 0:
+                batch = dataClass.batch_from_dicts(messages)
+                yield ids, batch
+            if len(ids) > 0:
+                self.last_id = ids[-1]
+
+    def subscribe_group(self, dataClass: type[BatchMessage], group: str, consumer: str, channel: str = "imu_data", block: int = 5, count=10) -> Generator[tuple[list[str], np.ndarray], None, None]:
+        """
+        Like subscribe_batch, but reads as a consumer of the Redis consumer group,
+        so several processes with the same group share the messages of the channel.
+
+        Parameters:
+        -----------
+        dataClass : Type
+            The class of the data to be read from the Redis channel, must implement batch_from_dicts.
+        group : str
+            The name of the consumer group.
+        consumer : str
+            The name of this consumer, unique inside of the group.
+        channel : str
+            The name of the Redis channel to subscribe to.
+        block : int
+            The number of milliseconds to block while waiting for new messages.
+        count : int
+            The maximum number of messages to read at once.
+
+        Yields:
+        -------
+        tuple[list[str], np.ndarray]
+            Stream ids of the messages and a structured array with one row per message.
+        """
+        for ids, messages in self.broker.subscribe_group(channel, group, consumer, block, count=count,
+                                                         ack_batch_size=consumer_group_ack_batch_size,
+                                                         claim_min_idle=consumer_group_claim_min_idle):
+            if len(messages) > 0:
+                batch = dataClass.batch_from_dicts(messages)
+                yield ids, batch
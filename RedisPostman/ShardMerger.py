@@ -0,0 +1,71 @@
+from collections import deque
+from typing import Any
+
+
+def stream_id_key(stream_id: str) -> tuple[int, int]:
+    """
+    Sort key of a Redis stream id "<ms>-<seq>".
+    """
+    ms, _, seq = stream_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class ShardMerger:
+    """
+    Joins the partial messages of N shards into one message per source message.
+
+    Every shard processes the same source stream in order and publishes a partial message
+    with its own fields and the source stream id under source_key. The partial messages of one
+    source id are merged into one message (without source_key) once all shards delivered theirs.
+    A source id which some shard does not deliver (the shard started later or skipped the message)
+    is dropped as soon as the shard delivers a later one, so the output stays in the source order.
+    """
+
+    def __init__(self, n_shards: int, source_key: str = "source", max_pending: int = 100000) -> None:
+        """
+        :param n_shards: number of shards
+        :param source_key: key of the source stream id in the partial messages
+        :param max_pending: max number of buffered partial messages of one shard,
+            the oldest ones are dropped when a shard stops delivering
+        """
+        self.n_shards = n_shards
+        self.source_key = source_key
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.__pending__: list[deque[tuple[tuple[int, int], dict[str, Any]]]] = [deque() for _ in range(n_shards)]
+
+    def add(self, shard: int, messages: list[dict[str, Any]]) -> None:
+        """
+        Buffers the partial messages of the shard, in the source order.
+        """
+        pending = self.__pending__[shard]
+        source_key = self.source_key
+        pending.extend((stream_id_key(message[source_key]), message) for message in messages)
+        while len(pending) > self.max_pending:
+            pending.popleft()
+            self.dropped += 1
+
+    def pop_ready(self) -> list[dict[str, Any]]:
+        """
+        Returns the merged messages of all source ids delivered by every shard, in the source order.
+        """
+        pendings = self.__pending__
+        source_key = self.source_key
+        merged = []
+        while all(pendings):
+            newest = max(pending[0][0] for pending in pendings)
+            # drop the source ids some shard has passed without delivering them
+            for pending in pendings:
+                while pending and pending[0][0] < newest:
+                    pending.popleft()
+                    self.dropped += 1
+            if not all(pendings):
+                break
+            if any(pending[0][0] != newest for pending in pendings):
+                continue
+            message: dict[str, Any] = {}
+            for pending in pendings:
+                message.update(pending.popleft()[1])
+            del message[source_key]
+            merged.append(message)
+        return merged
@@ -0,0 +1,485 @@
+import asyncio
+import json
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, AsyncIterator, Iterator
+import numpy as np
+from redis import Redis
+from redis.asyncio.client import Redis as aRedis
+from RedisPostman.MessageBroker import AMessageBroker, MessageBroker, ARedisMessageBroker, RedisMessageBroker
+from RedisPostman.models import IMU9250Message, get_serializer
+from config import (archive_enabled, stream_retention, shared_memory_channels, redis_tap_channels,
+                    shared_memory_slot_size, shared_memory_n_slots, message_encodings, timestamp_key, calib_version_key)
+
+
+class SharedMemoryRing:
+    """
+    Single-producer/multi-consumer ring of fixed-size records
+    in a multiprocessing.shared_memory segment.
+
+    Segment layout:
+    - header: magic, slot size, number of slots, sequence number of the next record;
+    - slots: record sequence number + 1 (0 while the record is written), payload length,
+      payload encoding and the payload itself.
+
+    The producer never waits for consumers. Every consumer keeps its own
+    sequence number and checks the sequence number of the slot before and after
+    copying the record, so records overwritten by the producer are detected
+    and counted as lost instead of being read corrupted.
+    """
+
+    MAGIC = 0x494D5552
+    HEADER = struct.Struct("<IIIIQ")
+    SLOT_HEADER = struct.Struct("<QI8s4x")
+    WRITE_SEQ_OFFSET = 16
+
+    def __init__(self, name: str, slot_size: int = 1024, n_slots: int = 65536) -> None:
+        """
+        Attaches to the ring with the given name, creates it if it does not exist.
+
+        :param name: name of the shared memory segment
+        :param slot_size: size of one record in bytes, including the record header
+        :param n_slots: number of records in the ring
+        """
+        size = self.HEADER.size + slot_size * n_slots
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, self.MAGIC, slot_size, n_slots, 0, 0)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=name)
+        # the ring has to outlive the process which created it,
+        # otherwise the resource tracker removes it on exit
+        resource_tracker.unregister(self.shm._name, "shared_memory")  # type:ignore
+
+        magic, self.slot_size, self.n_slots, _, _ = self.HEADER.unpack_from(self.shm.buf, 0)
+        assert magic == self.MAGIC, f"Shared memory {name} is not a message ring"
+        self.max_message_size = self.slot_size - self.SLOT_HEADER.size
+        self.buf = self.shm.buf
+
+    @property
+    def write_seq(self) -> int:
+        """
+        Sequence number of the next record to be written.
+        """
+        return struct.unpack_from("<Q", self.buf, self.WRITE_SEQ_OFFSET)[0]
+
+    def __slot_offset__(self, seq: int) -> int:
+        return self.HEADER.size + (seq % self.n_slots) * self.slot_size
+
+    def write(self, message: bytes, encoding: str = "json") -> int:
+        """
+        Appends the record to the ring. Must be called from one process only.
+
+        :return: sequence number of the record
+        """
+        if len(message) > self.max_message_size:
+            raise ValueError(f"Message of {len(message)} bytes does not fit into {self.max_message_size} bytes")
+        seq = self.write_seq
+        offset = self.__slot_offset__(seq)
+        # mark the slot as being written
+        struct.pack_into("<Q", self.buf, offset, 0)
+        payload_offset = offset + self.SLOT_HEADER.size
+        self.buf[payload_offset:payload_offset + len(message)] = message
+        self.SLOT_HEADER.pack_into(self.buf, offset, seq + 1, len(message), encoding.encode())
+        struct.pack_into("<Q", self.buf, self.WRITE_SEQ_OFFSET, seq + 1)
+        return seq
+
+    def read(self, seq: int) -> tuple[bytes, str] | None:
+        """
+        Returns the record and its encoding, or None if the record
+        was overwritten by the producer.
+        """
+        offset = self.__slot_offset__(seq)
+        slot_seq, length, encoding = self.SLOT_HEADER.unpack_from(self.buf, offset)
+        if slot_seq != seq + 1:
+            return None
+        payload_offset = offset + self.SLOT_HEADER.size
+        message = bytes(self.buf[payload_offset:payload_offset + length])
+        # the producer could overwrite the slot while it was copied
+        if struct.unpack_from("<Q", self.buf, offset)[0] != slot_seq:
+            return None
+        return message, encoding.rstrip(b"\0").decode()
+
+    def close(self) -> None:
+        self.buf = None  # type:ignore
+        self.shm.close()
+
+    def unlink(self) -> None:
+        """
+        Removes the segment from the system.
+        """
+        # unlink unregisters the segment from the resource tracker
+        resource_tracker.register(self.shm._name, "shared_memory")  # type:ignore
+        self.shm.unlink()
+
+
+class SharedMemoryReader:
+    """
+    Reading cursor of one consumer in a SharedMemoryRing.
+    """
+
+    def __init__(self, ring: SharedMemoryRing, last_id: str) -> None:
+        """
+        :param last_id: sequence number of the last read record,
+            "$" - read only new records, "0" or "" - from the oldest record in the ring
+        """
+        self.ring = ring
+        self.lost = 0
+        if last_id == "$":
+            self.seq = ring.write_seq
+        elif last_id in ("", "0", "0-0"):
+            self.seq = max(0, ring.write_seq - ring.n_slots)
+        else:
+            self.seq = int(last_id) + 1
+
+    def read(self, count: int) -> list[tuple[str, bytes, str]]:
+        """
+        Returns up to count records: (id, message, encoding).
+        """
+        ring = self.ring
+        write_seq = ring.write_seq
+        oldest = write_seq - ring.n_slots
+        if self.seq < oldest:
+            self.lost += oldest - self.seq
+            self.seq = oldest
+        result = []
+        while self.seq < write_seq and len(result) < count:
+            record = ring.read(self.seq)
+            if record is None:
+                self.lost += 1
+            else:
+                result.append((str(self.seq), record[0], record[1]))
+            self.seq += 1
+        return result
+
+
+def __to_bytes__(message: str | bytes) -> bytes:
+    if isinstance(message, str):
+        return message.encode()
+    return message
+
+
+def __as_json__(message: bytes, encoding: str) -> str:
+    if encoding == "json":
+        return message.decode()
+    return json.dumps(get_serializer(encoding).loads(message))
+
+
+class SharedMemoryBroker(MessageBroker):
+    """
+    Implementation of MessageBroker for processes on the same machine,
+    every channel is a SharedMemoryRing. Message ids are the record sequence numbers.
+
+    Only one process may publish to a channel, it owns the ring and removes it on close.
+    Consumers which fall behind by more than the ring size lose the overwritten messages,
+    the number of lost messages is reported in the lost attribute.
+    """
+
+    def __init__(self, slot_size: int = 1024, n_slots: int = 65536, poll_interval: float = 0.0002) -> None:
+        """
+        :param slot_size: size of one record in bytes
+        :param n_slots: number of records in each ring
+        :param poll_interval: sleep time in seconds when there are no new messages
+        """
+        self.slot_size = slot_size
+        self.n_slots = n_slots
+        self.poll_interval = poll_interval
+        self.rings: dict[str, SharedMemoryRing] = {}
+        # channels published by this broker
+        self.owned: set[str] = set()
+        self.__lost__: dict[str, int] = {}
+
+    @property
+    def lost(self) -> dict[str, int]:
+        return self.__lost__
+
+    def ring(self, channel: str) -> SharedMemoryRing:
+        if channel not in self.rings:
+            self.rings[channel] = SharedMemoryRing(f"imu_tools_{channel}", self.slot_size, self.n_slots)
+        return self.rings[channel]
+
+    def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        self.ring(channel).write(__to_bytes__(message), encoding)
+        self.owned.add(channel)
+
+    def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        ring = self.ring(channel)
+        for message in messages:
+            ring.write(__to_bytes__(message), encoding)
+        self.owned.add(channel)
+
+    def close(self) -> None:
+        """
+        Detaches from the rings and removes the rings of the channels published by this broker,
+        consumers which are still attached keep reading the records left in them.
+        """
+        for channel, ring in self.rings.items():
+            ring.close()
+            if channel in self.owned:
+                ring.unlink()
+        self.rings.clear()
+        self.owned.clear()
+
+    def __read__(self, reader: SharedMemoryReader, channel: str, block: int, count: int) -> list[tuple[str, bytes, str]]:
+        deadline = time.monotonic() + block / 1000
+        records = reader.read(count)
+        while len(records) == 0 and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            records = reader.read(count)
+        self.lost[channel] = reader.lost
+        return records
+
+    def subscribe(self, channel: str, last_id: str) -> Iterator[tuple[str, str]]:
+        reader = SharedMemoryReader(self.ring(channel), last_id)
+        while True:
+            for stream_id, message, encoding in self.__read__(reader, channel, 1000, 10):
+                yield (stream_id, __as_json__(message, encoding))
+
+    def subscribe_grouped(self, channel: str, last_id: str, block: int = 1000, count=10) -> Iterator[tuple[str, list[str]]]:
+        reader = SharedMemoryReader(self.ring(channel), last_id)
+        stream_id = last_id
+        while True:
+            records = self.__read__(reader, channel, block, count)
+            if len(records) > 0:
+                stream_id = records[-1][0]
+            yield (stream_id, [__as_json__(message, encoding) for _, message, encoding in records])
+
+    def subscribe_batch(self, channel: str, last_id: str, block: int = 1000, count=10) -> Iterator[tuple[list[str], list[dict]]]:
+        reader = SharedMemoryReader(self.ring(channel), last_id)
+        while True:
+            records = self.__read__(reader, channel, block, count)
+            yield ([stream_id for stream_id, _, _ in records],
+                   [get_serializer(encoding).loads(message) for _, message, encoding in records])
+
+
+class ASharedMemoryBroker(AMessageBroker):
+    """
+    Async version of SharedMemoryBroker. Waiting for new messages
+    sleeps on the event loop.
+    """
+
+    def __init__(self, slot_size: int = 1024, n_slots: int = 65536, poll_interval: float = 0.0002) -> None:
+        self.sync_broker = SharedMemoryBroker(slot_size, n_slots, poll_interval)
+        self.poll_interval = poll_interval
+
+    @property
+    def lost(self) -> dict[str, int]:
+        return self.sync_broker.lost
+
+    async def close(self) -> None:
+        self.sync_broker.close()
+
+    async def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        self.sync_broker.publish(channel, message, encoding)
+
+    async def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        self.sync_broker.publish_many(channel, messages, encoding)
+
+    async def __read__(self, reader: SharedMemoryReader, channel: str, block: int, count: int) -> list[tuple[str, bytes, str]]:
+        deadline = time.monotonic() + block / 1000
+        records = reader.read(count)
+        while len(records) == 0 and time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            records = reader.read(count)
+        self.lost[channel] = reader.lost
+        return records
+
+    async def subscribe(self, channel: str, last_id: str) -> AsyncIterator[tuple[str, str]]:
+        reader = SharedMemoryReader(self.sync_broker.ring(channel), last_id)
+        while True:
+            for stream_id, message, encoding in await self.__read__(reader, channel, 1000, 10):
+                yield (stream_id, __as_json__(message, encoding))
+
+    async def subscribe_grouped(self, channel: str, last_id: str, block: int = 5, count=10) -> AsyncIterator[tuple[str, list[str]]]:
+        reader = SharedMemoryReader(self.sync_broker.ring(channel), last_id)
+        stream_id = last_id
+        while True:
+            records = await self.__read__(reader, channel, block, count)
+            if len(records) > 0:
+                stream_id = records[-1][0]
+            yield (stream_id, [__as_json__(message, encoding) for _, message, encoding in records])
+
+    async def subscribe_batch(self, channel: str, last_id: str, block: int = 5, count=10) -> AsyncIterator[tuple[list[str], list[dict]]]:
+        reader = SharedMemoryReader(self.sync_broker.ring(channel), last_id)
+        while True:
+            records = await self.__read__(reader, channel, block, count)
+            yield ([stream_id for stream_id, _, _ in records],
+                   [get_serializer(encoding).loads(message) for _, message, encoding in records])
+
+
+class RoutingBroker(MessageBroker):
+    """
+    Sends the channels listed in shared_memory_channels through the shared memory broker
+    and all the others through Redis. Messages of the tap channels are published
+    to Redis too, so remote consumers can still read them.
+    Everything else (redis_client) is taken from the Redis broker. Consumer groups need a redis stream,
+    they raise ValueError for the shared memory channels.
+    """
+
+    def __init__(self, redis_broker: RedisMessageBroker, shared_memory_broker: SharedMemoryBroker,
+                 shared_memory_channels: list[str], tap_channels: list[str]) -> None:
+        self.redis_broker = redis_broker
+        self.shared_memory_broker = shared_memory_broker
+        self.shared_memory_channels = set(shared_memory_channels)
+        self.tap_channels = set(tap_channels)
+
+    def __getattr__(self, name: str):
+        return getattr(self.redis_broker, name)
+
+    def __route__(self, channel: str) -> MessageBroker:
+        if channel in self.shared_memory_channels:
+            return self.shared_memory_broker
+        return self.redis_broker
+
+    def __check_group__(self, channel: str) -> None:
+        if channel in self.shared_memory_channels:
+            raise ValueError(f"{channel} is a shared memory channel, consumer groups need a redis stream")
+
+    @property
+    def lost(self) -> dict[str, int]:
+        return self.shared_memory_broker.lost
+
+    def close(self) -> None:
+        self.shared_memory_broker.close()
+
+    def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        self.__route__(channel).publish(channel, message, encoding)  # type:ignore
+        if channel in self.shared_memory_channels and channel in self.tap_channels:
+            self.redis_broker.publish(channel, message, encoding)
+
+    def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        self.__route__(channel).publish_many(channel, messages, encoding)  # type:ignore
+        if channel in self.shared_memory_channels and channel in self.tap_channels:
+            self.redis_broker.publish_many(channel, messages, encoding)
+
+    def subscribe(self, channel: str, last_id: str) -> Iterator[tuple[str, str]]:
+        return self.__route__(channel).subscribe(channel, last_id)  # type:ignore
+
+    def subscribe_grouped(self, channel: str, last_id: str, block: int = 1000, count=10) -> Iterator[tuple[str, list[str]]]:
+        return self.__route__(channel).subscribe_grouped(channel, last_id, block, count)  # type:ignore
+
+    def subscribe_batch(self, channel: str, last_id: str, block: int = 1000, count=10) -> Iterator[tuple[list[str], list[dict]]]:
+        return self.__route__(channel).subscribe_batch(channel, last_id, block, count)  # type:ignore
+
+    def create_group(self, channel: str, group: str, start_id: str = "$") -> None:
+        self.__check_group__(channel)
+        self.redis_broker.create_group(channel, group, start_id)
+
+    def subscribe_group(self, channel: str, group: str, consumer: str, block: int = 1000, count=10, ack_batch_size: int = 100,
+                        claim_min_idle: int = 30000, claim_interval: float = 10) -> Iterator[tuple[list[str], list[dict]]]:
+        self.__check_group__(channel)
+        return self.redis_broker.subscribe_group(channel, group, consumer, block, count, ack_batch_size, claim_min_idle, claim_interval)
+
+
+class ARoutingBroker(AMessageBroker):
+    """
+    Async version of RoutingBroker.
+    """
+
+    def __init__(self, redis_broker: ARedisMessageBroker, shared_memory_broker: ASharedMemoryBroker,
+                 shared_memory_channels: list[str], tap_channels: list[str]) -> None:
+        self.redis_broker = redis_broker
+        self.shared_memory_broker = shared_memory_broker
+        self.shared_memory_channels = set(shared_memory_channels)
+        self.tap_channels = set(tap_channels)
+
+    def __getattr__(self, name: str):
+        return getattr(self.redis_broker, name)
+
+    def __route__(self, channel: str) -> AMessageBroker:
+        if channel in self.shared_memory_channels:
+            return self.shared_memory_broker
+        return self.redis_broker
+
+    def __check_group__(self, channel: str) -> None:
+        if channel in self.shared_memory_channels:
+            raise ValueError(f"{channel} is a shared memory channel, consumer groups need a redis stream")
+
+    @property
+    def lost(self) -> dict[str, int]:
+        return self.shared_memory_broker.lost
+
+    async def close(self) -> None:
+        await self.shared_memory_broker.close()
+
+    async def publish(self, channel: str, message: str | bytes, encoding: str = "json") -> None:
+        await self.__route__(channel).publish(channel, message, encoding)  # type:ignore
+        if channel in self.shared_memory_channels and channel in self.tap_channels:
+            await self.redis_broker.publish(channel, message, encoding)
+
+    async def publish_many(self, channel: str, messages: list[str] | list[bytes], encoding: str = "json") -> None:
+        await self.__route__(channel).publish_many(channel, messages, encoding)  # type:ignore
+        if channel in self.shared_memory_channels and channel in self.tap_channels:
+            await self.redis_broker.publish_many(channel, messages, encoding)
+
+    def subscribe(self, channel: str, last_id: str) -> AsyncIterator[tuple[str, str]]:
+        return self.__route__(channel).subscribe(channel, last_id)
+
+    def subscribe_grouped(self, channel: str, last_id: str, block: int = 5, count=10) -> AsyncIterator[tuple[str, list[str]]]:
+        return self.__route__(channel).subscribe_grouped(channel, last_id, block, count)  # type:ignore
+
+    def subscribe_batch(self, channel: str, last_id: str, block: int = 5, count=10) -> AsyncIterator[tuple[list[str], list[dict]]]:
+        return self.__route__(channel).subscribe_batch(channel, last_id, block, count)  # type:ignore
+
+    async def create_group(self, channel: str, group: str, start_id: str = "$") -> None:
+        self.__check_group__(channel)
+        await self.redis_broker.create_group(channel, group, start_id)
+
+    def subscribe_group(self, channel: str, group: str, consumer: str, block: int = 1000, count=10, ack_batch_size: int = 100,
+                        claim_min_idle: int = 30000, claim_interval: float = 10) -> AsyncIterator[tuple[list[str], list[dict]]]:
+        self.__check_group__(channel)
+        return self.redis_broker.subscribe_group(channel, group, consumer, block, count, ack_batch_size, claim_min_idle, claim_interval)
+
+
+def largest_payload() -> dict[str, Any]:
+    """
+    The largest message of the pipeline: a calibrated IMU9250Message with the timestamp
+    and the calibration version, every value printed with the full float64 precision.
+    """
+    block = np.full((1, len(IMU9250Message.imu_names), 3, 3), -1.2345678901234567e-300)
+    payload = IMU9250Message.codec.encode(block)[0]
+    payload[calib_version_key] = 2 ** 31
+    payload[timestamp_key] = -1.2345678901234567e+300
+    return payload
+
+
+def check_slot_size(slot_size: int, channels: list[str]) -> None:
+    """
+    Raises ValueError if the largest message in the encoding of a channel does not fit into the slot.
+    """
+    payload = largest_payload()
+    max_message_size = slot_size - SharedMemoryRing.SLOT_HEADER.size
+    for channel in channels:
+        encoding = message_encodings.get(channel, "json")
+        size = len(__to_bytes__(get_serializer(encoding).dumps(payload)))
+        if size > max_message_size:
+            raise ValueError(f"shared_memory_slot_size {slot_size} leaves {max_message_size} bytes for a message, "
+                             f"{encoding} messages of {channel} take up to {size} bytes")
+
+
+def create_broker(redis_client: Redis) -> MessageBroker:
+    """
+    Creates broker configured in config.py: Redis broker with the stream retention,
+    routed through shared memory for shared_memory_channels.
+    """
+    # with the archiver running, streams are trimmed by it
+    redis_broker = RedisMessageBroker(redis_client, retention=None if archive_enabled else stream_retention)
+    if len(shared_memory_channels) == 0:
+        return redis_broker
+    check_slot_size(shared_memory_slot_size, shared_memory_channels)
+    shared_memory_broker = SharedMemoryBroker(slot_size=shared_memory_slot_size, n_slots=shared_memory_n_slots)
+    return RoutingBroker(redis_broker, shared_memory_broker, shared_memory_channels, redis_tap_channels)
+
+
+def create_async_broker(redis_client: aRedis) -> AMessageBroker:
+    """
+    Async version of create_broker.
+    """
+    # with the archiver running, streams are trimmed by it
+    redis_broker = ARedisMessageBroker(redis_client, retention=None if archive_enabled else stream_retention)
+    if len(shared_memory_channels) == 0:
+        return redis_broker
+    check_slot_size(shared_memory_slot_size, shared_memory_channels)
+    shared_memory_broker = ASharedMemoryBroker(slot_size=shared_memory_slot_size, n_slots=shared_memory_n_slots)
+    return ARoutingBroker(redis_broker, shared_memory_broker, shared_memory_channels, redis_tap_channels)
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+from typing import Any
+from redis import asyncio as aioredis
+
+
+class AStateCheckpoint:
+    """
+    Periodic snapshots of a process state (a JSON-serializable dict) for the warm start after a restart.
+
+    The snapshot is stored either in a Redis hash with the fields "state" (JSON) and "saved_at"
+    (unix time), written with one HSET, or in a local JSON file, replaced atomically.
+    """
+
+    def __init__(self, target: str, key: str, redis_client: aioredis.Redis | None = None, interval: float = 1.0, max_age: float | None = None) -> None:
+        """
+        :param target: "redis" or path of the snapshot file
+        :param key: name of the Redis hash
+        :param redis_client: async redis client, required for "redis"
+        :param interval: min time between snapshots of save_due in seconds
+        :param max_age: older snapshots are not loaded, in seconds, None - no limit
+        """
+        if target == "redis" and redis_client is None:
+            raise ValueError("redis_client is required for the redis checkpoint target")
+        self.target = target
+        self.key = key
+        self.redis_client = redis_client
+        self.interval = interval
+        self.max_age = max_age
+        self.saved_at = 0.0
+
+    async def save(self, state: dict[str, Any]) -> None:
+        """
+        Stores the snapshot, replacing the previous one.
+        """
+        saved_at = time.time()
+        payload = json.dumps(state)
+        if self.target == "redis":
+            assert self.redis_client is not None
+            await self.redis_client.hset(self.key, mapping={"state": payload, "saved_at": saved_at})
+        else:
+            directory = os.path.dirname(self.target)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.target + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"state": state, "saved_at": saved_at}, f)
+            os.replace(tmp_path, self.target)
+        self.saved_at = saved_at
+
+    async def save_due(self, state: dict[str, Any]) -> bool:
+        """
+        Stores the snapshot if the last one is older than the interval.
+
+        :return: True if the snapshot was stored
+        """
+        if time.time() - self.saved_at < self.interval:
+            return False
+        await self.save(state)
+        return True
+
+    async def load(self) -> dict[str, Any] | None:
+        """
+        Returns the stored snapshot, None if there is none or it is older than max_age.
+        """
+        if self.target == "redis":
+            assert self.redis_client is not None
+            fields = await self.redis_client.hgetall(self.key)
+            if b"state" not in fields:
+                return None
+            state = json.loads(fields[b"state"])
+            saved_at = float(fields[b"saved_at"])
+        else:
+            if not os.path.exists(self.target):
+                return None
+            with open(self.target) as f:
+                snapshot = json.load(f)
+            state = snapshot["state"]
+            saved_at = snapshot["saved_at"]
+        if self.max_age is not None and time.time() - saved_at > self.max_age:
+            return None
+        return state
@@ -0,0 +1,138 @@
+import gzip
+import os
+import time
+from typing import Iterator
+from redis import Redis
+from RedisPostman.MessageBroker import message_as_json
+
+
+class StreamArchiver:
+    """
+    Moves messages which fall out of the stream retention from Redis
+    to segment files on disk.
+
+    Each segment is a gzip-compressed text file with one "<stream id>\\t<message>"
+    line per message, named after the ids of its first and last messages:
+    <directory>/<channel>/<first id>_<last id>.seg.gz
+    The messages are trimmed from the stream only after the segment is written,
+    so nothing is lost if the archiver is stopped.
+    """
+
+    def __init__(self, redis_client: Redis, retention: dict[str, dict[str, float]], directory: str, segment_size: int = 100000) -> None:
+        """
+        :param redis_client: redis client
+        :param retention: retention of the channels, see stream_retention in config.py
+        :param directory: directory to store the segments in
+        :param segment_size: max number of messages in one segment
+        """
+        self.redis_client = redis_client
+        self.retention = retention
+        self.directory = directory
+        self.segment_size = segment_size
+
+    def archive_boundary(self, channel: str) -> str | None:
+        """
+        Returns id of the last message which falls out of the channel retention,
+        or None if there is nothing to archive.
+        """
+        retention = self.retention[channel]
+        if "maxlen" in retention:
+            n_to_archive = self.redis_client.xlen(channel) - int(retention["maxlen"])
+            if n_to_archive <= 0:
+                return None
+            # the last one of the n_to_archive oldest messages
+            entries = self.redis_client.xrange(channel, min="-", max="+", count=n_to_archive)
+            return entries[-1][0].decode()
+        if "max_age" in retention:
+            max_ms = int((time.time() - retention["max_age"]) * 1000)
+            return f"{max_ms - 1}-{2**64 - 1}"
+        return None
+
+    def archive_channel(self, channel: str) -> int:
+        """
+        Writes the messages of the channel which fall out of the retention
+        to segments and trims them from the stream.
+
+        :return: number of archived messages
+        """
+        boundary = self.archive_boundary(channel)
+        if boundary is None:
+            return 0
+        os.makedirs(os.path.join(self.directory, channel), exist_ok=True)
+
+        n_archived = 0
+        while True:
+            entries = self.redis_client.xrange(channel, min="-", max=boundary, count=self.segment_size)
+            if len(entries) == 0:
+                return n_archived
+            self.write_segment(channel, entries)
+            last_ms, last_seq = entries[-1][0].decode().split("-")
+            # minid removes all messages with smaller ids
+            self.redis_client.xtrim(channel, minid=f"{last_ms}-{int(last_seq) + 1}", approximate=False)
+            n_archived += len(entries)
+            if len(entries) < self.segment_size:
+                return n_archived
+
+    def write_segment(self, channel: str, entries: list) -> str:
+        first_id = entries[0][0].decode()
+        last_id = entries[-1][0].decode()
+        filename = os.path.join(self.directory, channel, f"{first_id}_{last_id}.seg.gz")
+        tmp_filename = filename + ".tmp"
+        with gzip.open(tmp_filename, "wt", encoding="utf-8") as f:
+            for stream_id, fields in entries:
+                if not b"message" in fields.keys():
+                    continue
+                # messages in other encodings are stored as JSON, so segments are readable without the serializers
+                f.write(f"{stream_id.decode()}\t{message_as_json(fields)}\n")
+        # the segment appears only when it is complete
+        os.replace(tmp_filename, filename)
+        return filename
+
+    def export_channel(self, channel: str, min_id: str = "-", max_id: str = "+") -> int:
+        """
+        Writes the messages of the channel between min_id and max_id to segments
+        without trimming the stream, e.g. to replay a recording offline.
+
+        :return: number of exported messages
+        """
+        os.makedirs(os.path.join(self.directory, channel), exist_ok=True)
+        n_exported = 0
+        while True:
+            entries = self.redis_client.xrange(channel, min=min_id, max=max_id, count=self.segment_size)
+            if len(entries) == 0:
+                return n_exported
+            self.write_segment(channel, entries)
+            n_exported += len(entries)
+            if len(entries) < self.segment_size:
+                return n_exported
+            # exclusive range, continue after the last exported message
+            min_id = "(" + entries[-1][0].decode()
+
+    def archive(self) -> dict[str, int]:
+        """
+        Archives all channels with retention.
+
+        :return: number of archived messages for each channel
+        """
+        return {channel: self.archive_channel(channel) for channel in self.retention}
+
+
+def segment_sort_key(filename: str) -> tuple[int, int]:
+    first_id = filename.split("_")[0]
+    ms, seq = first_id.split("-")
+    return int(ms), int(seq)
+
+
+def read_segments(directory: str, channel: str) -> Iterator[tuple[str, str]]:
+    """
+    Yields (stream id, message) of all archived messages of the channel in order.
+    """
+    channel_directory = os.path.join(directory, channel)
+    if not os.path.isdir(channel_directory):
+        return
+    filenames = [f for f in os.listdir(channel_directory) if f.endswith(".seg.gz")]
+    for filename in sorted(filenames, key=segment_sort_key):
+        with gzip.open(os.path.join(channel_directory, filename), "rt", encoding="utf-8") as f:
+            for line in f:
+                stream_id, message = line.rstrip("\n").split("\t", 1)
+                yield stream_id, message
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
-from typing import Any, Dict
-from config import acc_coefficients_str, acc_offsets_str, gyro_coefficients_str, gyro_offsets_str, imu_1_name, imu_2_name
+from itertools import chain
+from operator import itemgetter
+from typing import Any, ClassVar, Dict
+from config import acc_bias_str, acc_coefficients_str, acc_matrix_str, acc_offsets_str, gyro_coefficients_str, gyro_offsets_str, imu_1_name, imu_2_name, timestamp_key
 import numpy as np
 import json
 from datetime import datetime
@@ -20,6 +22,21 @@ class Message(abc.ABC):
         pass
 
 
+class BatchMessage(Message):
+    """
+    Message which can be read in batches, see AsyncRedisWorker.subscribe_batch.
+    """
+
+    @classmethod
+    @abc.abstractmethod
+    def batch_from_dicts(cls, data: list[dict[str, Any]], imu_names: list[str] | None = None) -> np.ndarray:
+        """
+        Deserialize list of messages into one structured array,
+        one row per message, with only the fields of imu_names (all IMUs by default).
+        """
+        pass
+
+
 @dataclass
 class IMUData:
     acc: np.ndarray
@@ -30,9 +47,15 @@ class IMU9250Data(IMUData):
     mag: np.ndarray
 
 @dataclass
-class IMUMessage(Message):
+class IMUMessage(BatchMessage):
     imu_1: IMUData
     imu_2: IMUData
+    # sample time in seconds of a monotonic clock, None if the message has no timestamp
+    t: float | None = None
+
+    imu_names = ["imu_1", "imu_2"]
+    sensor_names = ["acc", "gyr"]
+    axes = ["x", "y", "z"]
 
     @classmethod
     def from_dict(cls, data: dict[str, float]):
@@ -64,7 +87,43 @@ class IMUMessage(Message):
                 float(data["imu_2_gyr z"]),
             ]),
         )
-        return cls(imu_1=imu_1, imu_2=imu_2)
+        return cls(imu_1=imu_1, imu_2=imu_2, t=cls.timestamp_from_dict(data))
+
+    @staticmethod
+    def timestamp_from_dict(data: dict[str, Any]) -> float | None:
+        t = data.get(timestamp_key)
+        return float(t) if t is not None else None
+
+    @staticmethod
+    def timestamps_from_dicts(data: list[dict[str, Any]]) -> np.ndarray:
+        """
+        (N,) timestamps of the messages, NaN for messages without timestamp.
+        """
+        return np.fromiter((d.get(timestamp_key, np.nan) for d in data), dtype=float, count=len(data))
+
+    @classmethod
+    def batch_dtype(cls, imu_names: list[str] | None = None) -> np.dtype:
+        """
+        dtype of the batch, for every imu (all imu_names by default) a (3,) float field for every sensor,
+        and the timestamp field (NaN if the message has no timestamp).
+        """
+        if imu_names is None:
+            imu_names = cls.imu_names
+        return np.dtype([(imu, [(sensor, float, (3,)) for sensor in cls.sensor_names]) for imu in imu_names] + [(timestamp_key, float)])
+
+    @classmethod
+    def batch_from_dicts(cls, data: list[dict[str, Any]], imu_names: list[str] | None = None) -> np.ndarray:
+        """
+        Deserialize list of messages into a structured array of batch_dtype,
+        reads only the fields of imu_names (all IMUs by default).
+        """
+        if imu_names is None:
+            imu_names = cls.imu_names
+        keys = [f"{imu}_{sensor} {axis}" for imu in imu_names for sensor in cls.sensor_names for axis in cls.axes]
+        values = np.empty((len(data), len(keys) + 1), dtype=float)
+        values[:, :-1] = np.array([[float(d[key]) for key in keys] for d in data], dtype=float).reshape(len(data), len(keys))
+        values[:, -1] = cls.timestamps_from_dicts(data)
+        return values.view(cls.batch_dtype(imu_names)).reshape(len(data))
 
     def to_dict(self):
         data = {}
@@ -85,13 +144,83 @@ class IMUMessage(Message):
         data["imu_2_gyr y"] = self.imu_2.gyr[1]
         data["imu_2_gyr z"] = self.imu_2.gyr[2]
 
+        if self.t is not None:
+            data[timestamp_key] = self.t
+
         return data
 
 
+class ColumnarCodec:
+    """
+    Converts lists of nested JSON payloads ({imu: {key: value}})
+    to (N, imus, sensors, 3) float blocks and back.
+
+    The field map (which payload key goes to which cell of the block)
+    is compiled once into itemgetters, so a payload is read with one call
+    per IMU instead of a dict lookup and a float() per value, and into
+    one function building a payload from a row of the block.
+    """
+
+    def __init__(self, imu_names: list[str], sensor_keys: dict[str, list[str]]) -> None:
+        """
+        :param imu_names: keys of the IMUs in the payload, the order of the block axis 1
+        :param sensor_keys: keys of the sensor axes in the payload of one IMU, the order of the block axes 2, 3
+        """
+        self.imu_names = imu_names
+        self.keys: list[str] = [key for sensor in sensor_keys for key in sensor_keys[sensor]]
+        self.shape = (len(imu_names), len(sensor_keys), 3)
+        self.__imu_getter__ = itemgetter(*imu_names)
+        self.__keys_getter__ = itemgetter(*self.keys)
+        self.__row_size__ = len(imu_names) * len(self.keys)
+        # the field map for encoding is compiled once into a function returning nested dict displays,
+        # the way dataclasses generate __init__: no zip, dict() call or loop per IMU for every payload
+        cells = iter(range(self.__row_size__))
+        layout = ", ".join(f"{imu!r}: {{" + ", ".join(f"{key!r}: row[{next(cells)}]" for key in self.keys) + "}" for imu in imu_names)
+        self.__make_payload__ = eval(f"lambda row: {{{layout}}}")
+
+    def decode(self, payloads: list[dict[str, Any]], out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Decodes payloads into one block.
+
+        :param payloads: list of N payloads
+        :param out: preallocated array of at least N rows to decode into
+        :return: (N, imus, sensors, 3) float array
+        """
+        n = len(payloads)
+        if out is None:
+            out = np.empty((n, *self.shape), dtype=float)
+        else:
+            out = out[:n]
+        if n == 0:
+            return out
+        keys_getter = self.__keys_getter__
+        imu_getter = self.__imu_getter__
+        if len(self.imu_names) == 1:
+            values = chain.from_iterable(keys_getter(imu_getter(payload)) for payload in payloads)
+        else:
+            values = chain.from_iterable(keys_getter(imu) for payload in payloads for imu in imu_getter(payload))
+        out.reshape(n, self.__row_size__)[:] = np.fromiter(values, dtype=float, count=n * self.__row_size__).reshape(n, self.__row_size__)
+        return out
+
+    def encode(self, block: np.ndarray) -> list[dict[str, Any]]:
+        """
+        Encodes (N, imus, sensors, 3) block into a list of payloads.
+        """
+        rows = block.reshape(block.shape[0], self.__row_size__).tolist()
+        return list(map(self.__make_payload__, rows))
+
 @dataclass
 class IMU9250Message(IMUMessage):
     imu_1 : IMU9250Data
     imu_2 : IMU9250Data
+    t: float | None = None
+
+    sensor_names = ["acc", "gyr", "mag"]
+    # keys of the sensor axes in the JSON message
+    sensor_keys = {"acc": ["AcX", "AcY", "AcZ"], "gyr": ["GyX", "GyY", "GyZ"], "mag": ["MaX", "MaY", "MaZ"]}
+    codec = ColumnarCodec(IMUMessage.imu_names, sensor_keys)
+    # codecs of IMU subsets, see batch_from_dicts
+    __subset_codecs__: ClassVar[dict[tuple[str, ...], ColumnarCodec]] = {}
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]):
@@ -136,7 +265,38 @@ class IMU9250Message(IMUMessage):
                 float(imu_d2["MaZ"])
             ]),
         )
-        return cls(imu_1=imu_1, imu_2=imu_2)
+        return cls(imu_1=imu_1, imu_2=imu_2, t=cls.timestamp_from_dict(data))
+
+    @classmethod
+    def block_from_dicts(cls, data: list[dict[str, Any]], out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Deserialize list of messages into (N, imus, sensors, 3) float array,
+        sensors are in the order of sensor_names.
+        """
+        return cls.codec.decode(data, out=out)
+
+    @classmethod
+    def block_to_dicts(cls, block: np.ndarray) -> list[dict[str, Any]]:
+        """
+        Serialize (N, imus, sensors, 3) float array into list of messages.
+        """
+        return cls.codec.encode(block)
+
+    @classmethod
+    def batch_from_dicts(cls, data: list[dict[str, Any]], imu_names: list[str] | None = None) -> np.ndarray:
+        if imu_names is None or imu_names == cls.imu_names:
+            imu_names = cls.imu_names
+            codec = cls.codec
+        else:
+            key = tuple(imu_names)
+            if key not in cls.__subset_codecs__:
+                cls.__subset_codecs__[key] = ColumnarCodec(imu_names, cls.sensor_keys)
+            codec = cls.__subset_codecs__[key]
+        n_values = len(imu_names) * len(cls.sensor_names) * 3
+        values = np.empty((len(data), n_values + 1), dtype=float)
+        values[:, :-1] = codec.decode(data).reshape(len(data), n_values)
+        values[:, -1] = cls.timestamps_from_dicts(data)
+        return values.view(cls.batch_dtype(imu_names)).reshape(len(data))
 
     def to_dict(self):
         data = {"imu_1": {}, "imu_2": {}}
@@ -164,7 +324,10 @@ class IMU9250Message(IMUMessage):
         data["imu_2"]["MaX"] = self.imu_2.mag[0]
         data["imu_2"]["MaY"] = self.imu_2.mag[1]
         data["imu_2"]["MaZ"] = self.imu_2.mag[2]
-    
+
+        if self.t is not None:
+            data[timestamp_key] = self.t
+
         return data
 
 
@@ -174,9 +337,10 @@ class Quaternion:
 
 
 @dataclass
-class MadgwickMessage(Message):
+class MadgwickMessage(BatchMessage):
     imu_1: Quaternion
     imu_2: Quaternion
+    imu_names = [imu_1_name, imu_2_name]
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]):
@@ -187,6 +351,19 @@ class MadgwickMessage(Message):
                            for i in data[imu_2_name]]))
         return cls(imu_1=imu_1, imu_2=imu_2)
 
+    @classmethod
+    def batch_dtype(cls, imu_names: list[str] | None = None) -> np.dtype:
+        if imu_names is None:
+            imu_names = cls.imu_names
+        return np.dtype([(imu, float, (4,)) for imu in imu_names])
+
+    @classmethod
+    def batch_from_dicts(cls, data: list[dict[str, Any]], imu_names: list[str] | None = None) -> np.ndarray:
+        if imu_names is None:
+            imu_names = cls.imu_names
+        values = np.array([[d[imu] for imu in imu_names] for d in data], dtype=float).reshape(len(data), 4 * len(imu_names))
+        return values.view(cls.batch_dtype(imu_names)).reshape(len(data))
+
     def to_dict(self) -> dict:
         raise Exception("Not implemented")
 
@@ -195,6 +372,53 @@ class MadgwickMessage(Message):
 class IMUCalibrationData:
     offset: np.ndarray
     coeffs: np.ndarray
+    # (3, 3) correction matrix, replaces coeffs when set
+    matrix: np.ndarray | None = None
+
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        """
+        Calibrates (..., 3) data: (data - offset) * coeffs, or matrix @ (data - offset).
+        """
+        if self.matrix is not None:
+            return (data - self.offset) @ self.matrix.T
+        return (data - self.offset) * self.coeffs
+
+    def correction_matrix(self) -> np.ndarray:
+        """
+        (3, 3) matrix of apply, diagonal for the per-axis coefficients.
+        """
+        return self.matrix if self.matrix is not None else np.diag(np.asarray(self.coeffs, dtype=float))
+
+
+@dataclass
+class BlockCoefficients:
+    """
+    Calibration coefficients of the IMUs stacked for (N, imus, sensors, 3) blocks of ColumnarCodec.
+    The accelerometer and the gyroscope of an IMU are corrected with one 6x6 block-diagonal matrix,
+    so a block is calibrated with one batched matrix product whatever the number of IMUs.
+    """
+    # (imus, 6, 6) transposed correction of the (acc, gyr) row of each IMU
+    matrix: np.ndarray
+    # (imus, 6) added after the product, -offset @ matrix
+    shift: np.ndarray
+    # (imus,) IMUs with the normalized accelerometer data, the ones without the ellipsoid fit matrix
+    acc_normalize: np.ndarray
+    version: int = 0
+
+    def apply(self, block: np.ndarray) -> np.ndarray:
+        """
+        Calibrates the accelerometer and gyroscope data of the block in place,
+        the sensors in the order of IMU9250Message.sensor_names (acc, gyr, ...).
+        """
+        n, imus = block.shape[:2]
+        rows = block[:, :, :2].reshape(n, imus, 6).transpose(1, 0, 2)
+        calibrated = np.matmul(rows, self.matrix)
+        calibrated += self.shift[:, None]
+        block[:, :, :2] = calibrated.transpose(1, 0, 2).reshape(n, imus, 2, 3)
+        if self.acc_normalize.any():
+            acc = block[:, self.acc_normalize, 0]
+            block[:, self.acc_normalize, 0] = acc / np.linalg.norm(acc, axis=-1, keepdims=True)
+        return block
 
 
 @dataclass
@@ -212,6 +436,8 @@ class IMUCoefficients:
         Calibration data for IMU 2 accelerometer.
     imu_2_gyr : IMUCalibrationData
         Calibration data for IMU 2 gyroscope.
+    version : int
+        Version of the calibration set in RedisPostman.CalibrationStore, 0 if it was read from the file.
 
     Methods:
     --------
@@ -224,6 +450,20 @@ class IMUCoefficients:
 
     imu_2_acc: IMUCalibrationData
     imu_2_gyr: IMUCalibrationData
+    # version of the calibration set in the calibration store, 0 - read from the file
+    version: int = 0
+
+    @staticmethod
+    def acc_calibration(imu_data: dict) -> IMUCalibrationData:
+        """
+        Accelerometer calibration of one IMU, the ellipsoid fit correction matrix and bias when the IMU has them.
+        """
+        if acc_matrix_str in imu_data:
+            return IMUCalibrationData(offset=np.array(imu_data[acc_bias_str], dtype=float),
+                                      coeffs=np.diag(np.array(imu_data[acc_matrix_str], dtype=float)),
+                                      matrix=np.array(imu_data[acc_matrix_str], dtype=float))
+        return IMUCalibrationData(offset=np.array(imu_data[acc_offsets_str]),
+                                  coeffs=np.array(imu_data[acc_coefficients_str]))
 
     @classmethod
     def read_from_file(cls, coeff_dict_filename: str) -> "IMUCoefficients":
@@ -245,7 +485,13 @@ class IMUCoefficients:
         calib_data_s: str = json.load(file)
         file.close()
 
-        calib_data: dict = json.loads(calib_data_s)
+        return cls.from_dict(json.loads(calib_data_s))
+
+    @classmethod
+    def from_dict(cls, calib_data: dict, version: int = 0) -> "IMUCoefficients":
+        """
+        Calibration coefficients from a dict in the layout of the calibration file, missing ones get the defaults.
+        """
         for imu_n in ["imu_1", "imu_2"]:
             if acc_coefficients_str not in calib_data[imu_n].keys():
                 calib_data[imu_n][acc_coefficients_str] = [1, 1, 1]
@@ -256,15 +502,40 @@ class IMUCoefficients:
             if gyro_offsets_str not in calib_data[imu_n].keys():
                 calib_data[imu_n][gyro_offsets_str] = [0, 0, 0]
             print("gyr offsets:", calib_data[imu_n][gyro_offsets_str])
-        imu_1_acc = IMUCalibrationData(offset=np.array(calib_data["imu_1"][acc_offsets_str]),
-                                       coeffs=np.array(calib_data["imu_1"][acc_coefficients_str]))
-        imu_2_acc = IMUCalibrationData(offset=np.array(calib_data["imu_2"][acc_offsets_str]),
-                                       coeffs=np.array(calib_data["imu_2"][acc_coefficients_str]))
+        imu_1_acc = cls.acc_calibration(calib_data["imu_1"])
+        imu_2_acc = cls.acc_calibration(calib_data["imu_2"])
         imu_1_gyr = IMUCalibrationData(offset=np.array(calib_data["imu_1"][gyro_offsets_str]),
                                        coeffs=np.array(calib_data["imu_1"][gyro_coefficients_str]))
         imu_2_gyr = IMUCalibrationData(offset=np.array(calib_data["imu_2"][gyro_offsets_str]),
                                        coeffs=np.array(calib_data["imu_2"][gyro_coefficients_str]))
-        return cls(imu_1_acc=imu_1_acc, imu_2_acc=imu_2_acc, imu_1_gyr=imu_1_gyr, imu_2_gyr=imu_2_gyr)
+        return cls(imu_1_acc=imu_1_acc, imu_2_acc=imu_2_acc, imu_1_gyr=imu_1_gyr, imu_2_gyr=imu_2_gyr, version=version)
+
+    def stack(self) -> BlockCoefficients:
+        """
+        Coefficients of the IMUs in the order of IMUMessage.imu_names for the blocks.
+        """
+        imus = [(self.imu_1_acc, self.imu_1_gyr), (self.imu_2_acc, self.imu_2_gyr)]
+        matrix = np.zeros((len(imus), 6, 6))
+        offset = np.empty((len(imus), 6))
+        for i, (acc, gyr) in enumerate(imus):
+            matrix[i, :3, :3] = acc.correction_matrix().T
+            matrix[i, 3:, 3:] = gyr.correction_matrix().T
+            offset[i] = np.concatenate([np.broadcast_to(acc.offset, 3), np.broadcast_to(gyr.offset, 3)])
+        return BlockCoefficients(matrix=matrix, shift=-np.einsum("ij,ijk->ik", offset, matrix),
+                                 acc_normalize=np.array([acc.matrix is None for acc, _ in imus]), version=self.version)
+
+    def to_dict(self) -> dict:
+        """
+        Coefficients in the layout of the calibration file.
+        """
+        calib_data: dict = {}
+        for imu_n, acc, gyr in (("imu_1", self.imu_1_acc, self.imu_1_gyr), ("imu_2", self.imu_2_acc, self.imu_2_gyr)):
+            calib_data[imu_n] = {acc_offsets_str: acc.offset.tolist(), acc_coefficients_str: acc.coeffs.tolist(),
+                                 gyro_offsets_str: gyr.offset.tolist(), gyro_coefficients_str: gyr.coeffs.tolist()}
+            if acc.matrix is not None:
+                calib_data[imu_n][acc_matrix_str] = acc.matrix.tolist()
+                calib_data[imu_n][acc_bias_str] = acc.offset.tolist()
+        return calib_data
 
 
 def dump_clean(obj, s="") -> str:
@@ -326,3 +597,108 @@ class LogMessage(Message):
 
     def __str__(self) -> str:
         return f'{self.date}\t{self.process_name}' + dump_clean(self.status)
+
+
+class Serializer(abc.ABC):
+    """
+    Converts message payloads (dicts returned by Message.to_dict) to bytes and back.
+    The name of the serializer is stored in the stream next to the message,
+    so consumers can decode messages of any encoding.
+    """
+    name: str
+
+    @abc.abstractmethod
+    def dumps(self, data: dict[str, Any]) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def loads(self, data: bytes) -> dict[str, Any]:
+        pass
+
+
+class JSONSerializer(Serializer):
+    """
+    Default encoding, the only one understood by the consumers
+    which read the message field directly.
+    """
+    name = "json"
+
+    def dumps(self, data: dict[str, Any]) -> bytes:
+        return json.dumps(data).encode()
+
+    def loads(self, data: bytes) -> dict[str, Any]:
+        return json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    Compact binary encoding of any payload. Floats stay float64: float32 would round the
+    timestamp (seconds of a monotonic clock) to tens of milliseconds, coarser than the sample period.
+    Requires msgpack package.
+    """
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        import msgpack  # type:ignore
+        self.msgpack = msgpack
+
+    @staticmethod
+    def __to_builtin__(obj: Any) -> Any:
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"Can not serialize {type(obj)}")
+
+    def dumps(self, data: dict[str, Any]) -> bytes:
+        return self.msgpack.packb(data, default=self.__to_builtin__)
+
+    def loads(self, data: bytes) -> dict[str, Any]:
+        return self.msgpack.unpackb(data)
+
+
+class Float32Serializer(Serializer):
+    """
+    Packs the values of the payload as little-endian float32 array
+    in the order of the codec field map. The keys are not stored,
+    so only payloads with the codec layout (IMU9250Message) are supported.
+    The timestamp, if any, follows as little-endian float64, float32 is too coarse for it.
+    """
+    name = "f32"
+
+    def __init__(self, codec: ColumnarCodec) -> None:
+        self.codec = codec
+        self.__size__ = int(np.prod(codec.shape)) * 4
+
+    def dumps(self, data: dict[str, Any]) -> bytes:
+        values = self.codec.decode([data]).astype("<f4").tobytes()
+        t = data.get(timestamp_key)
+        if t is not None:
+            values += np.array([t], dtype="<f8").tobytes()
+        return values
+
+    def loads(self, data: bytes) -> dict[str, Any]:
+        block = np.frombuffer(data, dtype="<f4", count=self.__size__ // 4).reshape(1, *self.codec.shape).astype(float)
+        payload = self.codec.encode(block)[0]
+        if len(data) > self.__size__:
+            payload[timestamp_key] = float(np.frombuffer(data, dtype="<f8", offset=self.__size__)[0])
+        return payload
+
+
+serializer_classes: dict[str, Any] = {
+    JSONSerializer.name: JSONSerializer,
+    MsgpackSerializer.name: MsgpackSerializer,
+    Float32Serializer.name: lambda: Float32Serializer(IMU9250Message.codec),
+}
+__serializers__: dict[str, Serializer] = {}
+
+
+def get_serializer(name: str) -> Serializer:
+    """
+    Returns serializer by the name stored in the stream.
+    """
+    if name not in __serializers__:
+        if name not in serializer_classes:
+            raise ValueError(f"Unknown message encoding {name}")
+        __serializers__[name] = serializer_classes[name]()
+    return __serializers__[name]
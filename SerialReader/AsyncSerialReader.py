@@ -0,0 +1,115 @@
+import asyncio
+from typing import AsyncIterator
+import serial  # type:ignore
+import numpy as np
+from SerialReader.RingBuffer import RingBuffer
+from SerialReader.BinaryFrames import BinaryFrameDecoder
+
+
+class SerialFrameProtocol(asyncio.Protocol):
+    """
+    asyncio protocol which stores bytes received from the serial port
+    in a RingBuffer and wakes up the reader.
+    """
+
+    def __init__(self, ring_buffer: RingBuffer) -> None:
+        self.ring_buffer = ring_buffer
+        self.data_ready = asyncio.Event()
+        self.closed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data: bytes) -> None:
+        self.ring_buffer.write(data)
+        self.data_ready.set()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if not self.closed.done():
+            if exc is None:
+                self.closed.set_result(None)
+            else:
+                self.closed.set_exception(exc)
+        self.data_ready.set()
+
+
+class AsyncSerialReader:
+    """
+    Reads the serial port from the asyncio event loop without blocking it.
+
+    The tty file descriptor is registered in the event loop as a read pipe,
+    so the loop is woken up only when the driver has new bytes.
+    Received bytes go to a RingBuffer, which splits them into frames.
+
+    Usage:
+        reader = await AsyncSerialReader.open("/dev/ttyUSB0", 115200)
+        async for frame in reader.frames():
+            ...
+    """
+
+    def __init__(self, serial_port: serial.Serial, buffer_size: int = 1 << 16, delimiter: bytes = b"\n") -> None:
+        """
+        :param serial_port: opened serial port
+        :param buffer_size: size of the ring buffer in bytes
+        :param delimiter: byte which terminates a frame
+        """
+        self.serial_port = serial_port
+        self.ring_buffer = RingBuffer(capacity=buffer_size, delimiter=delimiter)
+        self.transport: asyncio.ReadTransport | None = None
+        self.protocol: SerialFrameProtocol | None = None
+
+    @classmethod
+    async def open(cls, port: str, baudrate: int, buffer_size: int = 1 << 16, delimiter: bytes = b"\n") -> "AsyncSerialReader":
+        """
+        Opens the serial port and connects it to the running event loop.
+        """
+        serial_port = serial.Serial(port=port, baudrate=baudrate, timeout=0)
+        reader = cls(serial_port, buffer_size=buffer_size, delimiter=delimiter)
+        await reader.connect()
+        return reader
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.protocol = SerialFrameProtocol(self.ring_buffer)
+        self.transport, _ = await loop.connect_read_pipe(lambda: self.protocol, self.serial_port)
+
+    async def wait_for_data(self) -> None:
+        """
+        Waits until new bytes are received or the port is closed.
+        Raises the error the port was closed with.
+        """
+        assert self.protocol is not None, "reader is not connected"
+        await self.protocol.data_ready.wait()
+        self.protocol.data_ready.clear()
+        if self.protocol.closed.done():
+            # raises the exception if the port was lost
+            self.protocol.closed.result()
+            raise ConnectionError(f"Serial port {self.serial_port.name} is closed")
+
+    async def frames(self) -> AsyncIterator[list[bytes]]:
+        """
+        Yields lists of complete frames, all frames received since the previous yield.
+        """
+        while True:
+            frames = self.ring_buffer.frames()
+            if len(frames) > 0:
+                yield frames
+            else:
+                await self.wait_for_data()
+
+    async def records(self, decoder: BinaryFrameDecoder) -> AsyncIterator[np.ndarray]:
+        """
+        Yields structured arrays of payloads of all binary frames
+        received since the previous yield.
+        """
+        while True:
+            records, consumed = decoder.decode(self.ring_buffer.peek())
+            self.ring_buffer.consume(consumed)
+            if records.shape[0] > 0:
+                yield records
+            else:
+                await self.wait_for_data()
+
+    def close(self) -> None:
+        if self.transport is not None:
+            # closes the serial port too
+            self.transport.close()
+        else:
+            self.serial_port.close()
@@ -0,0 +1,228 @@
+"""
+Binary fixed-width frame protocol for the serial IMU stream.
+
+Every frame has the same size and consists of:
+- sync word, uint16 little-endian, marks the start of the frame;
+- sequence number, uint16, incremented by the sender on every frame, used to count lost frames;
+- payload, little-endian int16 or float32 fields in the order of the headers from config.py;
+- CRC-16/CCITT-FALSE, uint16, computed over sequence number and payload.
+
+Frames are decoded in bulk: all frames of a read chunk are located and checked
+with numpy operations, then viewed as one structured array via numpy.frombuffer.
+"""
+from typing import Any
+import numpy as np
+from config import esp_headers, mpu9250_headers, imu_1_name, imu_2_name
+
+
+SYNC_WORD = 0xA55A
+
+
+def __make_crc16_table__() -> np.ndarray:
+    table = np.zeros(256, dtype=np.uint16)
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table[byte] = crc
+    return table
+
+
+CRC16_TABLE = __make_crc16_table__()
+
+
+def crc16(frames: np.ndarray) -> np.ndarray:
+    """
+    Computes CRC-16/CCITT-FALSE of every row of the (N, L) uint8 array.
+    The loop goes over the L bytes of the frame, all N frames are processed at once.
+    """
+    crc = np.full(frames.shape[0], 0xFFFF, dtype=np.uint16)
+    for j in range(frames.shape[1]):
+        idx = ((crc >> 8) ^ frames[:, j]) & 0xFF
+        crc = (crc << 8) ^ CRC16_TABLE[idx]
+    return crc
+
+
+def esp_payload_dtype(imu_names: list[str] = [imu_1_name, imu_2_name], headers: list[str] = esp_headers, field_type: str = "<i2") -> np.dtype:
+    """
+    Payload with one block of esp_headers fields per IMU,
+    decoded records have the IMU9250Message layout.
+    """
+    return np.dtype([(imu_name, [(header, field_type) for header in headers]) for imu_name in imu_names])
+
+
+def mpu9250_payload_dtype(headers: list[str] = mpu9250_headers, field_type: str = "<i2") -> np.dtype:
+    """
+    Flat payload in the order of mpu9250_headers.
+    """
+    return np.dtype([(header, field_type) for header in headers])
+
+
+def frame_dtype(payload_dtype: np.dtype) -> np.dtype:
+    return np.dtype([("sync", "<u2"), ("seq", "<u2"), ("payload", payload_dtype), ("crc", "<u2")])
+
+
+def records_to_dicts(records: np.ndarray) -> list[dict[str, Any]]:
+    """
+    Converts structured array of payloads to the list of (nested) dicts
+    with the same keys as the JSON messages.
+    """
+    names = records.dtype.names
+    assert names is not None
+    columns = []
+    for name in names:
+        if records.dtype[name].names is not None:
+            columns.append(records_to_dicts(records[name]))
+        else:
+            columns.append(records[name].tolist())
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def records_to_block(records: np.ndarray, imu_names: list[str], sensor_keys: dict[str, list[str]]) -> np.ndarray:
+    """
+    Converts structured array of payloads to (N, imus, sensors, 3) float block
+    in the layout of ColumnarCodec, the fields missing in sensor_keys (Tmp) are dropped.
+    """
+    keys = [key for sensor in sensor_keys for key in sensor_keys[sensor]]
+    block = np.empty((records.shape[0], len(imu_names), len(keys)))
+    for i, imu_name in enumerate(imu_names):
+        for j, key in enumerate(keys):
+            block[:, i, j] = records[imu_name][key]
+    return block.reshape(records.shape[0], len(imu_names), len(sensor_keys), 3)
+
+
+def encode_frames(payloads: np.ndarray, first_seq: int = 0) -> bytes:
+    """
+    Packs structured array of payloads into frames.
+    Used to emulate the sensor board.
+    """
+    frames = np.zeros(payloads.shape[0], dtype=frame_dtype(payloads.dtype))
+    frames["sync"] = SYNC_WORD
+    frames["seq"] = (first_seq + np.arange(payloads.shape[0])) & 0xFFFF
+    frames["payload"] = payloads
+    raw = frames.view(np.uint8).reshape(payloads.shape[0], -1)
+    frames["crc"] = crc16(raw[:, 2:-2])
+    return frames.tobytes()
+
+
+class BinaryFrameDecoder:
+    """
+    Decodes chunks of the serial stream into structured arrays of payloads.
+
+    Attributes:
+    frame_dtype (np.dtype): dtype of the whole frame
+    frame_size (int): size of the frame in bytes
+    n_frames (int): number of decoded frames
+    lost_frames (int): number of frames missed according to the sequence numbers
+    crc_errors (int): number of frames rejected by the CRC check
+    frame_index (np.ndarray): sequence numbers of the last decoded frames without the uint16 wrap-around,
+        counted from the first decoded frame, so frame_index * sample period is the device time
+    """
+
+    def __init__(self, payload_dtype: np.dtype, sync_word: int = SYNC_WORD) -> None:
+        self.frame_dtype = frame_dtype(payload_dtype)
+        self.frame_size = self.frame_dtype.itemsize
+        self.sync_bytes = np.frombuffer(int(sync_word).to_bytes(2, "little"), dtype=np.uint8)
+        self.n_frames = 0
+        self.lost_frames = 0
+        self.crc_errors = 0
+        self.__last_seq__: int | None = None
+        self.frame_index = np.zeros(0, dtype=np.int64)
+        self.__frame_counter__ = -1
+        self.__offsets__ = np.arange(self.frame_size)
+
+    def decode(self, data: bytes) -> tuple[np.ndarray, int]:
+        """
+        Decodes all complete frames of the chunk.
+
+        :param data: bytes received from the serial port
+        :return: structured array of payloads and number of bytes of the chunk
+            which were processed, the rest has to be passed again with the next chunk
+        """
+        size = self.frame_size
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        n = buffer.shape[0]
+        if n < 2:
+            return np.zeros(0, dtype=self.frame_dtype["payload"]), 0
+
+        starts = np.flatnonzero((buffer[:-1] == self.sync_bytes[0]) & (buffer[1:] == self.sync_bytes[1]))
+        complete = starts[starts + size <= n]
+        incomplete = starts[starts + size > n]
+
+        frames = buffer[complete[:, None] + self.__offsets__]
+        crc = frames[:, -2].astype(np.uint16) | (frames[:, -1].astype(np.uint16) << 8)
+        valid = crc16(frames[:, 2:-2]) == crc
+        # sync word may appear inside of the payload of a valid frame,
+        # skip candidates overlapping the last accepted frame
+        valid_starts = self.__non_overlapping__(complete[valid])
+        self.__count_crc_errors__(complete[~valid], valid_starts)
+
+        # everything before the first incomplete frame is processed,
+        # keep the last byte, it can be the first byte of the sync word
+        consumed = int(incomplete[0]) if incomplete.shape[0] > 0 else n - 1
+        if valid_starts.shape[0] > 0:
+            consumed = max(consumed, int(valid_starts[-1]) + size)
+
+        if valid_starts.shape[0] == 0:
+            return np.zeros(0, dtype=self.frame_dtype["payload"]), consumed
+
+        if valid_starts[-1] - valid_starts[0] == (valid_starts.shape[0] - 1) * size:
+            # frames are contiguous, view them without copying
+            records = np.frombuffer(data, dtype=self.frame_dtype, count=valid_starts.shape[0], offset=int(valid_starts[0]))
+        else:
+            records = np.frombuffer(buffer[valid_starts[:, None] + self.__offsets__].tobytes(), dtype=self.frame_dtype)
+
+        unique = self.__count_lost_frames__(records["seq"])
+        if not unique.all():
+            records = records[unique]
+        self.n_frames += records.shape[0]
+        return records["payload"], consumed
+
+    def __non_overlapping__(self, starts: np.ndarray) -> np.ndarray:
+        """
+        Keeps the frame starts which do not overlap the last accepted frame, in order.
+        """
+        size = self.frame_size
+        if starts.shape[0] < 2 or np.all(np.diff(starts) >= size):
+            return starts
+        accepted = []
+        end = -1
+        for start in starts.tolist():
+            if start >= end:
+                accepted.append(start)
+                end = start + size
+        return np.array(accepted, dtype=starts.dtype)
+
+    def __count_crc_errors__(self, invalid_starts: np.ndarray, valid_starts: np.ndarray) -> None:
+        """
+        Counts rejected candidates, except sync words found inside of valid frames.
+        """
+        if valid_starts.shape[0] > 0:
+            idx = np.searchsorted(valid_starts, invalid_starts, side="right") - 1
+            inside = (idx >= 0) & (invalid_starts < valid_starts[np.maximum(idx, 0)] + self.frame_size)
+            invalid_starts = invalid_starts[~inside]
+        self.crc_errors += int(invalid_starts.shape[0])
+
+    def __count_lost_frames__(self, seq: np.ndarray) -> np.ndarray:
+        """
+        Counts the frames missed between the sequence numbers and sets frame_index of the unique frames.
+        A repeated sequence number (step 0) is a duplicate of the previous frame, it is neither lost nor kept.
+
+        :return: (N,) bool mask of the frames which are not duplicates
+        """
+        seq = seq.astype(np.int64)
+        prev = self.__last_seq__ if self.__last_seq__ is not None else seq[0] - 1
+        steps = np.diff(seq, prepend=prev) % 0x10000
+        unique = steps != 0
+        steps = steps[unique]
+        self.__last_seq__ = int(seq[-1])
+        if steps.shape[0] == 0:
+            self.frame_index = np.zeros(0, dtype=np.int64)
+            return unique
+        self.lost_frames += int((steps - 1).sum())
+        self.frame_index = self.__frame_counter__ + np.cumsum(steps)
+        self.__frame_counter__ = int(self.frame_index[-1])
+        return unique
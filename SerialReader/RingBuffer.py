@@ -0,0 +1,117 @@
+class RingBuffer:
+    """
+    Fixed-size byte ring buffer used to frame the serial stream.
+
+    Bytes are written by the serial transport as they arrive and complete
+    frames are read out by the consumer. The storage is allocated once,
+    so no memory is moved or reallocated while streaming. If the consumer
+    falls behind and the buffer is full, the oldest bytes are dropped
+    and counted in overruns.
+    """
+
+    def __init__(self, capacity: int = 1 << 16, delimiter: bytes = b"\n") -> None:
+        """
+        :param capacity: size of the buffer in bytes
+        :param delimiter: single byte which terminates a line frame
+        """
+        assert len(delimiter) == 1, "delimiter has to be a single byte"
+        self.capacity = capacity
+        self.delimiter = delimiter
+        self.overruns = 0
+        self.__buffer__ = bytearray(capacity)
+        self.__head__ = 0
+        self.__size__ = 0
+        # number of bytes after the head already searched for the delimiter
+        self.__scanned__ = 0
+
+    def __len__(self) -> int:
+        return self.__size__
+
+    def write(self, data: bytes) -> None:
+        """
+        Appends data to the buffer, dropping the oldest bytes on overflow.
+        """
+        n = len(data)
+        if n == 0:
+            return
+        if n > self.capacity:
+            self.overruns += n - self.capacity
+            data = data[n - self.capacity:]
+            n = self.capacity
+        free = self.capacity - self.__size__
+        if n > free:
+            self.consume(n - free)
+            self.overruns += n - free
+
+        tail = (self.__head__ + self.__size__) % self.capacity
+        first = min(n, self.capacity - tail)
+        self.__buffer__[tail:tail + first] = data[:first]
+        if first < n:
+            self.__buffer__[:n - first] = data[first:]
+        self.__size__ += n
+
+    def peek(self, n: int | None = None) -> bytes:
+        """
+        Returns up to n bytes from the head of the buffer without consuming them.
+        """
+        if n is None or n > self.__size__:
+            n = self.__size__
+        head = self.__head__
+        end = head + n
+        if end <= self.capacity:
+            return bytes(self.__buffer__[head:end])
+        return bytes(self.__buffer__[head:]) + bytes(self.__buffer__[:end - self.capacity])
+
+    def consume(self, n: int) -> None:
+        """
+        Drops n bytes from the head of the buffer.
+        """
+        n = min(n, self.__size__)
+        self.__head__ = (self.__head__ + n) % self.capacity
+        self.__size__ -= n
+        self.__scanned__ = max(0, self.__scanned__ - n)
+        if self.__size__ == 0:
+            self.__head__ = 0
+
+    def __find_delimiter__(self) -> int:
+        """
+        Returns offset of the first delimiter after the head, or -1.
+        Bytes which were already searched are not scanned again.
+        """
+        start = self.__head__ + self.__scanned__
+        end = self.__head__ + self.__size__
+        if start < self.capacity:
+            idx = self.__buffer__.find(self.delimiter, start, min(end, self.capacity))
+            if idx >= 0:
+                return idx - self.__head__
+            start = self.capacity
+        if end > self.capacity:
+            idx = self.__buffer__.find(self.delimiter, start - self.capacity, end - self.capacity)
+            if idx >= 0:
+                return idx + self.capacity - self.__head__
+        self.__scanned__ = self.__size__
+        return -1
+
+    def read_frame(self) -> bytes | None:
+        """
+        Returns the next complete frame without the delimiter,
+        or None if there is no complete frame in the buffer.
+        """
+        offset = self.__find_delimiter__()
+        if offset < 0:
+            return None
+        frame = self.peek(offset)
+        self.consume(offset + 1)
+        self.__scanned__ = 0
+        return frame
+
+    def frames(self) -> list[bytes]:
+        """
+        Returns all complete frames in the buffer.
+        """
+        result = []
+        frame = self.read_frame()
+        while frame is not None:
+            result.append(frame)
+            frame = self.read_frame()
+        return result
@@ -0,0 +1,29 @@
+"""
+Keeps Redis memory flat during long sessions: messages which fall out of
+stream_retention (config.py) are moved to segment files in archive_directory.
+Set archive_enabled = True in config.py, so publishers leave the trimming to this process.
+"""
+import time
+from RedisPostman.StreamArchiver import StreamArchiver
+from RedisPostman.ConnectionManager import get_redis
+from config import stream_retention, archive_directory, archive_segment_size, archive_interval, archive_enabled
+
+
+def main() -> None:
+    if not archive_enabled:
+        print("WARNING: archive_enabled is False, publishers trim the streams before they are archived")
+    archiver = StreamArchiver(get_redis(), retention=stream_retention,
+                              directory=archive_directory, segment_size=archive_segment_size)
+    while True:
+        try:
+            archived = archiver.archive()
+            for channel, n in archived.items():
+                if n > 0:
+                    print(f"[INFO]:\tarchived {n} messages of {channel}")
+            time.sleep(archive_interval)
+        except KeyboardInterrupt:
+            return
+
+
+if __name__ == "__main__":
+    main()
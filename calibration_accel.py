@@ -1,15 +1,29 @@
 """
 The code can be used to proceed calibration of accelerometer data, all results will be stored in calib_data.json file.
 If there already is some data, not related to the imus you want to calibrate, it will stay the same.
+With --method ellipsoid the correction matrix and bias of the ellipsoid fit are stored too.
 """
+import argparse
+import asyncio
 
 from RedisPostman.RedisWorker import RedisWorker
 import json
 from AccelerometerCalibration.Calibration import CalibrationAcc
-from config import acc_coefficients_str, acc_offsets_str, gyro_coefficients_str, gyro_offsets_str, imu_raw_message_channel, calib_data_filename
+from AccelerometerCalibration.EllipsoidFit import EllipsoidCalibration
+from config import acc_bias_str, acc_coefficients_str, acc_matrix_str, acc_offsets_str, gyro_coefficients_str, gyro_offsets_str, imu_raw_message_channel, calib_data_filename, calibration_samples, calibration_stillness, calibration_method, calibration_poses, calib_store_key
 from RedisPostman.models import IMUCoefficients, IMUMessage
+from RedisPostman.CalibrationStore import ACalibrationStore
+from RedisPostman.ConnectionManager import get_async_redis
 
-def main()->None:
+def create_calibration(method: str, wait_for_motion: bool) -> CalibrationAcc | EllipsoidCalibration:
+    if method == "ellipsoid":
+        return EllipsoidCalibration(n_poses=calibration_poses, samples_per_pose=calibration_samples, stillness=calibration_stillness,
+                                    to_show_progress=True, wait_for_motion=wait_for_motion)
+    return CalibrationAcc(n_measurements=calibration_samples, to_show_progress=True, stillness=calibration_stillness,
+                          wait_for_motion=wait_for_motion)
+
+
+def main(method: str = calibration_method)->None:
     worker = RedisWorker()
 
     # Reading and storing data about calibration coeffitients from file with calib_data_filename
@@ -30,8 +44,7 @@ def main()->None:
     
 
     # First IMU calibration
-    calibration_acc_1 = CalibrationAcc(
-        n_measurements=1000, to_show_progress=True)
+    calibration_acc_1 = create_calibration(method, wait_for_motion=False)
     for message in worker.subscribe(dataClass=IMUMessage, count=10000, channel=imu_raw_message_channel):
         if calibration_acc_1.calibration_is_finished:
             break
@@ -41,8 +54,7 @@ def main()->None:
     print("\n_____\nNext IMU calibration starts!")
 
     # Second IMU calibration
-    calibration_acc_2 = CalibrationAcc(
-        n_measurements=1000, to_show_progress=True)
+    calibration_acc_2 = create_calibration(method, wait_for_motion=True)
     for message in worker.subscribe(dataClass=IMUMessage, count=10000, channel=imu_raw_message_channel):
         if calibration_acc_2.calibration_is_finished:
             break
@@ -63,6 +75,15 @@ def main()->None:
     calib_data['imu_1'][acc_offsets_str] = acc_offsets_1
     calib_data['imu_1'][acc_coefficients_str] = acc_coefficients_1
 
+    for imu_n, calibration in (("imu_1", calibration_acc_1), ("imu_2", calibration_acc_2)):
+        if isinstance(calibration, EllipsoidCalibration):
+            calib_data[imu_n][acc_matrix_str] = calibration.get_matrix()
+            calib_data[imu_n][acc_bias_str] = calibration.get_bias()
+        else:
+            # the matrix is used instead of the offsets and coefficients, drop the previous one
+            calib_data[imu_n].pop(acc_matrix_str, None)
+            calib_data[imu_n].pop(acc_bias_str, None)
+
 
 
     # calibr_results = {"imu_1":  {acc_offsets_str: acc_offsets_1, acc_coeffitients_str: acc_coefficients_1}, "imu_2": {
@@ -72,7 +93,22 @@ def main()->None:
     with open('calib_data.json', 'w+', encoding='utf-8') as f:
         json.dump(calib_res_json, f, ensure_ascii=False, indent=4)
 
+    if calib_store_key is not None:
+        version = asyncio.run(publish_calibration(calib_data, calib_store_key))
+        print(f"Calibration version {version} published")
+
+
+async def publish_calibration(calib_data: dict, key: str) -> int:
+    """
+    Publishes the calibration to the running recalculate_data.py processes.
+    """
+    return await ACalibrationStore(get_async_redis(), key).publish(calib_data)
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calibrates the accelerometers of both IMUs.")
+    parser.add_argument("--method", choices=["axes", "ellipsoid"], default=calibration_method,
+                        help="offset and coefficient of each axis from three poses, or the ellipsoid fit over many poses")
+    args = parser.parse_args()
 
-    main()
\ No newline at end of file
+    main(args.method)
\ No newline at end of file
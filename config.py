@@ -56,11 +56,40 @@ mpu9250_headers=[
     
 ]
 
+# serial port the IMUs are connected to
+serial_port_name = '/dev/ttyUSB0'
+serial_baudrate = 115200
+
+# format of the data in the serial port:
+# "json" - one JSON message per line,
+# "binary" - fixed-width frames described in SerialReader/BinaryFrames.py with esp_headers fields for each IMU
+serial_frame_mode = "json"
+# type of the binary frame fields: "<i2" - int16, "<f4" - float32
+binary_frame_field_type = "<i2"
+
+# key of the sample timestamp in the IMU messages, seconds of a monotonic clock.
+# Set by the device (JSON mode) or at ingest: from the frame sequence numbers in binary mode,
+# from time.monotonic() of the received lines in JSON mode
+timestamp_key = "t"
+# nominal sampling period of the IMUs in seconds
+imu_sample_period = 1 / 256
+# time between samples longer than this (or negative) is a gap,
+# the filters integrate such samples over imu_sample_period instead
+max_sample_dt = 0.1
+
 # redis data channels names
 imu_raw_message_channel = "imu_raw_data"
 imu_calibrated_message_channel = "imu_calibrated_data"
 madgwick_message_channel = "madgwick_data"
 
+# madgwick_transformer.py runs madgwick_shards processes, each transforms its own subset of the IMUs
+# and posts partial messages to its madgwick_shard_channel; the main process merges them into
+# one message per sample on madgwick_message_channel. 1 - one process, no shard channels.
+madgwick_shards = 1
+madgwick_shard_channel = madgwick_message_channel + "_shard_{}"
+# key of the input stream id in the shard messages, the merge key
+shard_source_key = "source"
+
 # logger stream name in redis database. Not is use for now. But it will be a great work.
 log_message_channel = "logger"
 
@@ -75,10 +104,35 @@ calib_data_filename = "calib_data.json"
 # names of calibration coefficients in the file with calib_data_filename
 acc_offsets_str = "acc offsets"
 acc_coefficients_str = "acc coeffs"
+# correction matrix and bias of the ellipsoid fit, calibrated = matrix @ (raw - bias),
+# used instead of the offsets and coefficients above when present
+acc_matrix_str = "acc matrix"
+acc_bias_str = "acc bias"
 
 gyro_coefficients_str = "gyro coeffs"
 gyro_offsets_str = "gyro offsets"
 
+# versioned calibration sets in redis (RedisPostman/CalibrationStore.py): calibration_accel.py publishes every new
+# calibration, recalculate_data.py switches to it without a restart and tags its messages with the version
+# under calib_version_key (kept by the "json" and "msgpack" encodings). The store is seeded from calib_data_filename
+# when it is empty. None - recalculate_data.py uses calib_data_filename read on start
+calib_store_key: str | None = "calib_coefficients"
+calib_version_key = "calib_version"
+
+# accelerometer calibration of calibration_accel.py: number of samples per axis and the StillnessGate
+# parameters (AccelerometerCalibration/Calibration.py), the capture starts when the IMU is held still for min_duration
+calibration_samples = 1000
+# "axes" - offset and coefficient of each axis from three poses,
+# "ellipsoid" - correction matrix and bias fitted over calibration_poses static poses (AccelerometerCalibration/EllipsoidFit.py)
+calibration_method = "axes"
+calibration_poses = 12
+calibration_stillness = {
+    "window": 0.25,
+    "variance": 1e-3,
+    "min_duration": 1.0,
+    "sample_period": imu_sample_period,
+}
+
 import numpy as np
 
 # gyroscope parameters which has to be checked via experiments of from IMU documentation
@@ -86,4 +140,115 @@ import numpy as np
 # omega_e_imu_2 = [0.001, 0.01, 0.0075]
 
 omega_e_imu_1 = [1, 1, 1]
-omega_e_imu_2 = [0.01, 0.01, 0.01]
\ No newline at end of file
+omega_e_imu_2 = [0.01, 0.01, 0.01]
+
+# rest scheduling of the Madgwick filter, StationaryDetector parameters (Madgwick/StationaryDetector.py):
+# at rest most samples get gyroscope-only propagation instead of the full correction step,
+# the correction gain is scaled by rest_beta_scale and the gyroscope bias is refined.
+# Rest needs both low variances and a mean rotation rate under gyr_rate, a steady rotation slower than gyr_rate is
+# taken into the bias, so keep gyr_rate near the residual bias of the calibrated gyroscope.
+# None (default) runs the full update on every sample, see Benchmarks/benchmark_stationary.py for the saved time. Example:
+# stationary_detection = {"window": 0.25, "gyr_variance": 1e-3, "gyr_rate": 0.01, "acc_variance": 5e-3, "min_duration": 0.5,
+#                         "correction_interval": 8, "rest_beta_scale": 2.0, "bias_time_constant": 5.0}
+stationary_detection: dict[str, float] | None = None
+
+# online gyroscope bias of recalculate_data.py, StationaryDetector parameters of each IMU: at rest the bias of the
+# calibrated gyroscope data is refined with the time constant bias_time_constant and subtracted from it.
+# None (default) - the static gyro offsets of calib_data_filename only. Example:
+# gyro_bias_detection = {"window": 0.25, "gyr_variance": 1e-3, "gyr_rate": 0.01, "acc_variance": 5e-3, "min_duration": 0.5,
+#                        "bias_time_constant": 5.0}
+gyro_bias_detection: dict[str, float] | None = None
+# redis hash of the bias estimates, restored on start and readable by other processes:
+# field "state" - JSON {imu name: {"bias": [x, y, z] in rad/s, counters}}, field "saved_at" - unix time
+gyro_bias_key = "gyro_bias"
+# seconds between the updates of the hash
+gyro_bias_interval = 1.0
+
+# the bias is estimated in one stage only: the data calibrated with gyro_bias_detection comes without it,
+# so the rest scheduling of the Madgwick filter does not refine it again
+madgwick_stationary = stationary_detection
+if stationary_detection is not None and gyro_bias_detection is not None:
+    madgwick_stationary = {**stationary_detection, "bias_time_constant": 0.0}
+
+# orientation filter of madgwick_transformer.py: "madgwick", "mahony" or "complementary",
+# see Benchmarks/benchmark_ahrs.py for their cost and accuracy
+ahrs_engine = "madgwick"
+# constructor parameters of the engines, sample_period and max_dt are added from the settings above
+ahrs_parameters = {
+    "madgwick": {"stationary": madgwick_stationary},
+    "mahony": {"kp": 2.0, "ki": 0.05},
+    "complementary": {"gain": 0.02},
+}
+
+# snapshots of the filter state of madgwick_transformer.py (quaternions, bias estimates, timestamps),
+# restored on start so the filters do not reconverge from the identity after a restart:
+# "redis" - hash checkpoint_key in redis, a file path - JSON file, None - no snapshots
+checkpoint_target: str | None = "redis"
+checkpoint_key = "madgwick_state"
+# seconds between the snapshots
+checkpoint_interval = 1.0
+# older snapshots are not restored, in seconds, None - no limit
+checkpoint_max_age: float | None = 3600.0
+
+# buffered publishing to redis: a batch is sent when it has publish_batch_size messages
+# or when its oldest message waited for publish_max_latency seconds
+publish_batch_size = 100
+publish_max_latency = 0.005
+
+# redis consumer groups: processed messages are acknowledged in batches of consumer_group_ack_batch_size,
+# messages pending longer than consumer_group_claim_min_idle ms are taken over from crashed consumers
+consumer_group_ack_batch_size = 100
+consumer_group_claim_min_idle = 30000
+
+# retention of the redis streams, streams are trimmed approximately on every publish:
+# "maxlen" - max number of messages in the stream, "max_age" - max age of the messages in seconds.
+# Channels which are not listed grow without limit.
+stream_retention: dict[str, dict[str, float]] = {
+    imu_raw_message_channel: {"maxlen": 200000},
+    imu_calibrated_message_channel: {"maxlen": 200000},
+    madgwick_message_channel: {"maxlen": 200000},
+    **{madgwick_shard_channel.format(i): {"maxlen": 20000} for i in range(madgwick_shards)},
+    log_message_channel: {"max_age": 24 * 3600},
+}
+
+# if True, publishers do not trim the streams: archive_streams.py saves messages
+# which fall out of stream_retention to segment files and trims the streams after that
+archive_enabled = False
+archive_directory = "archive"
+# max number of messages in one segment file
+archive_segment_size = 100000
+# how often the archiver checks the streams, in seconds
+archive_interval = 1.0
+
+# encoding of the messages published to each channel: "json", "msgpack" (requires msgpack package)
+# or "f32" (packed float32 values, only for IMU9250Message channels).
+# Consumers decode any encoding, messages read with subscribe() are converted to JSON.
+message_encodings = {
+    imu_raw_message_channel: "json",
+    imu_calibrated_message_channel: "json",
+    madgwick_message_channel: "json",
+}
+
+# channels passed between the processes of this machine through shared memory rings instead of redis,
+# e.g. [imu_raw_message_channel, imu_calibrated_message_channel]. Only one process may publish to such channel,
+# it removes the ring on exit. Consumer groups need redis streams and are not available for these channels.
+shared_memory_channels: list[str] = []
+# shared memory channels which are also published to redis, for the remote consumers and the visualization
+redis_tap_channels: list[str] = [imu_raw_message_channel, imu_calibrated_message_channel, madgwick_message_channel]
+# size of one message record in bytes and number of records in the ring of each shared memory channel.
+# A record holds a 24 bytes header and the message, a calibrated JSON message of two IMUs takes up to 676 bytes.
+# The brokers check on creation that the messages of the channels fit.
+shared_memory_slot_size = 1024
+shared_memory_n_slots = 65536
+
+# redis connection shared by all workers of a process, see RedisPostman/ConnectionManager.py.
+# A unix socket is faster for local processes: "unix:///var/run/redis/redis-server.sock?db=0"
+redis_url = "redis://localhost:6379/0"
+redis_max_connections = 50
+redis_socket_keepalive = True
+# seconds of idleness after which a connection is checked before use
+redis_health_check_interval = 30
+# reconnection attempts with exponential backoff from redis_backoff_base to redis_backoff_cap seconds
+redis_retries = 5
+redis_backoff_base = 0.01
+redis_backoff_cap = 1.0
@@ -1,46 +1,205 @@
+import argparse
 import asyncio
 import datetime
-from Madgwick.MadgwickFilter import MadgwickAHRS
+import multiprocessing
+import os
+import numpy as np
+from Madgwick.AHRS import AHRSBank
+from Madgwick.MadgwickBank import MadgwickBank
+from Madgwick.engines import create_bank
 from RedisPostman.models import IMUMessage, LogMessage, IMU9250Message
 import json
-from config import madgwick_message_channel,  imu_1_name, imu_2_name, imu_calibrated_message_channel, omega_e_imu_1, omega_e_imu_2, log_message_channel, imu_raw_message_channel
+from config import madgwick_message_channel,  imu_1_name, imu_2_name, imu_calibrated_message_channel, omega_e_imu_1, omega_e_imu_2, log_message_channel, imu_raw_message_channel, publish_batch_size, publish_max_latency, message_encodings, timestamp_key, imu_sample_period, max_sample_dt, ahrs_engine, ahrs_parameters, checkpoint_target, checkpoint_key, checkpoint_interval, checkpoint_max_age, madgwick_shards, madgwick_shard_channel, shard_source_key
 from RedisPostman.RedisWorker import AsyncRedisWorker
+from RedisPostman.ConnectionManager import get_redis
+from RedisPostman.MessageBroker import ABufferedPublisher
+from RedisPostman.StateCheckpoint import AStateCheckpoint
+from RedisPostman.ShardMerger import ShardMerger
 
 
-async def transform_imu_data_to_quaternions(out_channel_name: str, in_channel_name:str):
+def update_bank(bank: MadgwickBank | AHRSBank, batch: np.ndarray, imu_names: list[str], dt: np.ndarray) -> np.ndarray:
+    """
+    Runs the filter bank over the IMU9250Message batch, one filter per IMU in imu_names.
+
+    :return: (N, imus, 4) quaternions
+    """
+    gyr = np.stack([batch[imu]["gyr"] for imu in imu_names], axis=1)
+    acc = np.stack([batch[imu]["acc"] for imu in imu_names], axis=1)
+    mag = np.stack([batch[imu]["mag"] for imu in imu_names], axis=1)
+    return bank.update_batch(gyr=gyr, acc=acc, mag=mag, dt=dt)
+
+
+def bank_snapshot(bank: MadgwickBank | AHRSBank, engine: str, imu_names: list[str]) -> dict:
+    """
+    Snapshot of the filter bank for the checkpoint, with the engine and the IMUs it was made for.
+    """
+    return {"engine": engine, "imu_names": imu_names, "bank": bank.state_dict()}
+
+
+def restore_bank(bank: MadgwickBank | AHRSBank, snapshot: dict, engine: str, imu_names: list[str]) -> bool:
+    """
+    Restores the filter bank from the bank_snapshot, if it was made for the same engine and IMUs.
+
+    :return: True if the bank was restored
+    """
+    if snapshot.get("engine") != engine or snapshot.get("imu_names") != imu_names:
+        return False
+    bank.load_state(snapshot["bank"])
+    return True
+
+
+def shard_imu_names(imu_names: list[str], n_shards: int) -> list[list[str]]:
+    """
+    Splits the IMUs into n_shards contiguous groups of (almost) the same size.
+    """
+    n_shards = max(1, min(n_shards, len(imu_names)))
+    size, extra = divmod(len(imu_names), n_shards)
+    bounds = np.cumsum([0] + [size + (i < extra) for i in range(n_shards)])
+    return [imu_names[bounds[i]:bounds[i + 1]] for i in range(n_shards)]
+
+
+def create_checkpoint(worker: AsyncRedisWorker, imu_names: list[str]) -> AStateCheckpoint | None:
+    """
+    Checkpoint of the filter state of the IMUs, shards get their own hash or file.
+    """
+    if checkpoint_target is None:
+        return None
+    target, key = checkpoint_target, checkpoint_key
+    if imu_names != IMU9250Message.imu_names:
+        suffix = "_" + "_".join(imu_names)
+        key += suffix
+        if target != "redis":
+            root, ext = os.path.splitext(target)
+            target = root + suffix + ext
+    return AStateCheckpoint(target, key, worker.r, interval=checkpoint_interval, max_age=checkpoint_max_age)
+
+
+async def transform_imu_data_to_quaternions(out_channel_name: str, in_channel_name: str, imu_names: list[str] | None = None,
+                                            source_key: str | None = None):
     """
     Read data from IMU using serial port and post to redis stream.
+
+    :param imu_names: IMUs to transform, all IMUs of IMU9250Message by default. Only their fields are decoded
+    :param source_key: if set, every output message gets the stream id of its input message under this key, for ShardMerger
     """
-    mf1: MadgwickAHRS = MadgwickAHRS(omega_e=omega_e_imu_1)
-    mf2: MadgwickAHRS = MadgwickAHRS(omega_e=omega_e_imu_2)
+    if imu_names is None:
+        imu_names = IMU9250Message.imu_names
+    bank = create_bank(ahrs_engine, len(imu_names), sample_period=imu_sample_period, max_dt=max_sample_dt, **ahrs_parameters[ahrs_engine])
 
     worker = AsyncRedisWorker()
-    async for message in worker.subscribe(count=10000000, block=1, dataClass=IMU9250Message, channel=in_channel_name):
-        if message is None:
-            continue
-        try:
-            mf1.update_IMU(gyros_data=message.imu_1.gyr,
-                                accel_data=message.imu_1.acc, magn_data=message.imu_1.mag)
+    publisher = ABufferedPublisher(worker.broker, max_batch_size=publish_batch_size, max_latency=publish_max_latency, encodings=message_encodings)
 
-            mf2.update_IMU(gyros_data=message.imu_2.gyr,
-                                accel_data=message.imu_2.acc, magn_data=message.imu_2.mag)
+    # warm start from the last snapshot of the filter state
+    checkpoint = create_checkpoint(worker, imu_names)
+    if checkpoint is not None:
+        snapshot = await checkpoint.load()
+        if snapshot is not None and restore_bank(bank, snapshot, ahrs_engine, imu_names):
+            print(f"[INFO]:\trestored the filter state of {imu_names} from {checkpoint.target}")
+    # Ctrl-C cancels this task (Python 3.11+) or raises KeyboardInterrupt in it, the final flush
+    # and snapshot run in finally while the event loop is still alive
+    try:
+        async for ids, batch in worker.subscribe_batch(count=10000, block=1, dataClass=IMU9250Message, channel=in_channel_name, imu_names=imu_names):
+            try:
+                # integrate over the sensor time, so the result does not depend on batching or consumer lag
+                dt = bank.timestamps_to_dt(batch[timestamp_key])
 
+                quaternions = update_bank(bank, batch, imu_names, dt)
 
-            madgwick_data = {imu_1_name: mf1.quaternion.tolist(), imu_2_name: mf2.quaternion.tolist()}
-            # print("[INFO]:\t", madgwick_data)
+                for stream_id, row, t in zip(ids, quaternions.tolist(), batch[timestamp_key].tolist()):
+                    madgwick_data = dict(zip(imu_names, row))
+                    if not np.isnan(t):
+                        madgwick_data[timestamp_key] = t
+                    if source_key is not None:
+                        madgwick_data[source_key] = stream_id
+                    await publisher.publish_dict(out_channel_name, madgwick_data)
 
-            await worker.broker.publish(channel=out_channel_name, message=json.dumps(madgwick_data))
+                if checkpoint is not None:
+                    await checkpoint.save_due(bank_snapshot(bank, ahrs_engine, imu_names))
 
-        except KeyboardInterrupt:
-            await worker.broker.redis_client.delete(madgwick_message_channel)
-            return
-        except Exception as e:
-            error_message = LogMessage(date=datetime.datetime.now(), process_name="madgwick_transformer", status=LogMessage.exception_to_dict(e))
-            await worker.broker.publish(log_message_channel, json.dumps(error_message.to_dict()))
+            except Exception as e:
+                error_message = LogMessage(date=datetime.datetime.now(), process_name="madgwick_transformer", status=LogMessage.exception_to_dict(e))
+                await worker.broker.publish(log_message_channel, json.dumps(error_message.to_dict()))
+    finally:
+        await publisher.flush()
+        if checkpoint is not None:
+            await checkpoint.save(bank_snapshot(bank, ahrs_engine, imu_names))
+        print(f"[INFO]:\tpublished {publisher.stats}")
+        print(f"[INFO]:\tgaps in the sensor time: {dict(zip(imu_names, bank.gaps.tolist()))}")
+        if isinstance(bank, MadgwickBank) and bank.detectors:
+            print(f"[INFO]:\trest scheduling: {dict(zip(imu_names, bank.stationary_stats()))}")
+        if worker.broker.lost:
+            print(f"[INFO]:\tlost in shared memory: {worker.broker.lost}")
+        await worker.broker.close()
+        await worker.broker.redis_client.delete(out_channel_name)
 
 
-if __name__ == "__main__":
+async def merge_shards(shard_channels: list[str], out_channel_name: str, start_id: str = "0"):
+    """
+    Joins the partial messages of the shard channels into one message per IMU sample and posts them to out_channel_name.
+
+    :param start_id: id after which the shard channels are read, by default from the start:
+        the shards may publish before the merger subscribes, main clears the channels before starting them
+    """
+    worker = AsyncRedisWorker()
+    publisher = ABufferedPublisher(worker.broker, max_batch_size=publish_batch_size, max_latency=publish_max_latency, encodings=message_encodings)
+    merger = ShardMerger(len(shard_channels), source_key=shard_source_key)
+    readers = [worker.broker.subscribe_batch(channel, start_id, 1, count=10000) for channel in shard_channels]
+    try:
+        while True:
+            for shard, reader in enumerate(readers):
+                _, messages = await reader.__anext__()
+                merger.add(shard, messages)
+            for message in merger.pop_ready():
+                await publisher.publish_dict(out_channel_name, message)
+    finally:
+        # runs on the cancellation of the task by Ctrl-C too, while the event loop is still alive
+        await publisher.flush()
+        print(f"[INFO]:\tpublished {publisher.stats}, dropped incomplete samples: {merger.dropped}")
+        if worker.broker.lost:
+            print(f"[INFO]:\tlost in shared memory: {worker.broker.lost}")
+        await worker.broker.close()
+        await worker.broker.redis_client.delete(out_channel_name, *shard_channels)
+
 
-    madgwick_data_channel = madgwick_message_channel
+def run_shard(imu_names: list[str], in_channel_name: str, out_channel_name: str) -> None:
+    """
+    Process of one shard, transforms the imu_names to out_channel_name.
+    """
+    try:
+        asyncio.run(transform_imu_data_to_quaternions(out_channel_name=out_channel_name, in_channel_name=in_channel_name,
+                                                      imu_names=imu_names, source_key=shard_source_key))
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Transforms the IMU data to quaternions.")
+    parser.add_argument("--shards", type=int, default=madgwick_shards,
+                        help="number of worker processes, each transforms its own subset of the IMUs, "
+                             "defaults to madgwick_shards, which also sets the retention of the shard channels")
+    args = parser.parse_args()
+
+    shards = shard_imu_names(IMU9250Message.imu_names, args.shards)
+    if len(shards) == 1:
+        try:
+            asyncio.run(transform_imu_data_to_quaternions(in_channel_name=imu_raw_message_channel, out_channel_name=madgwick_message_channel))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    shard_channels = [madgwick_shard_channel.format(i) for i in range(len(shards))]
+    get_redis().delete(*shard_channels)
+    processes = [multiprocessing.Process(target=run_shard, args=(imu_names, imu_raw_message_channel, channel), daemon=True)
+                 for imu_names, channel in zip(shards, shard_channels)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(merge_shards(shard_channels, madgwick_message_channel))
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.join(timeout=5)
 
-    asyncio.run(transform_imu_data_to_quaternions(in_channel_name=imu_raw_message_channel, out_channel_name=madgwick_data_channel))
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
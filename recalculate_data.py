@@ -1,12 +1,18 @@
 import asyncio
 import datetime
+import math
+from dataclasses import replace
 import traceback
 
 import numpy as np
-from RedisPostman.models import IMUCoefficients,  IMUMessage, LogMessage, Message, IMU9250Message
+from RedisPostman.models import IMUCoefficients,  IMUMessage, LogMessage, Message, IMU9250Message, get_serializer
 import json
-from config import calib_data_filename, imu_raw_message_channel, imu_calibrated_message_channel, log_message_channel
+from config import calib_data_filename, imu_raw_message_channel, imu_calibrated_message_channel, log_message_channel, message_encodings, timestamp_key, imu_sample_period, gyro_bias_detection, gyro_bias_key, gyro_bias_interval, calib_store_key, calib_version_key
+from Madgwick.StationaryDetector import StationaryDetector
 from RedisPostman.RedisWorker import AsyncRedisWorker
+from RedisPostman.MessageBroker import BatchStats
+from RedisPostman.StateCheckpoint import AStateCheckpoint
+from RedisPostman.CalibrationStore import ACalibrationStore
 
 
 async def to_filter(array: list[IMUMessage], message: IMU9250Message):
@@ -23,43 +29,145 @@ async def to_filter(array: list[IMUMessage], message: IMU9250Message):
         array = array[1:]
 
 
-async def apply_coeffs_to_imu_message(coefficients: IMUCoefficients, in_channel_name: str, out_channel_name: str, in_dataClass: type[Message]):
-
-    imu_1_acc_coeffs = coefficients.imu_1_acc.coeffs
-    imu_1_acc_offset = coefficients.imu_1_acc.offset
-    imu_1_gyr_coeffs = coefficients.imu_1_gyr.coeffs
-    imu_1_gyr_offset = coefficients.imu_1_gyr.offset
+def create_bias_detectors(detection: dict[str, float] | None = gyro_bias_detection) -> dict[str, StationaryDetector]:
+    """
+    Online gyroscope bias estimators of the IMUs with the StationaryDetector parameters, none if detection is None.
+    """
+    if detection is None:
+        return {}
+    return {imu_name: StationaryDetector(sample_period=imu_sample_period, **detection) for imu_name in IMU9250Message.imu_names}
+
+
+def remove_gyro_bias(detectors: dict[str, StationaryDetector], block: np.ndarray) -> np.ndarray:
+    """
+    Refines the gyroscope bias of every IMU at rest and subtracts it from the calibrated (N, imus, sensors, 3) block in place.
+    """
+    for i, imu_name in enumerate(IMU9250Message.imu_names):
+        if imu_name in detectors:
+            block[:, i, 1], _ = detectors[imu_name].schedule(block[:, i, 1], block[:, i, 0])
+    return block
+
+
+def block_to_payloads(dataClass: type[IMU9250Message], block: np.ndarray, timestamps: np.ndarray, version: int) -> list[dict]:
+    """
+    Messages of the calibrated block with their timestamps, tagged with the calibration version.
+    """
+    payloads = dataClass.block_to_dicts(block)
+    for payload, t in zip(payloads, timestamps.tolist()):
+        payload[calib_version_key] = version
+        if not math.isnan(t):
+            payload[timestamp_key] = t
+    return payloads
+
+
+def bias_snapshot(detectors: dict[str, StationaryDetector]) -> dict[str, dict]:
+    return {imu_name: detector.state_dict() for imu_name, detector in detectors.items()}
+
+
+def restore_bias(detectors: dict[str, StationaryDetector], snapshot: dict[str, dict]) -> bool:
+    """
+    Loads the bias estimates of the snapshot, unless it was made for other IMUs.
+    """
+    if sorted(snapshot) != sorted(detectors):
+        return False
+    for imu_name, detector in detectors.items():
+        detector.load_state(snapshot[imu_name])
+    return True
+
+
+async def open_calibration_store(worker: AsyncRedisWorker, coefficients: IMUCoefficients) -> tuple[ACalibrationStore | None, IMUCoefficients]:
+    """
+    Subscribes to the calibration store and returns its current set, an empty store is seeded with coefficients.
+    """
+    if calib_store_key is None:
+        return None, coefficients
+    store = ACalibrationStore(worker.r, calib_store_key)
+    await store.subscribe()
+    current = await store.load()
+    if current is None:
+        version = await store.publish(coefficients.to_dict())
+        return store, replace(coefficients, version=version)
+    version, calib_data = current
+    return store, IMUCoefficients.from_dict(calib_data, version=version)
+
+
+async def reload_coefficients(store: ACalibrationStore, coefficients: IMUCoefficients, detectors: dict[str, StationaryDetector]) -> IMUCoefficients:
+    """
+    Returns the current set of the store if a newer one was published since the last call, else coefficients.
+    The online gyroscope bias starts over when the gyroscope calibration of the IMU changed.
+    """
+    notified = await store.poll()
+    if notified is None or notified <= coefficients.version:
+        return coefficients
+    current = await store.load()
+    if current is None or current[0] <= coefficients.version:
+        return coefficients
+    version, calib_data = current
+    updated = IMUCoefficients.from_dict(calib_data, version=version)
+    for imu_name, detector in detectors.items():
+        old, new = getattr(coefficients, imu_name + "_gyr"), getattr(updated, imu_name + "_gyr")
+        if not (np.array_equal(old.offset, new.offset) and np.array_equal(old.coeffs, new.coeffs)):
+            detector.bias = np.zeros(3)
+    print(f"[INFO]:\tcalibration version {coefficients.version} -> {version}")
+    return updated
 
-    imu_2_acc_coeffs = coefficients.imu_2_acc.coeffs
-    imu_2_acc_offset = coefficients.imu_2_acc.offset
-    imu_2_gyr_coeffs = coefficients.imu_2_gyr.coeffs
-    imu_2_gyr_offset = coefficients.imu_2_gyr.offset
 
+async def apply_coeffs_to_imu_message(coefficients: IMUCoefficients, in_channel_name: str, out_channel_name: str, in_dataClass: type[Message]):
+    """
+    Calibrates every message of the input channel. The messages are processed in blocks of all messages
+    received since the last read: one batched matrix product calibrates the whole (N, imus, sensors, 3) block
+    and the block is published with one pipelined round-trip.
+    """
+    assert issubclass(in_dataClass, IMU9250Message)
     worker = AsyncRedisWorker()
-
-    async for message in worker.subscribe(count=10000000, block=1, dataClass=in_dataClass, channel=in_channel_name):
-        if message is not None:
+    encoding = message_encodings.get(out_channel_name, "json")
+    serializer = get_serializer(encoding)
+    stats = BatchStats()
+
+    detectors = create_bias_detectors()
+    checkpoint = AStateCheckpoint("redis", gyro_bias_key, worker.r, interval=gyro_bias_interval) if detectors else None
+    if checkpoint is not None:
+        snapshot = await checkpoint.load()
+        if snapshot is not None and restore_bias(detectors, snapshot):
+            print(f"[INFO]:\trestored the gyroscope bias {[detector.bias.tolist() for detector in detectors.values()]}")
+    # the coefficients are swapped between blocks, each block is calibrated with one version
+    store, coefficients = await open_calibration_store(worker, coefficients)
+    stacked = coefficients.stack()
+    print(f"[INFO]:\tcalibration version {coefficients.version}")
+
+    # Ctrl-C cancels this task (Python 3.11+) or raises KeyboardInterrupt in it, the final bias
+    # snapshot runs in finally while the event loop is still alive
+    try:
+        async for ids, block, timestamps in worker.subscribe_block(count=10000, block=1, dataClass=in_dataClass, channel=in_channel_name):
             try:
-                message.imu_1.gyr = (message.imu_1.gyr -
-                                     imu_1_gyr_offset) * imu_1_gyr_coeffs
-                message.imu_1.acc = (message.imu_1.acc -
-                                     imu_1_acc_offset) * imu_1_acc_coeffs
-                message.imu_1.acc = message.imu_1.acc/np.linalg.norm(message.imu_1.acc)
-
-                message.imu_2.gyr = (message.imu_2.gyr -
-                                     imu_2_gyr_offset) * imu_2_gyr_coeffs
-                message.imu_2.acc = (message.imu_2.acc -
-                                     imu_2_acc_offset) * imu_2_acc_coeffs
-                message.imu_2.acc = message.imu_2.acc/np.linalg.norm(message.imu_2.acc)
-
-                await worker.broker.publish(channel=out_channel_name, message=json.dumps(message.to_dict()))
-
-            except KeyboardInterrupt:
-                await worker.broker.redis_client.delete(out_channel_name)
-                return
+                if store is not None:
+                    updated = await reload_coefficients(store, coefficients, detectors)
+                    if updated is not coefficients:
+                        coefficients, stacked = updated, updated.stack()
+                stacked.apply(block)
+                remove_gyro_bias(detectors, block)
+
+                payloads = block_to_payloads(in_dataClass, block, timestamps, stacked.version)
+                await worker.broker.publish_many(out_channel_name, [serializer.dumps(payload) for payload in payloads], encoding)
+                stats.add(len(payloads))
+                if checkpoint is not None:
+                    await checkpoint.save_due(bias_snapshot(detectors))
+
             except Exception as e:
                 error_message = LogMessage(date=datetime.datetime.now(), process_name="recalculate_data", status=LogMessage.exception_to_dict(e))
                 await worker.broker.publish(log_message_channel, json.dumps(error_message.to_dict()))
+    finally:
+        if checkpoint is not None:
+            await checkpoint.save(bias_snapshot(detectors))
+            for imu_name, detector in detectors.items():
+                print(f"[INFO]:\t{imu_name} gyroscope bias {detector.bias.tolist()}, {detector.stats()}")
+        print(f"[INFO]:\tpublished {stats}")
+        if worker.broker.lost:
+            print(f"[INFO]:\tlost in shared memory: {worker.broker.lost}")
+        if store is not None:
+            await store.close()
+        await worker.broker.close()
+        await worker.broker.redis_client.delete(out_channel_name)
 
 
 if __name__ == "__main__":
@@ -68,5 +176,8 @@ if __name__ == "__main__":
 
     coeff = IMUCoefficients.read_from_file(filename)
 
-    asyncio.run(apply_coeffs_to_imu_message(coefficients=coeff, in_channel_name=imu_raw_message_channel,
-                out_channel_name=imu_calibrated_message_channel, in_dataClass=IMU9250Message))
\ No newline at end of file
+    try:
+        asyncio.run(apply_coeffs_to_imu_message(coefficients=coeff, in_channel_name=imu_raw_message_channel,
+                    out_channel_name=imu_calibrated_message_channel, in_dataClass=IMU9250Message))
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file
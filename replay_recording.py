@@ -0,0 +1,159 @@
+"""
+Replays recorded raw IMU data through the processing pipeline in-process,
+as fast as the CPU allows: the calibration and the gyroscope bias removal of recalculate_data.py
+and the Madgwick filters of madgwick_transformer.py, without Redis in between.
+The filters integrate over the sample timestamps, so the result is the same as live processing.
+
+Every (recording, parameter set) pair is an independent job, jobs run in a process pool.
+
+A recording is a directory of segments written by archive_streams.py or by --export,
+or a text file (optionally gzip) with one "<stream id>\\t<message>" or "<message>" per line.
+
+Examples:
+    python replay_recording.py --export recordings/session_1
+    python replay_recording.py recordings/session_1 --beta 1 0.5 0.1 --calibration calib_data.json
+"""
+import argparse
+import gzip
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator
+import numpy as np
+from Madgwick.AHRS import AHRSBank
+from Madgwick.MadgwickBank import MadgwickBank
+from Madgwick.engines import create_bank
+from Madgwick import quaternions as quat
+from RedisPostman.models import IMU9250Message, IMUCoefficients
+from RedisPostman.StreamArchiver import StreamArchiver, read_segments
+from recalculate_data import create_bias_detectors, remove_gyro_bias
+from config import imu_raw_message_channel, imu_sample_period, max_sample_dt, ahrs_engine, ahrs_parameters, gyro_bias_detection
+
+# number of messages processed at once, bounds the memory for long recordings
+replay_chunk_size = 100000
+
+
+def read_recording(path: str, channel: str = imu_raw_message_channel) -> Iterator[dict[str, Any]]:
+    """
+    Yields the messages of the recording in order.
+    """
+    if os.path.isdir(path):
+        for _, message in read_segments(path, channel):
+            yield json.loads(message)
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                yield json.loads(line.split("\t", 1)[-1])
+
+
+def make_bank(n_filters: int, params: dict[str, Any]) -> MadgwickBank | AHRSBank:
+    """
+    Filter bank for the parameter set: "engine" - AHRS engine, defaults to ahrs_engine;
+    "parameters" - engine constructor parameters, default to ahrs_parameters;
+    for madgwick "beta" - algorithm gain, or "omega_e" - gyroscope noise in rad/s to derive beta from;
+    "sample_period", "max_dt" default to config.py.
+    """
+    engine = params.get("engine", ahrs_engine)
+    parameters = dict(params.get("parameters", ahrs_parameters[engine]))
+    if "beta" in params:
+        parameters["beta"] = np.ones(4) * params["beta"]
+    elif "omega_e" in params:
+        parameters["beta"] = np.ones(4) * np.sqrt(3) / 2 * params["omega_e"]
+    return create_bank(engine, n_filters, sample_period=params.get("sample_period", imu_sample_period),
+                       max_dt=params.get("max_dt", max_sample_dt), **parameters)
+
+
+def replay(messages: Iterator[dict[str, Any]], params: dict[str, Any]) -> dict[str, np.ndarray]:
+    """
+    Runs the messages through calibration (if params has "calibration", a coefficients file)
+    and the Madgwick filters. The calibrated gyroscope data is corrected by the online bias estimators
+    of params["gyro_bias_detection"], which defaults to config.py, like in recalculate_data.py.
+
+    :return: "t" (N,) timestamps, "quaternions" (N, imus, 4), "euler" (N, imus, 3) roll, pitch, yaw, "gaps" (imus,)
+    """
+    imu_names = IMU9250Message.imu_names
+    bank = make_bank(len(imu_names), params)
+    coefficients = IMUCoefficients.read_from_file(params["calibration"]).stack() if params.get("calibration") else None
+    # the thresholds of the estimators are in rad/s, the raw data is left as recorded
+    detectors = create_bias_detectors(params.get("gyro_bias_detection", gyro_bias_detection)) if coefficients is not None else {}
+
+    timestamps = []
+    quaternions = []
+    while True:
+        chunk = list(itertools.islice(messages, replay_chunk_size))
+        if len(chunk) == 0:
+            break
+        block = IMU9250Message.block_from_dicts(chunk)
+        t = IMU9250Message.timestamps_from_dicts(chunk)
+        if coefficients is not None:
+            coefficients.apply(block)
+            remove_gyro_bias(detectors, block)
+        quaternions.append(bank.update_batch(gyr=block[:, :, 1], acc=block[:, :, 0], mag=block[:, :, 2], dt=bank.timestamps_to_dt(t)))
+        timestamps.append(t)
+
+    q = np.concatenate(quaternions) if quaternions else np.zeros((0, len(imu_names), 4))
+    return {"t": np.concatenate(timestamps) if timestamps else np.zeros(0),
+            "quaternions": q, "euler": quat.to_euler(q), "gaps": bank.gaps}
+
+
+def run_job(recording: str, params: dict[str, Any], output: str) -> dict[str, Any]:
+    """
+    Replays one recording with one parameter set, saves the result to the output .npz file.
+    """
+    start = time.perf_counter()
+    result = replay(read_recording(recording), params)
+    np.savez_compressed(output, params=json.dumps(params), **result)
+    elapsed = time.perf_counter() - start
+    n = result["t"].shape[0]
+    return {"recording": recording, "params": params, "output": output, "samples": n,
+            "seconds": elapsed, "gaps": result["gaps"].tolist()}
+
+
+def export_recording(directory: str, channel: str = imu_raw_message_channel) -> int:
+    """
+    Exports the whole channel from Redis (XRANGE) to segments in the directory.
+    """
+    from RedisPostman.ConnectionManager import get_redis
+    return StreamArchiver(get_redis(), retention={}, directory=directory).export_channel(channel)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", help="recording directories or files")
+    parser.add_argument("--export", metavar="DIRECTORY", help="export the raw stream from Redis into the directory and exit")
+    parser.add_argument("--engine", nargs="+", help="AHRS engines to try, with their ahrs_parameters, defaults to ahrs_engine")
+    parser.add_argument("--beta", type=float, nargs="+", help="madgwick algorithm gains to try")
+    parser.add_argument("--omega-e", type=float, nargs="+", help="gyroscope noise values to try, beta is derived from them")
+    parser.add_argument("--calibration", nargs="+", help="calibration coefficients files to try, raw data is filtered if omitted")
+    parser.add_argument("--output", default="replay", help="directory for the results")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="size of the process pool")
+    args = parser.parse_args()
+
+    if args.export:
+        print(f"[INFO]:\texported {export_recording(args.export)} messages of {imu_raw_message_channel} to {args.export}")
+        return
+
+    gains = [{"beta": beta} for beta in args.beta or []] + [{"omega_e": omega_e} for omega_e in args.omega_e or []]
+    gains += [{"engine": engine} for engine in args.engine or []]
+    param_sets = [dict(gain, calibration=calibration) for gain in gains or [{}] for calibration in args.calibration or [None]]
+    os.makedirs(args.output, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = []
+        for recording in args.recordings:
+            name = os.path.basename(os.path.normpath(recording))
+            for i, params in enumerate(param_sets):
+                futures.append(pool.submit(run_job, recording, params, os.path.join(args.output, f"{name}_{i}.npz")))
+        for future in futures:
+            summary = future.result()
+            print(f"[INFO]:\t{summary['output']}: {summary['samples']} samples in {summary['seconds']:.1f} s "
+                  f"({summary['samples'] / max(summary['seconds'], 1e-9):.0f} samples/s), gaps {summary['gaps']}, {summary['params']}")
+
+
+if __name__ == "__main__":
+    main()